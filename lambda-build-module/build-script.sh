@@ -17,11 +17,15 @@ BUILD_DIR="$SCRIPT_DIR/builds"
 CODE_DIR="${1:-$(cd "$SCRIPT_DIR/../.." && pwd)/code}"
 JSON_DIR="${2:-$(cd "$SCRIPT_DIR/../.." && pwd)/lambda-json}"
 
+# Shared modules and data files imported by the handlers; every package gets the ones present in CODE_DIR
+SHARED_FILES="${SHARED_FILES:-s3_io.py stage_metrics.py stage_memory.py stage_profiler.py spill_buffer.py validation_cache.py schema_registry.json}"
+
 echo "Script directory: $SCRIPT_DIR"
 echo "Hash file: $HASH_FILE"
 echo "Code directory: $CODE_DIR"
 echo "JSON directory: $JSON_DIR"
 echo "Build directory: $BUILD_DIR"
+echo "Shared files: $SHARED_FILES"
 
 # Create build directory
 mkdir -p "$BUILD_DIR"
@@ -37,6 +41,14 @@ if [ ! -d "$JSON_DIR" ]; then
     exit 1
 fi
 
+# Collect the shared files that exist in this code directory
+shared_files=()
+for shared in $SHARED_FILES; do
+    if [ -f "$CODE_DIR/$shared" ]; then
+        shared_files+=("$shared")
+    fi
+done
+
 # Generate hash file
 echo "Generating lambda hashes..."
 echo '{' > "$HASH_FILE"
@@ -52,8 +64,8 @@ for lambda in "$JSON_DIR"/*.json; do
         echo "  Source file: $source_file"
         
         if [ -f "$source_file" ]; then
-            # Calculate SHA256 hash
-            hash=$(shasum -a 256 "$source_file" | cut -d' ' -f1)
+            # Calculate SHA256 hash over the handler and the shared files, so a shared change redeploys every function
+            hash=$(cd "$CODE_DIR" && shasum -a 256 "$lambda_name.py" "${shared_files[@]}" | shasum -a 256 | cut -d' ' -f1)
             echo "  \"$lambda_name\": \"$hash\"," >> "$HASH_FILE"
             echo "  Generated hash: $hash"
             
@@ -61,9 +73,10 @@ for lambda in "$JSON_DIR"/*.json; do
             package_file="$BUILD_DIR/$lambda_name.zip"
             echo "  Building package: $package_file"
             
-            # Create ZIP file
+            # Create ZIP file with the handler and the shared files at the package root
+            rm -f "$package_file"
             cd "$CODE_DIR"
-            zip -r "$package_file" "$lambda_name.py"
+            zip -r "$package_file" "$lambda_name.py" "${shared_files[@]}"
             cd - > /dev/null
             
             echo "  Package created: $package_file"
@@ -8,6 +8,12 @@ from kafka import KafkaProducer
 from kafka.errors import KafkaError
 from aws_msk_iam_sasl_signer import MSKAuthTokenProvider
 from botocore.exceptions import ClientError
+
+# Shared with the step-function handlers, packaged from terraform/step-function/lambda/code
+import s3_io
+import spill_buffer
+import stage_memory
+import stage_metrics
  
 # Set up logging
 logger = logging.getLogger()
@@ -15,6 +21,16 @@ logger.setLevel(logging.INFO)
  
 s3_client = boto3.client('s3')
  
+# Spill mode keeps records as serialized bytes on local disk (ephemeral storage up to 10GB)
+SPILL_DIR = os.environ.get('spill_dir', '/tmp')
+SPILL_MAX_BYTES = int(os.environ.get('spill_max_bytes', 10 * 1024 ** 3))
+ 
+def is_spill_enabled(event):
+    if 'spillToDisk' in event:
+        return bool(event['spillToDisk'])
+    return os.environ.get('spill_to_disk', 'false').lower() == 'true'
+ 
+ 
 class MSKTokenProvider():
     def token(self):
         try:
@@ -32,6 +48,13 @@ def lambda_handler(event, context):
     error_messages = []
     records_processed = 0
     records_failed = 0
+    send_time = 0
+    producer = None
+    records = []
+    # One EMF document per invocation, with the same dimensions and limits as the other stages
+    metrics = stage_metrics.StageMetrics.for_event('send-to-kafka', event)
+    # Peak RSS, buffer sizes and the memory budget, shared with the step-function stages
+    memory = stage_memory.MemoryGuard('send-to-kafka', context).start()
  
     try:
         # Validate input
@@ -59,13 +82,28 @@ def lambda_handler(event, context):
         # Read the file from S3
         try:
             response = s3_client.get_object(Bucket=event['Bucket'], Key=event['Key'])
-            json_data = response['Body'].read().decode('utf-8')
-            records = json.loads(json_data)
+            spill = is_spill_enabled(event)
+            file_size = response.get('ContentLength', 0)
+            # A file that would not fit in the memory budget once parsed is spilled even without spill_to_disk
+            if not spill and memory.would_exceed(file_size):
+                memory.note('spill', f"for a {file_size:,} byte file")
+                spill = True
+            if spill:
+                # Stream records to disk so only one record is held as Python objects at a time
+                records = spill_buffer.SpillBuffer(directory=SPILL_DIR, max_bytes=SPILL_MAX_BYTES)
+                for record in s3_io.iter_json_array(response['Body']):
+                    records.append(record)
+                logger.info(f"Spilled {len(records)} records ({records.size} bytes) to {records.path}")
+            else:
+                json_data = response['Body'].read().decode('utf-8')
+                memory.set_buffer('input', len(json_data))
+                records = json.loads(json_data)
+                del json_data
             logger.info(f"Successfully read {len(records)} records from S3")
- 
+  
         except ClientError as e:
             logger.error(f"Failed to read from S3: {str(e)}")
-            logger.info(f"METRIC|S3ReadFailure|1|{batch_id}")
+            metrics.increment('S3ReadFailure')
             return create_error(f"Failed to read from S3: {str(e)}")
  
         # Process records and send to Kafka
@@ -90,7 +128,9 @@ def lambda_handler(event, context):
                 )
  
                 # Wait for message to be delivered
+                send_start = time.time()
                 send_record.get(timeout=10)
+                send_time += time.time() - send_start
                 records_processed += 1
                 logger.info(f"Successfully processed record with gssId: {record['gssId']}")
  
@@ -104,18 +144,26 @@ def lambda_handler(event, context):
  
     except Exception as e:
         logger.error(f"Fatal error in lambda execution: {str(e)}")
-        logger.info(f"METRIC|LambdaExecutionFailure|1|{batch_id}")
+        metrics.increment('LambdaExecutionFailure')
         raise
  
     finally:
         # Publish metrics
         execution_time = time.time() - start_time
-        logger.info(f"METRIC|ProcessingTime|{execution_time}|{batch_id}")
-        logger.info(f"METRIC|RecordsProcessed|{records_processed}|{batch_id}")
-        logger.info(f"METRIC|RecordsFailed|{records_failed}|{batch_id}")
+        metrics.record('Duration', execution_time * 1000)
+        metrics.increment('RecordsOut', records_processed)
+        metrics.increment('RecordsFailed', records_failed)
+        if records_processed:
+            metrics.record('SendLatency', send_time / records_processed * 1000)
+        metrics.rate('Throughput', records_processed, execution_time)
+        memory.stop()
+        memory.record_metrics(metrics)
+        metrics.flush()
  
         if producer:
             producer.close()
+        if isinstance(records, spill_buffer.SpillBuffer):
+            records.close()
  
     # Final response based on success or failure of message production
     if error_messages:
@@ -123,13 +171,15 @@ def lambda_handler(event, context):
             "batchStatus": "SUBMISSION_FAILED",
             'batchId': batch_id,
             'customerId': customer_id,
-            'errors': error_messages
+            'errors': error_messages,
+            'memory': memory.get_report()
         }
  
     return {
         'status': 'SUCCESS',
         'batchId': batch_id,
-        'customerId': customer_id
+        'customerId': customer_id,
+        'memory': memory.get_report()
     }
  
 def create_error(error_message, batch_id="unknown", customer_id="unknown", tenant_id="unknown", records_failed=0, records_processed=0, error_messages=[]):
@@ -0,0 +1,342 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, List, Any, Optional
+
+from botocore.exceptions import ClientError
+
+# In-process stand-ins for the AWS and Kafka clients the handlers use, so each stage can
+# be benchmarked without network calls. S3 objects live on the local filesystem; SQS,
+# Lambda and Kafka sends are counted but not stored.
+
+# The expressions select_object_content understands: every record, or one top-level field
+SELECT_ALL = re.compile(r'^SELECT \* FROM S3OBJECT$', re.IGNORECASE)
+SELECT_FIELD = re.compile(r'^SELECT S\."?([^"]+)"? FROM S3OBJECT S$', re.IGNORECASE)
+
+def _client_error(code: str, operation: str, message: str = '') -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': message or code}}, operation)
+
+class LocalBody:
+    """The subset of botocore's StreamingBody the handlers read from"""
+
+    def __init__(self, path: str, offset: int = 0, length: Optional[int] = None):
+        self._file = open(path, 'rb')
+        self._file.seek(offset)
+        self._remaining = length if length is not None else os.path.getsize(path) - offset
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        if amt is None or amt > self._remaining:
+            amt = self._remaining
+        data = self._file.read(amt)
+        self._remaining -= len(data)
+        return data
+
+    def iter_chunks(self, chunk_size: int = 1024):
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+    def iter_lines(self, chunk_size: int = 1024, keepends: bool = False):
+        pending = b''
+        for data in self.iter_chunks(chunk_size):
+            lines = (pending + data).splitlines(True)
+            pending = lines.pop() if lines and not lines[-1].endswith(b'\n') else b''
+            for line in lines:
+                yield line if keepends else line.rstrip(b'\r\n')
+        if pending:
+            yield pending
+
+    def close(self):
+        self._file.close()
+
+class LocalS3:
+    """Filesystem-backed S3 client: s3://bucket/key is stored at root/bucket/key"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def _count(self, operation: str):
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+
+    def path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def _existing(self, bucket: str, key: str, operation: str) -> str:
+        path = self.path(bucket, key)
+        if not os.path.isfile(path):
+            raise _client_error('NoSuchKey' if operation == 'GetObject' else '404', operation)
+        return path
+
+    def _write(self, bucket: str, key: str, source, exclusive: bool = False):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if exclusive:
+            try:
+                with open(path, 'xb') as output:
+                    self._copy(source, output)
+            except FileExistsError:
+                raise _client_error('PreconditionFailed', 'PutObject')
+            return
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as output:
+            self._copy(source, output)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def _copy(source, output):
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            output.write(source)
+        else:
+            shutil.copyfileobj(source, output)
+
+    def open_for_write(self, bucket: str, key: str, mode: str = 'w'):
+        """Write an object directly, used to stage large benchmark inputs"""
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, mode)
+
+    def head_object(self, Bucket: str, Key: str, **kwargs) -> Dict[str, Any]:
+        self._count('HeadObject')
+        path = self._existing(Bucket, Key, 'HeadObject')
+        stat = os.stat(path)
+        etag = hashlib.md5(f"{Key}:{stat.st_mtime_ns}:{stat.st_size}".encode('utf-8')).hexdigest()
+        return {
+            'ContentLength': stat.st_size,
+            'ETag': f'"{etag}"',
+            'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+        }
+
+    def get_object(self, Bucket: str, Key: str, Range: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+        self._count('GetObject')
+        path = self._existing(Bucket, Key, 'GetObject')
+        size = os.path.getsize(path)
+        offset, length = 0, size
+        if Range:
+            first, last = Range.split('=', 1)[1].split('-')
+            offset = int(first)
+            length = min(int(last), size - 1) - offset + 1 if last else size - offset
+        return {'Body': LocalBody(path, offset, length), 'ContentLength': length}
+
+    def put_object(self, Bucket: str, Key: str, Body=b'', IfNoneMatch: Optional[str] = None, **kwargs):
+        self._count('PutObject')
+        self._write(Bucket, Key, Body, exclusive=IfNoneMatch == '*')
+        return {'ETag': '"local"'}
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str, ExtraArgs=None, Callback=None, Config=None):
+        self._count('UploadFile')
+        with open(Filename, 'rb') as source:
+            self._write(Bucket, Key, source)
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, ExtraArgs=None, Callback=None, Config=None):
+        self._count('UploadFileobj')
+        self._write(Bucket, Key, Fileobj)
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs):
+        self._count('DeleteObject')
+        try:
+            os.remove(self.path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+        return {}
+
+    def list_objects(self, bucket: str, prefix: str) -> List[Dict[str, Any]]:
+        base = os.path.join(self.root, bucket)
+        objects = []
+        for directory, _, files in os.walk(base):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, base).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    stat = os.stat(path)
+                    objects.append({'Key': key, 'Size': stat.st_size, 'ETag': '"local"',
+                                    'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)})
+        return sorted(objects, key=lambda obj: obj['Key'])
+
+    def get_paginator(self, operation_name: str):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(f"LocalS3 has no paginator for {operation_name}")
+        return LocalListPaginator(self)
+
+    def select_object_content(self, Bucket: str, Key: str, Expression: str, InputSerialization=None,
+                              OutputSerialization=None, **kwargs) -> Dict[str, Any]:
+        """SELECT * or SELECT s."field" over JSON LINES input: streams the records back in record events"""
+        self._count('SelectObjectContent')
+        expression = Expression.strip()
+        field_match = SELECT_FIELD.match(expression)
+        if not field_match and not SELECT_ALL.match(expression):
+            raise NotImplementedError(f"LocalS3 only supports SELECT * and SELECT s.field, got {Expression}")
+        path = self._existing(Bucket, Key, 'SelectObjectContent')
+        field = field_match.group(1) if field_match else None
+
+        def project(payload: bytes) -> bytes:
+            if field is None:
+                return payload
+            lines = []
+            for line in payload.splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = {}
+                projected = {field: record[field]} if isinstance(record, dict) and field in record else {}
+                lines.append(json.dumps(projected).encode('utf-8') + b'\n')
+            return b''.join(lines)
+
+        def events():
+            body = LocalBody(path)
+            pending = b''
+            try:
+                for data in body.iter_chunks(256 * 1024):
+                    data = pending + data
+                    cut = data.rfind(b'\n') + 1
+                    pending = data[cut:]
+                    if cut:
+                        yield {'Records': {'Payload': project(data[:cut])}}
+                if pending:
+                    yield {'Records': {'Payload': project(pending + b'\n')}}
+            finally:
+                body.close()
+            yield {'End': {}}
+
+        return {'Payload': events()}
+
+class LocalListPaginator:
+    def __init__(self, client: LocalS3):
+        self.client = client
+
+    def paginate(self, Bucket: str, Prefix: str = '', **kwargs):
+        self.client._count('ListObjectsV2')
+        objects = self.client.list_objects(Bucket, Prefix)
+        for start in range(0, max(len(objects), 1), 1000):
+            page = objects[start:start + 1000]
+            yield {'Contents': page, 'KeyCount': len(page)} if page else {'KeyCount': 0}
+
+class LocalSQS:
+    """Counts SQS messages and bytes without storing them"""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl: str, MessageBody: str, **kwargs) -> Dict[str, Any]:
+        with self._lock:
+            self.messages += 1
+            self.bytes += len(MessageBody)
+            return {'MessageId': f"local-{self.messages}"}
+
+    def send_message_batch(self, QueueUrl: str, Entries: List[Dict[str, Any]], **kwargs) -> Dict[str, Any]:
+        for entry in Entries:
+            self.send_message(QueueUrl, entry['MessageBody'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+class LocalLambda:
+    """Records asynchronous invocations (speculative attempts, self-continuations)"""
+
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, FunctionName: str, InvocationType: str = 'RequestResponse', Payload=b'', **kwargs):
+        self.invocations.append({'functionName': FunctionName, 'invocationType': InvocationType,
+                                 'payloadBytes': len(Payload)})
+        return {'StatusCode': 202 if InvocationType == 'Event' else 200}
+
+class LocalRecordMetadata:
+    def __init__(self, topic: str, partition: int, offset: int):
+        self.topic = topic
+        self.partition = partition
+        self.offset = offset
+
+class LocalFuture:
+    """Already-resolved stand-in for kafka-python's FutureRecordMetadata"""
+
+    def __init__(self, metadata: LocalRecordMetadata):
+        self.metadata = metadata
+
+    def add_callback(self, fn, *args, **kwargs):
+        fn(*args, self.metadata, **kwargs)
+        return self
+
+    def add_errback(self, fn, *args, **kwargs):
+        return self
+
+    def get(self, timeout: Optional[float] = None) -> LocalRecordMetadata:
+        return self.metadata
+
+    def succeeded(self) -> bool:
+        return True
+
+class LocalKafkaProducer:
+    """Serializes and partitions messages like KafkaProducer, then counts them.
+
+    send_latency_ms adds a per-message delay to approximate a broker round trip.
+    """
+
+    totals = {'messages': 0, 'bytes': 0}
+    _totals_lock = threading.Lock()
+
+    def __init__(self, partitions: int = 12, send_latency_ms: float = 0, **config):
+        self.partitions = partitions
+        self.send_latency = send_latency_ms / 1000
+        self.value_serializer = config.get('value_serializer')
+        self.key_serializer = config.get('key_serializer')
+        self._next_partition = 0
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def send(self, topic: str, value=None, key=None, headers=None, partition=None, timestamp_ms=None):
+        if self.value_serializer is not None:
+            value = self.value_serializer(value)
+        if self.key_serializer is not None and key is not None:
+            key = self.key_serializer(key)
+        if self.send_latency:
+            time.sleep(self.send_latency)
+        with self._lock:
+            if partition is None:
+                if key is not None:
+                    partition = zlib.crc32(key) % self.partitions
+                else:
+                    partition = self._next_partition
+                    self._next_partition = (self._next_partition + 1) % self.partitions
+            self._offset += 1
+            offset = self._offset
+        size = len(value or b'') + len(key or b'') + sum(len(name) + len(data) for name, data in headers or [])
+        with LocalKafkaProducer._totals_lock:
+            LocalKafkaProducer.totals['messages'] += 1
+            LocalKafkaProducer.totals['bytes'] += size
+        return LocalFuture(LocalRecordMetadata(topic, partition, offset))
+
+    def flush(self, timeout: Optional[float] = None):
+        pass
+
+    def close(self, timeout: Optional[float] = None):
+        pass
+
+class LocalContext:
+    """Lambda context with a fixed timeout, for handlers that watch their remaining time"""
+
+    def __init__(self, function_name: str, timeout_seconds: float = 900, memory_mb: int = 10240):
+        self.function_name = function_name
+        self.invoked_function_arn = f"arn:aws:lambda:local:000000000000:function:{function_name}"
+        self.memory_limit_in_mb = memory_mb
+        self.aws_request_id = 'local'
+        self._deadline = time.time() + timeout_seconds
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, int((self._deadline - time.time()) * 1000))
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""Offline per-stage benchmark for the batch processor Lambda handlers.
+
+Generates deterministic synthetic batch data, runs each handler in-process against
+filesystem-backed S3 and counting SQS/Kafka stand-ins, and reports records/sec,
+bytes/sec, peak RSS and invocation latency per stage. Every stage runs in a fresh
+process so its peak RSS is its own. Results are saved as JSON named after the git
+commit, and --compare prints the change against an earlier result file.
+
+    python run_benchmarks.py --records 200000 --chunk-size 20000
+    python run_benchmarks.py --compare results/20240101T120000-abc1234.json
+"""
+import argparse
+import concurrent.futures
+import importlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Any, Optional
+
+import synthetic_data
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+CODE_DIR = os.path.join(BENCHMARK_DIR, '..', 'lambda', 'code')
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+
+BUCKET = 'benchmark-bucket'
+BATCH_ID = 'benchmark-batch'
+CUSTOMER_ID = 'benchmark-customer'
+TENANT_ID = 'benchmark-tenant'
+INPUT_KEY = 'input/records.ndjson'
+
+# In run order; aggregate-results reads the stats written by the update-records stages
+STAGES = [
+    'initialize',
+    'validate',
+    'calculate-chunks',
+    'update-records',
+    'update-records-pipelined',
+    'update-records-spill',
+    'aggregate-results'
+]
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process (ru_maxrss is KB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def git_revision() -> Dict[str, Any]:
+    """Commit the benchmark ran against, and whether the tree had local changes"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--', '..'], cwd=BENCHMARK_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return {'commit': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': 'unknown', 'dirty': None}
+
+def prepare_dataset(store_root: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Write the NDJSON input file, the chunk files and a chunk plan into the local S3 store"""
+    from local_aws import LocalS3
+
+    s3 = LocalS3(store_root)
+    options = {'seed': config['seed'], 'shape': config['shape'],
+               'error_rate': config['error_rate'], 'padding': config['padding']}
+    started = time.perf_counter()
+
+    s3.open_for_write(BUCKET, INPUT_KEY).close()
+    input_file = synthetic_data.write_ndjson(s3.path(BUCKET, INPUT_KEY), config['records'], **options)
+    chunks = synthetic_data.write_chunks(
+        lambda chunk_id: s3.open_for_write(BUCKET, f"chunks/{BATCH_ID}/{chunk_id}.json"),
+        config['records'], config['chunk_size'], **options
+    )
+    manifest_key = f"metadata/{BATCH_ID}/benchmark-plan.jsonl"
+    with s3.open_for_write(BUCKET, manifest_key) as manifest:
+        for chunk in chunks:
+            manifest.write(json.dumps({key: chunk[key] for key in ('chunkId', 'startIndex', 'endIndex', 'chunkSize')}) + '\n')
+
+    return {
+        'inputBytes': input_file['bytes'],
+        'injectedErrors': input_file['errors'],
+        'chunks': chunks,
+        'manifestKey': manifest_key,
+        'generationSeconds': time.perf_counter() - started
+    }
+
+def install_local_clients(store_root: str) -> Dict[str, Any]:
+    """Point the shared client factory at the local stand-ins before any handler is imported"""
+    from local_aws import LocalS3, LocalSQS, LocalLambda
+
+    sys.path.insert(0, CODE_DIR)
+    import s3_io
+
+    clients = {'s3': LocalS3(store_root), 'sqs': LocalSQS(), 'lambda': LocalLambda()}
+    s3_io._clients.update(clients)
+    return clients
+
+def load_handler(name: str):
+    return importlib.import_module(f"scm-batch-processor-{name}")
+
+def invoke(handler, event: Dict[str, Any], context=None) -> Dict[str, Any]:
+    started = time.perf_counter()
+    response = handler(event, context)
+    return {'seconds': time.perf_counter() - started, 'response': response}
+
+def run_initialize(config, dataset, clients) -> List[Dict[str, Any]]:
+    module = load_handler('read-s3')
+    event = {'bucket': BUCKET, 'file': INPUT_KEY, 'customerId': CUSTOMER_ID,
+             'tenantId': TENANT_ID, 'batchId': BATCH_ID}
+    invocation = invoke(module.lambda_handler, event)
+    invocation.update(ok=invocation['response'].get('batchStatus') != 'SUBMISSION_FAILED', records=0, bytes=0)
+    return [invocation]
+
+def run_validate(config, dataset, clients) -> List[Dict[str, Any]]:
+    module = load_handler('validate-data')
+    event = {'bucket': BUCKET, 'file': INPUT_KEY, 'customerId': CUSTOMER_ID,
+             'tenantId': TENANT_ID, 'batchId': BATCH_ID}
+    invocation = invoke(module.lambda_handler, event)
+    body = invocation['response'].get('body', {})
+    invocation.update(
+        ok=invocation['response'].get('statusCode') == 200,
+        records=body.get('validationResults', {}).get('recordsProcessed', 0),
+        bytes=dataset['inputBytes']
+    )
+    return [invocation]
+
+def run_calculate_chunks(config, dataset, clients) -> List[Dict[str, Any]]:
+    module = load_handler('calculate-chunks')
+    event = {'bucket': BUCKET, 'file': INPUT_KEY, 'customerId': CUSTOMER_ID, 'tenantId': TENANT_ID,
+             'batchId': BATCH_ID, 'targetTotalRecords': config['records'], 'maxChunkSize': config['chunk_size']}
+    invocation = invoke(module.lambda_handler, event)
+    invocation.update(ok=invocation['response'].get('batchStatus') == 'CHUNKS_CALCULATED', records=0, bytes=0)
+    return [invocation]
+
+def run_update_records(config, dataset, clients, pipelined: bool = False, spill: bool = False) -> List[Dict[str, Any]]:
+    module = load_handler('update-records')
+    from local_aws import LocalContext, LocalKafkaProducer
+
+    module.create_kafka_producer = lambda brokers: LocalKafkaProducer(
+        partitions=config['kafka_partitions'], send_latency_ms=config['kafka_send_latency_ms'],
+        value_serializer=lambda v: v if isinstance(v, bytes) else json.dumps(v).encode('utf-8')
+    )
+    invocations = []
+    for chunk in dataset['chunks']:
+        event = {'chunkId': chunk['chunkId'], 'startIndex': chunk['startIndex'], 'endIndex': chunk['endIndex'],
+                 'bucket': BUCKET, 'file': INPUT_KEY, 'customerId': CUSTOMER_ID, 'tenantId': TENANT_ID,
+                 'batchId': BATCH_ID, 'destination': config['destination'],
+                 'pipelined': pipelined, 'spillToDisk': spill}
+        # A chunk that runs out of its Lambda timeout continues in further invocations
+        while True:
+            context = LocalContext('scm-batch-processor-update-records', config['lambda_timeout'])
+            invocation = invoke(module.lambda_handler, event, context)
+            response = invocation['response']
+            if response.get('status') != 'CONTINUE':
+                break
+            invocation.update(ok=True, records=0, bytes=0)
+            invocations.append(invocation)
+            event = response
+        invocation.update(ok=response.get('status') == 'SUCCESS',
+                          records=response.get('recordsAttempted', 0), bytes=chunk['bytes'])
+        invocations.append(invocation)
+    return invocations
+
+def run_aggregate_results(config, dataset, clients) -> List[Dict[str, Any]]:
+    module = load_handler('aggregate-results')
+    s3 = clients['s3']
+    if not s3.list_objects(BUCKET, f"stats/{BATCH_ID}/"):
+        raise RuntimeError("aggregate-results needs chunk stats, run an update-records stage first")
+    result_bytes = sum(obj['Size'] for obj in s3.list_objects(BUCKET, f"results/{BATCH_ID}/"))
+    event = {'bucket': BUCKET, 'batchId': BATCH_ID, 'customerId': CUSTOMER_ID, 'tenantId': TENANT_ID,
+             'deployment': 'WORKSPACE', 'chunkManifest': {'bucket': BUCKET, 'key': dataset['manifestKey']}}
+    invocation = invoke(module.lambda_handler, event)
+    invocation.update(ok=invocation['response'].get('batchStatus') == 'COMPLETED',
+                      records=invocation['response'].get('totalRecordsProcessed', 0), bytes=result_bytes)
+    return [invocation]
+
+STAGE_HANDLERS = {
+    'initialize': 'read-s3',
+    'validate': 'validate-data',
+    'calculate-chunks': 'calculate-chunks',
+    'update-records': 'update-records',
+    'update-records-pipelined': 'update-records',
+    'update-records-spill': 'update-records',
+    'aggregate-results': 'aggregate-results'
+}
+
+STAGE_RUNNERS = {
+    'initialize': run_initialize,
+    'validate': run_validate,
+    'calculate-chunks': run_calculate_chunks,
+    'update-records': run_update_records,
+    'update-records-pipelined': lambda *args: run_update_records(*args, pipelined=True),
+    'update-records-spill': lambda *args: run_update_records(*args, spill=True),
+    'aggregate-results': run_aggregate_results
+}
+
+def summarize_stage(invocations: List[Dict[str, Any]], baseline_rss_mb: float) -> Dict[str, Any]:
+    """Throughput, latency percentiles and memory for one stage"""
+    latencies = [invocation['seconds'] * 1000 for invocation in invocations]
+    seconds = sum(invocation['seconds'] for invocation in invocations)
+    records = sum(invocation['records'] for invocation in invocations)
+    total_bytes = sum(invocation['bytes'] for invocation in invocations)
+    return {
+        'invocations': len(invocations),
+        'failures': sum(1 for invocation in invocations if not invocation['ok']),
+        'records': records,
+        'bytes': total_bytes,
+        'seconds': seconds,
+        'recordsPerSecond': records / seconds if seconds > 0 else 0,
+        'bytesPerSecond': total_bytes / seconds if seconds > 0 else 0,
+        'latencyP50Ms': percentile(latencies, 50),
+        'latencyP99Ms': percentile(latencies, 99),
+        'latencyMaxMs': max(latencies) if latencies else 0,
+        'baselineRssMb': baseline_rss_mb,
+        'peakRssMb': peak_rss_mb()
+    }
+
+def run_stage(stage: str, store_root: str, config: Dict[str, Any], dataset: Dict[str, Any]) -> Dict[str, Any]:
+    """Run one stage in this (fresh) process, repeated config['repeat'] times"""
+    os.environ.setdefault('SPILL_DIR', os.path.join(os.path.dirname(store_root), 'spill'))
+    os.makedirs(os.environ['SPILL_DIR'], exist_ok=True)
+    os.environ.setdefault('KAFKA_BROKERS', 'localhost:9092')
+    os.environ.setdefault('SQS_CORE_QUEUE', 'https://sqs.local/000000000000/benchmark')
+    # EMF lines would interleave with the report; the handlers still build their metrics
+    os.environ.setdefault('METRICS_ENABLED', 'false')
+    if config['profile']:
+        # Read by stage_profiler when the handler is imported below
+        os.environ['PROFILE_SAMPLE_RATE'] = '1'
+    clients = install_local_clients(store_root)
+
+    # Import the handler before taking the baseline so module set-up is not counted as stage
+    # memory; handlers set the root logger to INFO on import, so the level is applied after
+    load_handler(STAGE_HANDLERS[stage])
+    logging.getLogger().setLevel(config['log_level'])
+    baseline = peak_rss_mb()
+
+    invocations = []
+    for _ in range(config['repeat']):
+        invocations.extend(STAGE_RUNNERS[stage](config, dataset, clients))
+
+    summary = summarize_stage(invocations, baseline)
+    failed = [invocation['response'] for invocation in invocations if not invocation['ok']]
+    if failed:
+        summary['firstFailure'] = json.loads(json.dumps(failed[0], default=str))
+    summary['s3Requests'] = dict(clients['s3'].requests)
+    return summary
+
+def compare_results(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Per-stage change in throughput, latency and memory against an earlier result file"""
+    lines = [f"Compared with {baseline['revision']['commit']} ({baseline['createdAt']}):"]
+    differing = sorted(key for key in current['config'] if current['config'][key] != baseline['config'].get(key))
+    if differing:
+        lines.append(f"  warning: run configuration differs ({', '.join(differing)}), numbers are not like for like")
+    metrics = [('recordsPerSecond', 'rec/s', True), ('latencyP50Ms', 'p50 ms', False),
+               ('latencyP99Ms', 'p99 ms', False), ('peakRssMb', 'peak MB', False)]
+    for stage, summary in current['stages'].items():
+        before = baseline['stages'].get(stage)
+        if before is None:
+            lines.append(f"  {stage:<26} (not in baseline)")
+            continue
+        changes = []
+        for metric, label, higher_is_better in metrics:
+            old, new = before.get(metric, 0), summary.get(metric, 0)
+            if not old:
+                continue
+            change = (new - old) / old * 100
+            better = change > 0 if higher_is_better else change < 0
+            changes.append(f"{label} {old:,.1f} -> {new:,.1f} ({change:+.1f}%{'' if abs(change) < 1 else ' better' if better else ' worse'})")
+        lines.append(f"  {stage:<26} " + ', '.join(changes))
+    return lines
+
+def format_table(result: Dict[str, Any]) -> List[str]:
+    header = f"{'stage':<26} {'invocations':>11} {'records/s':>12} {'MB/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'peak MB':>9} {'failures':>8}"
+    lines = [header, '-' * len(header)]
+    for stage, summary in result['stages'].items():
+        lines.append(
+            f"{stage:<26} {summary['invocations']:>11} {summary['recordsPerSecond']:>12,.0f} "
+            f"{summary['bytesPerSecond'] / 1024 ** 2:>9.2f} {summary['latencyP50Ms']:>9.1f} "
+            f"{summary['latencyP99Ms']:>9.1f} {summary['peakRssMb']:>9.1f} {summary['failures']:>8}"
+        )
+    return lines
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark the batch processor stages offline')
+    parser.add_argument('--records', type=int, default=100000, help='records in the synthetic batch')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='records per chunk file')
+    parser.add_argument('--shape', choices=synthetic_data.SHAPES, default='flat', help='record shape')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='fraction of invalid records')
+    parser.add_argument('--padding', type=int, default=0, help='extra bytes of text per record')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated stages to run')
+    parser.add_argument('--repeat', type=int, default=3, help='times each stage is run')
+    parser.add_argument('--destination', choices=['kafka', 'sqs_core'], default='kafka')
+    parser.add_argument('--kafka-partitions', type=int, default=12)
+    parser.add_argument('--kafka-send-latency-ms', type=float, default=0,
+                        help='simulated per-message broker latency')
+    parser.add_argument('--lambda-timeout', type=float, default=900, help='seconds each chunk invocation may run')
+    parser.add_argument('--work-dir', help='where the local S3 store is written (default: a temp dir)')
+    parser.add_argument('--keep', action='store_true', help='keep the work dir after the run')
+    parser.add_argument('--output-dir', default=RESULTS_DIR)
+    parser.add_argument('--compare', help='earlier result file to compare against')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--profile', action='store_true',
+                        help='sample stacks of every invocation into profiles/ in the work dir (use with --keep)')
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    stages = [stage for stage in args.stages.split(',') if stage]
+    unknown = [stage for stage in stages if stage not in STAGE_RUNNERS]
+    if unknown:
+        print(f"Unknown stages: {', '.join(unknown)} (choose from {', '.join(STAGES)})", file=sys.stderr)
+        return 2
+    stages = [stage for stage in STAGES if stage in stages]
+    config = {
+        'records': args.records, 'chunk_size': args.chunk_size, 'shape': args.shape,
+        'error_rate': args.error_rate, 'padding': args.padding, 'seed': args.seed,
+        'repeat': args.repeat, 'destination': args.destination,
+        'kafka_partitions': args.kafka_partitions, 'kafka_send_latency_ms': args.kafka_send_latency_ms,
+        'lambda_timeout': args.lambda_timeout, 'log_level': args.log_level.upper(),
+        'profile': args.profile
+    }
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='batch-benchmark-')
+    store_root = os.path.join(work_dir, 's3')
+    try:
+        print(f"Generating {args.records:,} {args.shape} records ({args.error_rate:.1%} invalid) in {work_dir}")
+        dataset = prepare_dataset(store_root, config)
+        print(f"Input {dataset['inputBytes'] / 1024 ** 2:,.1f} MB in {len(dataset['chunks'])} chunks, "
+              f"generated in {dataset['generationSeconds']:.1f}s")
+
+        result = {
+            'createdAt': datetime.now().isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpuCount': os.cpu_count(),
+            'config': config,
+            'dataset': {key: dataset[key] for key in ('inputBytes', 'injectedErrors')},
+            'stages': {}
+        }
+        # spawn gives every stage a fresh interpreter, so peak RSS and module state are per stage
+        context = multiprocessing.get_context('spawn')
+        for stage in stages:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result['stages'][stage] = executor.submit(run_stage, stage, store_root, config, dataset).result()
+            summary = result['stages'][stage]
+            print(f"  {stage}: {summary['recordsPerSecond']:,.0f} records/s, p99 {summary['latencyP99Ms']:,.1f}ms"
+                  + (f", {summary['failures']} failed invocations" if summary['failures'] else ''))
+    finally:
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print()
+    print('\n'.join(format_table(result)))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(
+        args.output_dir,
+        f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{result['revision']['commit']}"
+        f"{'-dirty' if result['revision']['dirty'] else ''}.json"
+    )
+    with open(output_path, 'w') as output:
+        json.dump(result, output, indent=2)
+    print(f"\nSaved {output_path}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            print('\n'.join(compare_results(result, json.load(baseline_file))))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
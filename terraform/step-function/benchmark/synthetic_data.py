@@ -0,0 +1,114 @@
+import json
+import random
+from datetime import datetime, timedelta
+from typing import Dict, List, Any, Iterator, Optional, Tuple
+
+# Deterministic synthetic batch data for the benchmark harness. The same seed, size,
+# shape and error rate always produce byte-identical files, so runs on different
+# commits measure the same input.
+
+SHAPES = ('flat', 'wide', 'nested')
+ERROR_KINDS = ('missing_field', 'bad_email', 'bad_status', 'malformed_json', 'null_record')
+VALID_STATUSES = ('active', 'inactive', 'pending', 'suspended', 'deleted')
+BASE_TIME = datetime(2024, 1, 1)
+WORDS = ('alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet')
+
+def _timestamp(rng: random.Random) -> str:
+    return (BASE_TIME + timedelta(seconds=rng.randrange(365 * 24 * 3600))).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def _uuid(rng: random.Random) -> str:
+    value = f"{rng.getrandbits(128):032x}"
+    return f"{value[:8]}-{value[8:12]}-{value[12:16]}-{value[16:20]}-{value[20:]}"
+
+def make_record(index: int, rng: random.Random, shape: str = 'flat', padding: int = 0) -> Dict[str, Any]:
+    """One valid record that passes the validate-data checks"""
+    name = f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()}"
+    record = {
+        'id': index,
+        'gssId': _uuid(rng),
+        'name': name,
+        'email': f"{name.replace(' ', '.').lower()}{index}@example.com",
+        'status': rng.choice(VALID_STATUSES),
+        'createdAt': _timestamp(rng),
+        'updatedAt': _timestamp(rng)
+    }
+    if shape == 'wide':
+        for i in range(30):
+            record[f"attr_{i:02d}"] = rng.choice(WORDS) if i % 2 else rng.randrange(1000000)
+    elif shape == 'nested':
+        record['address'] = {
+            'street': f"{rng.randrange(1, 999)} {rng.choice(WORDS).title()} Street",
+            'city': rng.choice(WORDS).title(),
+            'geo': {'lat': round(rng.uniform(-90, 90), 6), 'lon': round(rng.uniform(-180, 180), 6)}
+        }
+        record['tags'] = [rng.choice(WORDS) for _ in range(rng.randrange(1, 6))]
+        record['metrics'] = {word: rng.randrange(10000) for word in rng.sample(WORDS, 4)}
+    if padding:
+        record['notes'] = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz ') for _ in range(padding))
+    return record
+
+def corrupt_record(record: Dict[str, Any], kind: str, rng: random.Random) -> Optional[Any]:
+    """Apply one kind of data error; malformed JSON is returned as a raw string"""
+    if kind == 'missing_field':
+        record.pop(rng.choice(['name', 'email', 'status', 'createdAt', 'updatedAt']))
+        return record
+    if kind == 'bad_email':
+        record['email'] = record['email'].replace('@', ' at ')
+        return record
+    if kind == 'bad_status':
+        record['status'] = 'unknown'
+        return record
+    if kind == 'malformed_json':
+        return json.dumps(record)[:-1]
+    return None
+
+def iter_records(count: int, seed: int = 42, shape: str = 'flat', error_rate: float = 0.0,
+                 padding: int = 0) -> Iterator[Tuple[Optional[Any], Optional[str]]]:
+    """Yield (record, error kind) pairs; the error kind is None for valid records"""
+    if shape not in SHAPES:
+        raise ValueError(f"Unknown record shape: {shape}")
+    rng = random.Random(seed)
+    for index in range(count):
+        record = make_record(index, rng, shape, padding)
+        if error_rate and rng.random() < error_rate:
+            kind = rng.choice(ERROR_KINDS)
+            yield corrupt_record(record, kind, rng), kind
+        else:
+            yield record, None
+
+def write_ndjson(path: str, count: int, **options) -> Dict[str, Any]:
+    """Write the batch input file as NDJSON and return its size and error counts"""
+    errors = {}
+    size = 0
+    with open(path, 'w') as output:
+        for record, kind in iter_records(count, **options):
+            line = record if isinstance(record, str) else json.dumps(record)
+            output.write(line + '\n')
+            size += len(line) + 1
+            if kind:
+                errors[kind] = errors.get(kind, 0) + 1
+    return {'records': count, 'bytes': size, 'errors': errors}
+
+def write_chunks(open_chunk, count: int, chunk_size: int, **options) -> List[Dict[str, Any]]:
+    """Write the same records as chunk JSON arrays, as the chunk workers read them.
+
+    open_chunk(chunk_id) returns a writable text file. Malformed lines cannot exist inside
+    a JSON array, so they become string records, which fail the transform like bad input.
+    """
+    chunks = []
+    records = iter_records(count, **options)
+    for start in range(0, count, chunk_size):
+        end = min(start + chunk_size, count) - 1
+        chunk_id = f"chunk_{len(chunks):06d}"
+        size = 0
+        with open_chunk(chunk_id) as output:
+            output.write('[')
+            for i in range(start, end + 1):
+                record, _ = next(records)
+                data = json.dumps(record)
+                output.write(data if i == start else ',' + data)
+                size += len(data) + 1
+            output.write(']')
+        chunks.append({'chunkId': chunk_id, 'startIndex': start, 'endIndex': end,
+                       'chunkSize': end - start + 1, 'bytes': size + 1})
+    return chunks
@@ -0,0 +1,410 @@
+import io
+import os
+import json
+import math
+import codecs
+import logging
+import threading
+import time
+import concurrent.futures
+from collections import defaultdict, deque
+from typing import Dict, Any, Optional, Iterator, Union
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Shared AWS client factory and S3 transfer helpers used by every batch processing stage.
+# Clients are created once per process with a tuned configuration and reused across
+# invocations and threads (boto3 clients are thread-safe).
+
+logger = logging.getLogger()
+
+# Transfer tuning
+S3_IO_THREADS = int(os.environ.get('S3_IO_THREADS', 16))
+S3_MULTIPART_THRESHOLD = int(os.environ.get('S3_MULTIPART_THRESHOLD', 16 * 1024 * 1024))
+S3_MULTIPART_CHUNK_SIZE = int(os.environ.get('S3_MULTIPART_CHUNK_SIZE', 16 * 1024 * 1024))
+
+# Client tuning; the pool leaves headroom over the transfer threads for the stage's own threads
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', S3_IO_THREADS + 16))
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', 10))
+AWS_CONNECT_TIMEOUT = int(os.environ.get('AWS_CONNECT_TIMEOUT', 5))
+AWS_READ_TIMEOUT = int(os.environ.get('AWS_READ_TIMEOUT', 60))
+
+# Hedged range reads: a duplicate GET is sent when a read outlives the running latency percentile
+S3_HEDGE_READS = os.environ.get('S3_HEDGE_READS', 'true').lower() == 'true'
+S3_HEDGE_PERCENTILE = float(os.environ.get('S3_HEDGE_PERCENTILE', 95))
+S3_HEDGE_WINDOW = int(os.environ.get('S3_HEDGE_WINDOW', 200))
+S3_HEDGE_MIN_SAMPLES = int(os.environ.get('S3_HEDGE_MIN_SAMPLES', 20))
+S3_HEDGE_MIN_DELAY_MS = float(os.environ.get('S3_HEDGE_MIN_DELAY_MS', 50))
+S3_HEDGE_MAX_RATIO = float(os.environ.get('S3_HEDGE_MAX_RATIO', 0.05))
+# Reads are grouped into size classes growing 4x from 64KB; each class keeps its own latency window,
+# so a 64KB sample is never judged against the p95 of 16MB parts or the other way round
+HEDGE_SIZE_CLASS_MIN = 64 * 1024
+HEDGE_SIZE_CLASS_FACTOR = 4
+
+# Record count estimates from the newline density of ranged samples spread across an object
+RECORD_ESTIMATE_SAMPLES = int(os.environ.get('RECORD_ESTIMATE_SAMPLES', 16))
+RECORD_ESTIMATE_SAMPLE_BYTES = int(os.environ.get('RECORD_ESTIMATE_SAMPLE_BYTES', 64 * 1024))
+RECORD_ESTIMATE_Z = 1.96  # two-sided 95% error bound
+
+_clients = {}
+_clients_lock = threading.Lock()
+_hedge_executor = None
+
+def get_client_config() -> Config:
+    """Tuned botocore configuration: sized pool, adaptive retries, keepalive and timeouts"""
+    return Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        retries={'mode': 'adaptive', 'max_attempts': AWS_MAX_ATTEMPTS},
+        tcp_keepalive=True,
+        connect_timeout=AWS_CONNECT_TIMEOUT,
+        read_timeout=AWS_READ_TIMEOUT
+    )
+
+def get_client(service_name: str):
+    """Return the process-wide client for a service, creating it on first use"""
+    client = _clients.get(service_name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(service_name)
+            if client is None:
+                client = boto3.client(service_name, config=get_client_config())
+                _clients[service_name] = client
+    return client
+
+def get_transfer_config() -> TransferConfig:
+    """Multipart transfer settings shared by uploads and downloads"""
+    return TransferConfig(
+        multipart_threshold=S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=S3_MULTIPART_CHUNK_SIZE,
+        max_concurrency=S3_IO_THREADS,
+        use_threads=True
+    )
+
+def hedge_size_class(length: int) -> int:
+    """Upper bound in bytes of the size class a read of length bytes falls in"""
+    bound = HEDGE_SIZE_CLASS_MIN
+    while bound < length:
+        bound *= HEDGE_SIZE_CLASS_FACTOR
+    return bound
+
+class HedgePolicy:
+    """Tracks recent range read latencies per read size class and budgets duplicate requests for the slow tail.
+
+    The hedge budget is shared by all size classes.
+    """
+    
+    def __init__(self, percentile: float = S3_HEDGE_PERCENTILE, window: int = S3_HEDGE_WINDOW,
+                 min_samples: int = S3_HEDGE_MIN_SAMPLES, min_delay_ms: float = S3_HEDGE_MIN_DELAY_MS,
+                 max_ratio: float = S3_HEDGE_MAX_RATIO):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay_ms / 1000
+        self.max_ratio = max_ratio
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """Reset the counters, keeping the latency window"""
+        with self.lock:
+            self.requests = 0
+            self.fired = 0
+            self.won = 0
+    
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+    
+    def record_latency(self, latency: float, length: int):
+        with self.lock:
+            self.latencies[hedge_size_class(length)].append(latency)
+    
+    def record_win(self):
+        with self.lock:
+            self.won += 1
+    
+    def threshold(self, length: int) -> Optional[float]:
+        """Seconds to wait before hedging a read of length bytes, or None while its size class has too few samples"""
+        with self.lock:
+            latencies = self.latencies.get(hedge_size_class(length), ())
+            if len(latencies) < self.min_samples:
+                return None
+            ordered = sorted(latencies)
+        position = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(ordered[position], self.min_delay)
+    
+    def try_hedge(self) -> bool:
+        """Claim a hedge if extra requests stay within max_ratio of all requests"""
+        with self.lock:
+            if self.fired + 1 > self.requests * self.max_ratio:
+                return False
+            self.fired += 1
+            return True
+    
+    def get_statistics(self) -> Dict[str, Any]:
+        with self.lock:
+            size_classes = sorted(self.latencies)
+        thresholds = {size_class: self.threshold(size_class) for size_class in size_classes}
+        with self.lock:
+            return {
+                'enabled': S3_HEDGE_READS,
+                'requests': self.requests,
+                'hedgesFired': self.fired,
+                'hedgesWon': self.won,
+                'hedgeRate': (self.fired / self.requests * 100) if self.requests else 0,
+                'winRate': (self.won / self.fired * 100) if self.fired else 0,
+                # Keyed by the upper bound in bytes of each read size class
+                'thresholdMs': {str(size_class): threshold * 1000
+                                for size_class, threshold in thresholds.items() if threshold is not None}
+            }
+
+hedge_policy = HedgePolicy()
+
+def get_hedge_stats() -> Dict[str, Any]:
+    """Hedged read counters since the last reset"""
+    return hedge_policy.get_statistics()
+
+def reset_hedge_stats():
+    """Start a new counting period, e.g. per invocation in a warm container"""
+    hedge_policy.reset()
+
+def _get_hedge_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _clients_lock:
+            if _hedge_executor is None:
+                _hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=AWS_MAX_POOL_CONNECTIONS, thread_name_prefix='s3-read'
+                )
+    return _hedge_executor
+
+def _timed_get_range(bucket: str, key: str, offset: int, length: int) -> bytes:
+    start = time.time()
+    response = get_client('s3').get_object(Bucket=bucket, Key=key, Range=f"bytes={offset}-{offset + length - 1}")
+    data = response['Body'].read()
+    hedge_policy.record_latency(time.time() - start, length)
+    return data
+
+def read_range(bucket: str, key: str, offset: int, length: int) -> bytes:
+    """Read length bytes of an object starting at offset.
+
+    Once enough latencies are known, a read still running after the percentile
+    threshold gets a duplicate request and the first successful response wins.
+    """
+    if not S3_HEDGE_READS:
+        return _timed_get_range(bucket, key, offset, length)
+    
+    hedge_policy.record_request()
+    threshold = hedge_policy.threshold(length)
+    if threshold is None:
+        return _timed_get_range(bucket, key, offset, length)
+    
+    executor = _get_hedge_executor()
+    primary = executor.submit(_timed_get_range, bucket, key, offset, length)
+    done, _ = concurrent.futures.wait([primary], timeout=threshold)
+    if done or not hedge_policy.try_hedge():
+        return primary.result()
+    
+    hedge = executor.submit(_timed_get_range, bucket, key, offset, length)
+    pending = {primary, hedge}
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    hedge_policy.record_win()
+                return future.result()
+    # Both requests failed, surface the original error
+    return primary.result()
+
+def download_bytes(bucket: str, key: str, size: Optional[int] = None, offset: int = 0) -> Union[bytes, bytearray]:
+    """Download an object from offset on, using concurrent ranged GETs above the multipart threshold.
+
+    Above the threshold the parts are written into one bytearray, which is returned as-is
+    rather than copied into bytes, so the download is held in memory only once.
+    """
+    s3 = get_client('s3')
+    if size is None:
+        size = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+    length = max(0, size - offset)
+
+    if length <= S3_MULTIPART_THRESHOLD:
+        return read_range(bucket, key, offset, length) if length else b''
+
+    buffer = bytearray(length)
+
+    def fetch(position: int):
+        part = min(S3_MULTIPART_CHUNK_SIZE, length - position)
+        buffer[position:position + part] = read_range(bucket, key, offset + position, part)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=S3_IO_THREADS) as executor:
+        for future in [executor.submit(fetch, position) for position in range(0, length, S3_MULTIPART_CHUNK_SIZE)]:
+            future.result()
+
+    logger.info(f"Downloaded s3://{bucket}/{key} ({length:,} bytes from offset {offset:,}) with ranged GETs")
+    return buffer
+
+def estimate_line_count(bucket: str, key: str, size: int, samples: int = RECORD_ESTIMATE_SAMPLES,
+                        sample_bytes: int = RECORD_ESTIMATE_SAMPLE_BYTES) -> Dict[str, Any]:
+    """Estimate the line count of a newline-delimited object from a few ranged samples.
+
+    Objects up to samples * sample_bytes are read whole and counted exactly. Larger ones are
+    sampled at evenly spaced offsets from the first to the last byte; errorBound is a ~95%
+    bound from the spread of the sample densities and the few lines each sample holds.
+    """
+    samples = max(2, samples)
+    if size <= samples * sample_bytes:
+        data = read_range(bucket, key, 0, size) if size else b''
+        lines = data.count(b'\n') + (1 if data and not data.endswith(b'\n') else 0)
+        return {'records': lines, 'errorBound': 0, 'bytesPerRecord': size / lines if lines else None,
+                'method': 'exact', 'samples': 1, 'sampledBytes': size}
+
+    step = (size - sample_bytes) / (samples - 1)
+    offsets = [int(index * step) for index in range(samples)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(samples, S3_IO_THREADS)) as executor:
+        counts = list(executor.map(lambda offset: read_range(bucket, key, offset, sample_bytes).count(b'\n'), offsets))
+
+    densities = [count / sample_bytes for count in counts]
+    mean = sum(densities) / samples
+    variance = sum((density - mean) ** 2 for density in densities) / (samples - 1)
+    standard_error = math.sqrt(variance / samples + mean / (samples * sample_bytes))
+    estimate = {
+        'records': round(mean * size),
+        'errorBound': math.ceil(RECORD_ESTIMATE_Z * standard_error * size),
+        'bytesPerRecord': 1 / mean if mean else None,
+        'method': 'sampled',
+        'samples': samples,
+        'sampledBytes': samples * sample_bytes
+    }
+    logger.info(f"Estimated {estimate['records']:,} ± {estimate['errorBound']:,} lines in s3://{bucket}/{key} "
+                f"from {samples} samples")
+    return estimate
+
+def upload_bytes(bucket: str, key: str, data: bytes, extra_args: Optional[Dict[str, Any]] = None):
+    """Upload bytes, switching to a concurrent multipart upload for large bodies"""
+    extra_args = extra_args or {}
+    if len(data) <= S3_MULTIPART_THRESHOLD:
+        get_client('s3').put_object(Bucket=bucket, Key=key, Body=data, **extra_args)
+    else:
+        get_client('s3').upload_fileobj(io.BytesIO(data), bucket, key,
+                                        ExtraArgs=extra_args, Config=get_transfer_config())
+
+def upload_file(path: str, bucket: str, key: str, extra_args: Optional[Dict[str, Any]] = None):
+    """Upload a local file with concurrent multipart parts"""
+    get_client('s3').upload_file(path, bucket, key, ExtraArgs=extra_args or {}, Config=get_transfer_config())
+
+def put_if_absent(bucket: str, key: str, data: bytes, extra_args: Optional[Dict[str, Any]] = None) -> bool:
+    """Create an object only if the key does not exist yet (S3 conditional write).
+
+    Returns False when another writer created the key first.
+    """
+    attempts = 3
+    for attempt in range(attempts):
+        try:
+            get_client('s3').put_object(Bucket=bucket, Key=key, Body=data, IfNoneMatch='*', **(extra_args or {}))
+            return True
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code == 'PreconditionFailed':
+                return False
+            # A concurrent conditional write to the same key is still in flight, ask again
+            if code != 'ConditionalRequestConflict' or attempt == attempts - 1:
+                raise
+            time.sleep(0.1 * (attempt + 1))
+
+def get_json(bucket: str, key: str) -> Optional[Any]:
+    """Read a small JSON object, or None if it does not exist"""
+    try:
+        response = get_client('s3').get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+class JsonArrayStream:
+    """Incrementally parses a JSON array from an S3 streaming body, one element at a time.
+
+    offset is the byte offset in the object where the next element (or the comma before it)
+    starts, so a reader can stop between elements and later resume from that byte with a
+    ranged GET. A body that starts at such an offset is read with resume=True.
+    """
+
+    def __init__(self, body, chunk_size: int = 1024 * 1024, offset: int = 0, resume: bool = False):
+        self._body = body
+        self._chunk_size = chunk_size
+        self._consumed = offset
+        self._buffer = ''
+        self._pos = 0
+        self._started = resume
+        self._elements = self._parse()
+
+    @property
+    def offset(self) -> int:
+        return self._consumed + len(self._buffer[:self._pos].encode('utf-8'))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Any:
+        return next(self._elements)
+
+    def _parse(self) -> Iterator[Any]:
+        decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+        finished = False
+
+        if isinstance(self._body, (bytes, bytearray, memoryview)):
+            data = memoryview(self._body)
+            raw_chunks = (data[position:position + self._chunk_size] for position in range(0, len(data), self._chunk_size))
+        else:
+            raw_chunks = self._body.iter_chunks(self._chunk_size)
+
+        for raw_chunk in raw_chunks:
+            buffer = self._buffer + text_decoder.decode(raw_chunk)
+            self._buffer = buffer
+            pos = 0
+            while not finished:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos >= len(buffer):
+                    break
+                if not self._started:
+                    if buffer[pos] != '[':
+                        raise ValueError("Object must be a JSON array")
+                    self._started = True
+                    pos += 1
+                    continue
+                if buffer[pos] == ']':
+                    finished = True
+                    break
+                try:
+                    element, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    break  # Element continues in the next chunk
+                if end == len(buffer):
+                    break  # Element may be truncated (e.g. a number), wait for more data
+                self._pos = pos = end
+                yield element
+            self._consumed += len(buffer[:pos].encode('utf-8'))
+            self._buffer = buffer[pos:]
+            self._pos = 0
+            if finished:
+                return
+
+        # Flush the last element when the body ends without trailing bytes
+        buffer = (self._buffer + text_decoder.decode(b'', final=True)).strip()
+        if buffer.startswith(','):
+            buffer = buffer[1:].lstrip()
+        if not self._started or not buffer.endswith(']'):
+            raise ValueError("Unexpected end of JSON array")
+        buffer = buffer[:-1].strip()
+        if buffer:
+            yield json.loads(buffer)
+
+def iter_json_array(body, chunk_size: int = 1024 * 1024) -> Iterator[Any]:
+    """Incrementally parse a JSON array from an S3 streaming body, yielding one element at a time"""
+    return JsonArrayStream(body, chunk_size)
@@ -1,23 +1,215 @@
 import json
-import boto3
+import gzip
+import hashlib
 import logging
+import os
+import shutil
+import struct
+import tempfile
 import time
+import concurrent.futures
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Iterator
 from collections import defaultdict
 
+import s3_io
+import stage_memory
+import stage_metrics
+import stage_profiler
+
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client('s3')
+s3_client = s3_io.get_client('s3')
+
+# Final output sharding
+FINAL_SHARD_MAX_BYTES = int(os.environ.get('FINAL_SHARD_MAX_BYTES', 64 * 1024 * 1024))
+FINAL_SHARD_COMPRESSION = os.environ.get('FINAL_SHARD_COMPRESSION', 'gzip')
+# Shards are written as independently compressed blocks so single records can be range-read
+FINAL_SHARD_BLOCK_BYTES = int(os.environ.get('FINAL_SHARD_BLOCK_BYTES', 64 * 1024))
+
+# Record lookup index
+INDEX_KEY_FIELDS = [field for field in os.environ.get('INDEX_KEY_FIELDS', 'id,originalId,gssId').split(',') if field]
+INDEX_FENCE_INTERVAL = int(os.environ.get('INDEX_FENCE_INTERVAL', 2048))
+INDEX_TEMP_DIR = os.environ.get('INDEX_TEMP_DIR', '/tmp')
+
+# Throughput model read by the chunk planner
+PERFORMANCE_MODEL_SMOOTHING = float(os.environ.get('PERFORMANCE_MODEL_SMOOTHING', 0.3))
+MODEL_BASE_MEMORY_MB = float(os.environ.get('MODEL_BASE_MEMORY_MB', 128))
 
 def validate_input(event):
     """Validate input parameters"""
+    if isinstance(event, dict):
+        if not event.get('chunkManifest') or not event.get('bucket') or not event.get('batchId'):
+            return "Input must include bucket, batchId and chunkManifest"
+        return None
     if not isinstance(event, list):
-        return "Input must be a list of chunk results"
+        return "Input must be a list of chunk results or a chunk manifest reference"
     return None
 
+def load_chunk_stats(bucket: str, batch_id: str, chunk_id: str) -> Optional[Dict[str, Any]]:
+    """Read the stats object a chunk worker wrote, or None if it is missing"""
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=f"stats/{batch_id}/{chunk_id}.json")
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except Exception as e:
+        logger.warning(f"No stats for chunk {chunk_id}: {str(e)}")
+        return None
+
+def resolve_chunk_result(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Turn a Map output item into a chunk result.
+
+    Lambda chunks carry their result under chunkResult. Batch chunks only carry the
+    job status, so their result is read back from the stats the worker uploaded.
+    """
+    if isinstance(item.get('chunkResult'), dict):
+        return dict(item['chunkResult'], bucket=item['chunkResult'].get('bucket', item.get('bucket')))
+    if 'batchJob' in item:
+        stats = load_chunk_stats(item.get('bucket'), item.get('batchId'), item.get('chunkId'))
+        if stats is not None:
+            return stats
+        return create_missing_chunk_result(item, 'Batch job finished without writing chunk stats')
+    return item
+
+def create_missing_chunk_result(item: Dict[str, Any], error_message: str) -> Dict[str, Any]:
+    """Failed chunk result for a chunk that has no stats"""
+    return {
+        'chunkId': item.get('chunkId'),
+        'batchId': item.get('batchId'),
+        'customerId': item.get('customerId'),
+        'tenantId': item.get('tenantId'),
+        'bucket': item.get('bucket'),
+        'status': 'FAILED',
+        'error': error_message
+    }
+
+def load_planned_chunk_results(event: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Read the result of every chunk in the plan manifest from stats/"""
+    bucket = event['bucket']
+    batch_id = event['batchId']
+    response = s3_client.get_object(Bucket=bucket, Key=event['chunkManifest']['key'])
+    plan = [json.loads(line) for line in response['Body'].read().decode('utf-8').splitlines() if line]
+    chunk_ids = [entry['chunkId'] for entry in plan]
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=s3_io.S3_IO_THREADS) as executor:
+        stats = list(executor.map(lambda chunk_id: load_chunk_stats(bucket, batch_id, chunk_id), chunk_ids))
+    
+    chunk_results = []
+    for entry, chunk_stats in zip(plan, stats):
+        if chunk_stats is None:
+            chunk_stats = create_missing_chunk_result(dict(event, chunkId=entry['chunkId']), 'No chunk stats written')
+        chunk_results.append(dict(
+            chunk_stats,
+            deployment=event.get('deployment', chunk_stats.get('deployment')),
+            plannedExecutor=entry.get('executor'),
+            predictedSeconds=entry.get('predictedSeconds')
+        ))
+    
+    logger.info(f"Loaded results for {len(chunk_results)} planned chunks from s3://{bucket}/stats/{batch_id}/")
+    return chunk_results
+
+def summarize_chunk_performance(chunk_results: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Throughput, input bytes and memory per record measured in this batch, per executor"""
+    totals = defaultdict(lambda: {'chunks': 0, 'records': 0, 'seconds': 0.0, 'bytes': 0, 'memory': 0.0})
+    for chunk_result in chunk_results:
+        records = chunk_result.get('recordsProcessed', 0)
+        if chunk_result.get('status') != 'SUCCESS' or not records:
+            continue
+        performance = chunk_result.get('performance') or {}
+        executor_totals = totals[performance.get('executor', 'lambda')]
+        executor_totals['chunks'] += 1
+        executor_totals['records'] += records
+        executor_totals['seconds'] += chunk_result.get('processingTime', 0)
+        executor_totals['bytes'] += performance.get('inputBytes', 0)
+        # Keep the worst chunk so memory predictions stay conservative
+        memory_per_record = max(performance.get('peakMemoryMb', 0) - MODEL_BASE_MEMORY_MB, 0) / records
+        executor_totals['memory'] = max(executor_totals['memory'], memory_per_record)
+    
+    return {
+        executor: {
+            'chunks': executor_totals['chunks'],
+            'recordsPerSecond': executor_totals['records'] / executor_totals['seconds'] if executor_totals['seconds'] > 0 else 0,
+            'bytesPerRecord': executor_totals['bytes'] / executor_totals['records'],
+            'memoryMbPerRecord': executor_totals['memory']
+        }
+        for executor, executor_totals in totals.items()
+    }
+
+def update_performance_model(bucket: str, tenant_id: str, destination: str,
+                             observed: Dict[str, Dict[str, Any]]) -> Optional[str]:
+    """Blend this batch's measurements into the tenant/destination model used by the chunk planner"""
+    model_key = f"performance-model/{tenant_id}/{destination}.json"
+    try:
+        try:
+            model = json.loads(s3_client.get_object(Bucket=bucket, Key=model_key)['Body'].read().decode('utf-8'))
+        except Exception:
+            model = {'tenantId': tenant_id, 'destination': destination, 'executors': {}}
+        
+        for executor, measured in observed.items():
+            if not measured['recordsPerSecond']:
+                continue
+            current = model['executors'].get(executor)
+            if current is None:
+                current = {name: measured[name] for name in ('recordsPerSecond', 'bytesPerRecord', 'memoryMbPerRecord')}
+                current['samples'] = 0
+            else:
+                for name in ('recordsPerSecond', 'bytesPerRecord', 'memoryMbPerRecord'):
+                    current[name] += PERFORMANCE_MODEL_SMOOTHING * (measured[name] - current[name])
+            current['samples'] += measured['chunks']
+            model['executors'][executor] = current
+        
+        model['updatedAt'] = datetime.now().isoformat()
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=model_key,
+            Body=json.dumps(model, indent=2),
+            ContentType='application/json'
+        )
+        logger.info(f"Updated performance model s3://{bucket}/{model_key}: {json.dumps(model['executors'])}")
+        return model_key
+        
+    except Exception as e:
+        logger.error(f"Error updating performance model: {str(e)}")
+        return None
+
+def compare_predictions(chunk_results: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Compare the planner's predicted chunk durations with the measured ones"""
+    pairs = [
+        (chunk_result['predictedSeconds'], chunk_result.get('processingTime', 0))
+        for chunk_result in chunk_results
+        if chunk_result.get('predictedSeconds') and chunk_result.get('status') == 'SUCCESS'
+    ]
+    if not pairs:
+        return None
+    predicted_total = sum(predicted for predicted, _ in pairs)
+    actual_total = sum(actual for _, actual in pairs)
+    return {
+        'chunks': len(pairs),
+        'predictedSeconds': predicted_total,
+        'actualSeconds': actual_total,
+        'meanAbsolutePercentageError': sum(
+            abs(actual - predicted) / actual * 100 for predicted, actual in pairs if actual > 0
+        ) / len(pairs),
+        'executorMismatches': sum(
+            1 for chunk_result in chunk_results
+            if chunk_result.get('plannedExecutor') and chunk_result.get('status') == 'SUCCESS'
+            and (chunk_result.get('performance') or {}).get('executor', 'lambda') != chunk_result['plannedExecutor']
+        )
+    }
+
+def merge_send_latency(chunk_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merge the chunks' latency histograms into batch-wide percentiles per partition and per queue"""
+    successful = [chunk_result for chunk_result in chunk_results if chunk_result.get('status') == 'SUCCESS']
+    kafka_latency = stage_metrics.merge_latency([
+        (chunk_result.get('kafkaPartitionStats') or {}).get('latency') for chunk_result in successful
+    ])
+    sqs_latency = stage_metrics.merge_latency([chunk_result.get('sqsQueueLatency') for chunk_result in successful])
+    return {
+        'kafka': stage_metrics.summarize_latency(kafka_latency, 'partition'),
+        'sqs': stage_metrics.summarize_latency(sqs_latency, 'queue')
+    }
+
 def aggregate_chunk_results(chunk_results: List[Dict[str, Any]]) -> Dict[str, Any]:
     """Aggregate results from all processed chunks"""
     total_records = 0
@@ -53,8 +245,8 @@ def aggregate_chunk_results(chunk_results: List[Dict[str, Any]]) -> Dict[str, An
     # Calculate processing statistics
     avg_processing_time = total_processing_time / successful_chunks if successful_chunks > 0 else 0
     records_per_second = total_records / total_processing_time if total_processing_time > 0 else 0
-        
-        # Calculate destination statistics (exclusive routing)
+    
+    # Calculate destination statistics (exclusive routing)
     total_kafka_sent = sum(chunk.get('recordsSentToKafka', 0) for chunk in chunk_details)
     total_kafka_errors = sum(chunk.get('kafkaErrors', 0) for chunk in chunk_details)
     total_sqs_sent = sum(chunk.get('recordsSentToSQSCore', 0) for chunk in chunk_details)
@@ -64,7 +256,13 @@ def aggregate_chunk_results(chunk_results: List[Dict[str, Any]]) -> Dict[str, An
     destinations_used = set(chunk.get('destination', 'unknown') for chunk in chunk_details)
     primary_destination = list(destinations_used)[0] if destinations_used else 'unknown'
     
-        return {
+    # Record payload encodings used by the chunk workers
+    record_encodings = sorted(set(
+        chunk_result.get('recordEncoding', 'json') for chunk_result in chunk_results
+        if chunk_result.get('status') == 'SUCCESS'
+    ))
+    
+    return {
         'totalChunks': total_chunks,
         'successfulChunks': successful_chunks,
         'failedChunks': failed_chunks,
@@ -75,6 +273,8 @@ def aggregate_chunk_results(chunk_results: List[Dict[str, Any]]) -> Dict[str, An
         'avgProcessingTimePerChunk': avg_processing_time,
         'recordsPerSecond': records_per_second,
         'primaryDestination': primary_destination,
+        'recordEncodings': record_encodings,
+        'sendLatency': merge_send_latency(chunk_results),
         'kafkaStatistics': {
             'totalRecordsSent': total_kafka_sent,
             'totalErrors': total_kafka_errors,
@@ -88,66 +288,330 @@ def aggregate_chunk_results(chunk_results: List[Dict[str, Any]]) -> Dict[str, An
         'chunkDetails': chunk_details
     }
 
-def collect_result_files(bucket: str, batch_id: str) -> List[Dict[str, Any]]:
-    """Collect all result files from S3"""
+def list_objects(bucket: str, prefix: str) -> List[Dict[str, Any]]:
+    """The .json objects under a prefix"""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    objects = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.json'):
+                objects.append(obj)
+    return objects
+
+def load_committed_outputs(bucket: str, batch_id: str) -> Dict[str, set]:
+    """Result and error keys of the attempt that committed each chunk.
+
+    A losing speculative attempt deletes its own segments, but may not have done so yet
+    (or may have failed to), so its files under results/ and errors/ are not trusted.
+    """
+    commit_keys = [obj['Key'] for obj in list_objects(bucket, f"commits/{batch_id}/")]
+    
+    def load(commit_key: str) -> Optional[Dict[str, Any]]:
+        try:
+            return s3_io.get_json(bucket, commit_key)
+        except Exception as e:
+            logger.warning(f"Could not read commit {commit_key}: {str(e)}")
+            return None
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=s3_io.S3_IO_THREADS) as executor:
+        commits = list(executor.map(load, commit_keys))
+    
+    outputs = {'results': set(), 'errors': set()}
+    for commit in commits:
+        if not commit:
+            continue
+        result = commit.get('result') or {}
+        # Lambda chunks list every continuation segment, Batch chunks write a single file
+        outputs['results'].update(result.get('resultKeys') or [result.get('resultKey')])
+        outputs['errors'].update(result.get('errorKeys') or [result.get('errorKey')])
+    outputs['results'].discard(None)
+    outputs['errors'].discard(None)
+    logger.info(f"Loaded {len(commit_keys)} chunk commits for batch {batch_id}")
+    return outputs
+
+def collect_result_files(bucket: str, batch_id: str, committed_keys: set) -> List[Dict[str, Any]]:
+    """Collect the result files written by the committed attempt of each chunk"""
     try:
-        # List all result files for this batch
-        prefix = f"results/{batch_id}/"
-        paginator = s3_client.get_paginator('list_objects_v2')
         result_files = []
+        ignored = 0
+        for obj in list_objects(bucket, f"results/{batch_id}/"):
+            if obj['Key'] not in committed_keys:
+                ignored += 1
+                continue
+            result_files.append({
+                'key': obj['Key'],
+                'size': obj['Size'],
+                'lastModified': obj['LastModified'].isoformat()
+            })
         
-        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    if obj['Key'].endswith('.json'):
-                        result_files.append({
-                            'key': obj['Key'],
-                            'size': obj['Size'],
-                            'lastModified': obj['LastModified'].isoformat()
-                        })
-        
-        logger.info(f"Found {len(result_files)} result files for batch {batch_id}")
+        missing = len(committed_keys) - len(result_files)
+        if missing:
+            logger.warning(f"{missing} committed result files are missing for batch {batch_id}")
+        logger.info(f"Found {len(result_files)} result files for batch {batch_id}"
+                    + (f", ignored {ignored} not owned by a committed attempt" if ignored else ""))
         return result_files
         
     except Exception as e:
         logger.error(f"Error collecting result files: {str(e)}")
         raise
 
-def download_and_merge_results(bucket: str, result_files: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Download and merge all result files"""
-    all_records = []
+def iter_result_records(bucket: str, result_files: List[Dict[str, Any]],
+                        memory: Optional[stage_memory.MemoryGuard] = None) -> Iterator[Dict[str, Any]]:
+    """Download result files one at a time and yield their records.
+
+    A file that would not fit in the memory budget once parsed is streamed instead.
+    """
+    total_records = 0
     
     for file_info in result_files:
-        try:
+        if memory is not None and memory.would_exceed(file_info.get('size', 0)):
+            memory.note('streaming', f"for {file_info['key']} ({file_info.get('size', 0):,} bytes)")
             response = s3_client.get_object(Bucket=bucket, Key=file_info['key'])
-            records = json.loads(response['Body'].read().decode('utf-8'))
-            
-            if isinstance(records, list):
-                all_records.extend(records)
-            else:
-                all_records.append(records)
-                
-            logger.info(f"Downloaded {len(records)} records from {file_info['key']}")
-            
+            streamed = 0
+            for record in s3_io.iter_json_array(response['Body']):
+                streamed += 1
+                yield record
+            logger.info(f"Streamed {streamed} records from {file_info['key']}")
+            total_records += streamed
+            continue
+        
+        try:
+            data = s3_io.download_bytes(bucket, file_info['key'], size=file_info.get('size'))
+            if memory is not None:
+                memory.set_buffer('input', len(data))
+            records = json.loads(data.decode('utf-8'))
         except Exception as e:
             logger.error(f"Error downloading {file_info['key']}: {str(e)}")
             continue
+        
+        if not isinstance(records, list):
+            records = [records]
+        
+        logger.info(f"Downloaded {len(records)} records from {file_info['key']}")
+        total_records += len(records)
+        yield from records
     
-    logger.info(f"Total records merged: {len(all_records)}")
-    return all_records
+    logger.info(f"Total records merged: {total_records}")
 
-def collect_error_reports(bucket: str, batch_id: str) -> List[Dict[str, Any]]:
-    """Collect all error reports from S3"""
-    try:
-        prefix = f"errors/{batch_id}/"
-        paginator = s3_client.get_paginator('list_objects_v2')
-        error_files = []
+class RecordStatistics:
+    """Accumulates record level statistics for the processing summary without keeping the records"""
+    
+    def __init__(self):
+        self.total_records = 0
+        self.record_types = defaultdict(int)
+        self.customer_ids = set()
+        self.tenant_ids = set()
+    
+    def add(self, record: Any):
+        self.total_records += 1
+        if isinstance(record, dict):
+            self.record_types[record.get('type', 'unknown')] += 1
+            if 'customerId' in record:
+                self.customer_ids.add(record['customerId'])
+            if 'tenantId' in record:
+                self.tenant_ids.add(record['tenantId'])
+
+class RecordIndexBuilder:
+    """Builds a sorted, binary-searchable index from record key hashes to shard locations.
+
+    Entries are fixed-width (key hash, shard, block offset, block length, line offset,
+    line length) and are spilled to one temporary file per leading hash byte, so only
+    one bucket is ever sorted in memory. A fence object with the first hash of every
+    INDEX_FENCE_INTERVAL entries lets a lookup range-read a single index block.
+    """
+    
+    ENTRY = struct.Struct('>QIIIII')
+    BUCKETS = 256
+    
+    def __init__(self, directory: Optional[str] = None):
+        self._directory = tempfile.mkdtemp(prefix='record-index-', dir=directory or INDEX_TEMP_DIR)
+        self._buckets = [open(os.path.join(self._directory, f"{i:03d}.bin"), 'wb') for i in range(self.BUCKETS)]
+        self.total_entries = 0
+    
+    @staticmethod
+    def hash_key(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+    
+    def add(self, key: str, shard: int, block_offset: int, block_length: int,
+            line_offset: int, line_length: int):
+        key_hash = self.hash_key(key)
+        self._buckets[key_hash >> 56].write(
+            self.ENTRY.pack(key_hash, shard, block_offset, block_length, line_offset, line_length)
+        )
+        self.total_entries += 1
+    
+    def upload(self, bucket: str, batch_id: str) -> Dict[str, Any]:
+        """Sort every bucket into one index object, upload it with its fence object and clean up"""
+        index_path = os.path.join(self._directory, 'record-index.bin')
+        index_key = f"final-results/{batch_id}/index/record-index.bin"
+        fence_key = f"final-results/{batch_id}/index/record-index.fence"
+        fence = []
+        position = 0
+        
+        try:
+            with open(index_path, 'wb') as index_file:
+                for bucket_file in self._buckets:
+                    bucket_file.close()
+                    with open(bucket_file.name, 'rb') as f:
+                        entries = sorted(self.ENTRY.iter_unpack(f.read()))
+                    os.unlink(bucket_file.name)
+                    for entry in entries:
+                        if position % INDEX_FENCE_INTERVAL == 0:
+                            fence.append(entry[0])
+                        index_file.write(self.ENTRY.pack(*entry))
+                        position += 1
+            
+            s3_io.upload_file(index_path, bucket, index_key, {'ContentType': 'application/octet-stream'})
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=fence_key,
+                Body=struct.pack(f'>{len(fence)}Q', *fence),
+                ContentType='application/octet-stream'
+            )
+        finally:
+            shutil.rmtree(self._directory, ignore_errors=True)
+        
+        logger.info(f"Uploaded record index with {position:,} entries to s3://{bucket}/{index_key}")
+        return {
+            'key': index_key,
+            'fenceKey': fence_key,
+            'entries': position,
+            'entryFormat': self.ENTRY.format,
+            'entrySize': self.ENTRY.size,
+            'fenceInterval': INDEX_FENCE_INTERVAL,
+            'keyFields': INDEX_KEY_FIELDS,
+            'hash': 'blake2b-64'
+        }
+    
+    def discard(self):
+        for bucket_file in self._buckets:
+            bucket_file.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+class FinalResultsWriter:
+    """Writes final records as size-bounded NDJSON shards, optionally gzip compressed.
+
+    Every uploaded shard gets a manifest entry with its key, record count, sizes and
+    SHA-256 checksum so consumers can read shards in parallel or fetch a single one.
+    Shards are built from blocks of about FINAL_SHARD_BLOCK_BYTES, each compressed as its
+    own gzip member (the concatenation is still a valid gzip file), so that an index
+    entry can point at a single block that is range-read and decompressed on its own.
+    """
+    
+    def __init__(self, bucket: str, batch_id: str, max_shard_bytes: Optional[int] = None,
+                 compression: Optional[str] = None, index: Optional[RecordIndexBuilder] = None,
+                 memory: Optional[stage_memory.MemoryGuard] = None):
+        max_shard_bytes = max_shard_bytes or FINAL_SHARD_MAX_BYTES
+        compression = compression or FINAL_SHARD_COMPRESSION
+        if compression not in ('gzip', 'none'):
+            raise ValueError(f"Unsupported shard compression: {compression}")
+        self.bucket = bucket
+        self.batch_id = batch_id
+        self.max_shard_bytes = max_shard_bytes
+        self.compression = compression
+        self.index = index
+        self.memory = memory
+        self.shards = []
+        self.total_records = 0
+        # Current shard
+        self._parts = []
+        self._stored_bytes = 0
+        self._uncompressed_bytes = 0
+        self._record_count = 0
+        # Current block
+        self._lines = []
+        self._block_bytes = 0
+        self._block_keys = []
+    
+    def write(self, record: Any):
+        line = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+        if self.index is not None and isinstance(record, dict):
+            keys = [str(record[field]) for field in INDEX_KEY_FIELDS if record.get(field) is not None]
+            if keys:
+                self._block_keys.append((keys, self._block_bytes, len(line)))
+        self._lines.append(line)
+        self._block_bytes += len(line)
+        if self._block_bytes >= FINAL_SHARD_BLOCK_BYTES:
+            self._flush_block()
+            if self.memory is not None and self.memory.over_budget():
+                # Upload a shorter shard rather than keep buffering it
+                self.memory.note('early shard upload', f"at shard {len(self.shards)}")
+                self._flush_shard()
+        if self._uncompressed_bytes + self._block_bytes >= self.max_shard_bytes:
+            self._flush_shard()
+    
+    def _flush_block(self):
+        if not self._lines:
+            return
         
-        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    if obj['Key'].endswith('.json'):
-                        error_files.append(obj['Key'])
+        data = b''.join(self._lines)
+        stored = gzip.compress(data) if self.compression == 'gzip' else data
+        shard_number = len(self.shards)
+        
+        if self.index is not None:
+            for keys, line_offset, line_length in self._block_keys:
+                for key in keys:
+                    if self.compression == 'gzip':
+                        self.index.add(key, shard_number, self._stored_bytes, len(stored), line_offset, line_length)
+                    else:
+                        # Uncompressed lines are addressed directly
+                        self.index.add(key, shard_number, self._stored_bytes + line_offset, line_length, 0, line_length)
+        
+        self._parts.append(stored)
+        self._stored_bytes += len(stored)
+        if self.memory is not None:
+            self.memory.set_buffer('shard', self._stored_bytes)
+        self._uncompressed_bytes += len(data)
+        self._record_count += len(self._lines)
+        self._lines = []
+        self._block_bytes = 0
+        self._block_keys = []
+    
+    def _flush_shard(self):
+        self._flush_block()
+        if not self._parts:
+            return
+        
+        body = b''.join(self._parts)
+        record_count = self._record_count
+        uncompressed_bytes = self._uncompressed_bytes
+        self._parts = []
+        self._stored_bytes = 0
+        self._uncompressed_bytes = 0
+        self._record_count = 0
+        if self.memory is not None:
+            self.memory.set_buffer('shard', 0)
+        
+        shard_number = len(self.shards)
+        extension = 'ndjson.gz' if self.compression == 'gzip' else 'ndjson'
+        shard_key = f"final-results/{self.batch_id}/shards/part-{shard_number:05d}.{extension}"
+        
+        s3_io.upload_bytes(
+            self.bucket, shard_key, body,
+            {'ContentType': 'application/gzip' if self.compression == 'gzip' else 'application/x-ndjson'}
+        )
+        
+        self.shards.append({
+            'shardNumber': shard_number,
+            'key': shard_key,
+            'firstRecord': self.total_records,
+            'recordCount': record_count,
+            'bytes': len(body),
+            'uncompressedBytes': uncompressed_bytes,
+            'sha256': hashlib.sha256(body).hexdigest()
+        })
+        self.total_records += record_count
+        logger.info(f"Uploaded shard {shard_key} with {record_count:,} records ({len(body):,} bytes)")
+    
+    def close(self) -> List[Dict[str, Any]]:
+        self._flush_shard()
+        return self.shards
+
+def collect_error_reports(bucket: str, batch_id: str, committed_keys: set) -> List[Dict[str, Any]]:
+    """Collect the error reports written by the committed attempt of each chunk"""
+    try:
+        error_files = [obj['Key'] for obj in list_objects(bucket, f"errors/{batch_id}/")
+                       if obj['Key'] in committed_keys]
         
         all_errors = []
         for error_file in error_files:
@@ -172,22 +636,10 @@ def collect_error_reports(bucket: str, batch_id: str) -> List[Dict[str, Any]]:
         return []
 
 def generate_processing_summary(aggregated_results: Dict[str, Any], 
-                              all_records: List[Dict[str, Any]], 
+                              record_stats: RecordStatistics, 
                               all_errors: List[Dict[str, Any]]) -> Dict[str, Any]:
     """Generate comprehensive processing summary"""
-    
-    # Analyze record patterns
-    record_types = defaultdict(int)
-    customer_ids = set()
-    tenant_ids = set()
-    
-    for record in all_records:
-        if isinstance(record, dict):
-            record_types[record.get('type', 'unknown')] += 1
-            if 'customerId' in record:
-                customer_ids.add(record['customerId'])
-            if 'tenantId' in record:
-                tenant_ids.add(record['tenantId'])
+    total_records = record_stats.total_records
     
     # Analyze error patterns
     error_types = defaultdict(int)
@@ -197,19 +649,20 @@ def generate_processing_summary(aggregated_results: Dict[str, Any],
     
     summary = {
         'processingSummary': {
-            'totalRecordsProcessed': len(all_records),
+            'totalRecordsProcessed': total_records,
             'totalErrors': len(all_errors),
-            'successRate': ((len(all_records) - len(all_errors)) / len(all_records) * 100) if all_records else 0,
-            'uniqueCustomers': len(customer_ids),
-            'uniqueTenants': len(tenant_ids),
-            'recordTypes': dict(record_types),
+            'successRate': ((total_records - len(all_errors)) / total_records * 100) if total_records else 0,
+            'uniqueCustomers': len(record_stats.customer_ids),
+            'uniqueTenants': len(record_stats.tenant_ids),
+            'recordTypes': dict(record_stats.record_types),
             'errorTypes': dict(error_types)
         },
         'performanceMetrics': {
             'totalProcessingTime': aggregated_results['totalProcessingTime'],
             'avgProcessingTimePerChunk': aggregated_results['avgProcessingTimePerChunk'],
             'recordsPerSecond': aggregated_results['recordsPerSecond'],
-            'chunksPerSecond': aggregated_results['successfulChunks'] / aggregated_results['totalProcessingTime'] if aggregated_results['totalProcessingTime'] > 0 else 0
+            'chunksPerSecond': aggregated_results['successfulChunks'] / aggregated_results['totalProcessingTime'] if aggregated_results['totalProcessingTime'] > 0 else 0,
+            'sendLatency': aggregated_results['sendLatency']
         },
         'chunkStatistics': {
             'totalChunks': aggregated_results['totalChunks'],
@@ -221,53 +674,87 @@ def generate_processing_summary(aggregated_results: Dict[str, Any],
     
     return summary
 
-def upload_final_results(bucket: str, batch_id: str, all_records: List[Dict[str, Any]], 
-                        summary: Dict[str, Any]) -> str:
-    """Upload final aggregated results to S3"""
+def upload_final_results(bucket: str, batch_id: str, writer: FinalResultsWriter, 
+                        summary: Dict[str, Any]) -> Dict[str, str]:
+    """Upload the summary and the shard manifest for the final results"""
     try:
-        # Create final results structure
-        final_results = {
+        shards = writer.close()
+        processed_at = datetime.now().isoformat()
+        summary_key = f"final-results/{batch_id}/summary.json"
+        manifest_key = f"final-results/{batch_id}/manifest.json"
+        
+        # Summary stays small and separate from the record data
+        index_info = writer.index.upload(bucket, batch_id) if writer.index is not None else None
+        
+        s3_client.put_object(
+            Bucket=bucket,
+            Key=summary_key,
+            Body=json.dumps({
+                'batchId': batch_id,
+                'processedAt': processed_at,
+                'summary': summary,
+                'totalRecords': writer.total_records,
+                'manifestKey': manifest_key
+            }, indent=2),
+            ContentType='application/json'
+        )
+        
+        manifest = {
             'batchId': batch_id,
-            'processedAt': datetime.now().isoformat(),
-            'summary': summary,
-            'totalRecords': len(all_records),
-            'records': all_records
+            'processedAt': processed_at,
+            'format': 'ndjson',
+            'compression': writer.compression,
+            'totalRecords': writer.total_records,
+            'totalShards': len(shards),
+            'totalBytes': sum(shard['bytes'] for shard in shards),
+            'summaryKey': summary_key,
+            'shards': shards,
+            'index': index_info,
+            'manifestVersion': '2.0'
         }
-        
-        # Upload to S3
-        result_key = f"final-results/{batch_id}/aggregated-results.json"
         s3_client.put_object(
             Bucket=bucket,
-            Key=result_key,
-            Body=json.dumps(final_results, indent=2),
+            Key=manifest_key,
+            Body=json.dumps(manifest, separators=(',', ':')),
             ContentType='application/json'
         )
         
-        logger.info(f"Uploaded final results to s3://{bucket}/{result_key}")
-        return result_key
+        logger.info(f"Uploaded final results manifest to s3://{bucket}/{manifest_key} ({len(shards)} shards)")
+        return {'manifestKey': manifest_key, 'summaryKey': summary_key, 'totalShards': len(shards),
+                'totalBytes': manifest['totalBytes']}
         
     except Exception as e:
         logger.error(f"Error uploading final results: {str(e)}")
         raise
 
+@stage_profiler.profiled('aggregate-results')
 def lambda_handler(event, context):
     """Main Lambda handler for aggregating results"""
+    start_time = time.time()
+    metrics = stage_metrics.StageMetrics('aggregate-results')
+    memory = stage_memory.MemoryGuard('aggregate-results', context).start()
     try:
         # Validate input
         error = validate_input(event)
         if error:
             return create_error(error)
         
+        # A chunk manifest reference means the chunk results are read back from stats/
+        if isinstance(event, dict):
+            event = load_planned_chunk_results(event)
+        
         # Extract batch information from the first chunk result
         if not event or not isinstance(event, list) or len(event) == 0:
             return create_error("No chunk results provided")
         
+        event = [resolve_chunk_result(item) for item in event]
         first_result = event[0]
         batch_id = first_result.get('batchId', 'unknown')
         customer_id = first_result.get('customerId', 'unknown')
         tenant_id = first_result.get('tenantId', 'unknown')
         deployment = first_result.get('deployment', 'WORKSPACE')
         bucket = first_result.get('bucket', 'unknown')
+        metrics.set_dimensions(batch_id, tenant_id)
         
         logger.info(f"Starting result aggregation for batch {batch_id}")
         logger.info(f"Processing {len(event)} chunk results")
@@ -275,20 +762,52 @@ def lambda_handler(event, context):
         # Aggregate chunk results
         aggregated_results = aggregate_chunk_results(event)
         
-        # Collect result files from S3
-        result_files = collect_result_files(bucket, batch_id)
+        # Feed measured throughput back to the planner and check its predictions
+        destination = next((chunk.get('destination') for chunk in event if chunk.get('destination')), 'unknown')
+        performance_model_key = update_performance_model(
+            bucket, tenant_id, destination, summarize_chunk_performance(event)
+        )
+        prediction_accuracy = compare_predictions(event)
+        if prediction_accuracy:
+            logger.info(f"Chunk duration predictions: {json.dumps(prediction_accuracy)}")
         
-        # Download and merge all results
-        all_records = download_and_merge_results(bucket, result_files)
+        # Collect result files from S3, only those of the attempt that committed each chunk
+        committed = load_committed_outputs(bucket, batch_id)
+        result_files = collect_result_files(bucket, batch_id, committed['results'])
+        
+        # Stream all results into NDJSON shards while collecting record statistics
+        index = RecordIndexBuilder() if INDEX_KEY_FIELDS else None
+        writer = FinalResultsWriter(bucket, batch_id, index=index, memory=memory)
+        record_stats = RecordStatistics()
+        try:
+            for record in iter_result_records(bucket, result_files, memory):
+                record_stats.add(record)
+                writer.write(record)
+        except Exception:
+            if index is not None:
+                index.discard()
+            raise
         
         # Collect error reports
-        all_errors = collect_error_reports(bucket, batch_id)
+        all_errors = collect_error_reports(bucket, batch_id, committed['errors'])
         
         # Generate comprehensive summary
-        summary = generate_processing_summary(aggregated_results, all_records, all_errors)
+        summary = generate_processing_summary(aggregated_results, record_stats, all_errors)
+        
+        # Upload summary and shard manifest
+        final_output = upload_final_results(bucket, batch_id, writer, summary)
         
-        # Upload final results
-        final_result_key = upload_final_results(bucket, batch_id, all_records, summary)
+        metrics.increment('ChunksIn', len(event))
+        metrics.increment('RecordsIn', record_stats.total_records)
+        metrics.increment('RecordsOut', writer.total_records)
+        metrics.increment('RecordsFailed', len(all_errors))
+        metrics.increment('BytesRead', sum(result_file['size'] for result_file in result_files), stage_metrics.BYTES)
+        metrics.increment('BytesWritten', final_output['totalBytes'], stage_metrics.BYTES)
+        metrics.rate('Throughput', record_stats.total_records, time.time() - start_time)
+        send_latency = aggregated_results['sendLatency']
+        metrics.latency_percentiles('SendLatency', send_latency['kafka'] or send_latency['sqs'])
+        memory.stop()
+        memory.record_metrics(metrics)
         
         # Prepare response
         response = {
@@ -300,21 +819,33 @@ def lambda_handler(event, context):
             'batchStatus': 'COMPLETED',
             'aggregatedResults': aggregated_results,
             'summary': summary,
-            'finalResultKey': final_result_key,
-            'totalRecordsProcessed': len(all_records),
+            'finalResultKey': final_output['manifestKey'],
+            'summaryKey': final_output['summaryKey'],
+            'totalShards': final_output['totalShards'],
+            'totalRecordsProcessed': record_stats.total_records,
             'totalErrors': len(all_errors),
             'processingTime': aggregated_results['totalProcessingTime'],
+            'recordEncoding': ','.join(aggregated_results['recordEncodings']) or 'json',
+            'performanceModelKey': performance_model_key,
+            'predictionAccuracy': prediction_accuracy,
+            'speculativeChunks': sum(1 for chunk in event if chunk.get('attempt', 'primary') != 'primary'),
+            'memory': memory.get_report(),
             'completionTime': datetime.now().isoformat()
         }
         
         logger.info(f"Result aggregation completed successfully for batch {batch_id}")
-        logger.info(f"Processed {len(all_records):,} records with {len(all_errors)} errors")
+        logger.info(f"Processed {record_stats.total_records:,} records with {len(all_errors)} errors")
         
         return response
         
     except Exception as e:
         logger.error(f"Error in result aggregation: {str(e)}")
+        metrics.increment('Errors')
         return create_error(f"Result aggregation failed: {str(e)}")
+    finally:
+        memory.stop()
+        metrics.record('Duration', (time.time() - start_time) * 1000)
+        metrics.flush()
 
 def create_error(error_message: str):
     """Create error response"""
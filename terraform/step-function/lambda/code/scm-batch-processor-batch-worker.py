@@ -0,0 +1,404 @@
+import json
+import logging
+import math
+import resource
+import os
+import sys
+import time
+import argparse
+import importlib
+import shutil
+import tempfile
+import multiprocessing
+import concurrent.futures
+from datetime import datetime
+from typing import Dict, List, Any, Optional, Iterator, Tuple
+
+import s3_io
+import stage_metrics
+
+# AWS Batch entry point for chunks above batch_processing_threshold. It processes one chunk
+# with the update-records transform and destinations, spread over a process pool, and writes
+# the same results/, errors/ and stats/ objects as the Lambda path.
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+logger = logging.getLogger()
+
+BATCH_WORKER_PROCESSES = int(os.environ.get('BATCH_WORKER_PROCESSES', 0))  # 0 = the job's vCPUs
+BATCH_JOB_VCPUS = int(os.environ.get('BATCH_JOB_VCPUS', 0))  # vcpus of the job definition, 0 if not passed
+BATCH_WORKER_SLICE_SIZE = int(os.environ.get('BATCH_WORKER_SLICE_SIZE', 50000))
+BATCH_WORKER_SLICES_IN_FLIGHT = int(os.environ.get('BATCH_WORKER_SLICES_IN_FLIGHT', 2))  # per pool process
+BATCH_WORKER_TEMP_DIR = os.environ.get('BATCH_WORKER_TEMP_DIR', tempfile.gettempdir())
+
+def cgroup_cpu_limit() -> Optional[int]:
+    """CPUs allowed by the container's cgroup CPU quota, None without a quota"""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max:
+            quota, period = cpu_max.read().split()[:2]
+        if quota != 'max':
+            return max(1, math.ceil(int(quota) / int(period)))
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as quota_file, \
+                open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as period_file:
+            quota, period = int(quota_file.read()), int(period_file.read())
+        return max(1, math.ceil(quota / period)) if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+def available_cpus() -> int:
+    """CPUs this job may use: the job's vCPUs, the CPU affinity and the cgroup quota, whichever is lowest.
+
+    os.cpu_count() is the host's CPU count, which on a shared Batch host is far more
+    than the job was given.
+    """
+    limits = [len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1]
+    quota = cgroup_cpu_limit()
+    if quota:
+        limits.append(quota)
+    if BATCH_JOB_VCPUS > 0:
+        limits.append(BATCH_JOB_VCPUS)
+    return max(1, min(limits))
+
+def load_update_records():
+    """Import the update-records handler module (its file name is not a valid identifier)"""
+    return importlib.import_module('scm-batch-processor-update-records')
+
+def parse_args(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Parse the job parameters passed by the SubmitBatchJob state"""
+    parser = argparse.ArgumentParser(description='Process one batch processor chunk on AWS Batch')
+    parser.add_argument('--chunk-id', dest='chunkId', required=True)
+    parser.add_argument('--start-index', dest='startIndex', type=int, required=True)
+    parser.add_argument('--end-index', dest='endIndex', type=int, required=True)
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--file', required=True)
+    parser.add_argument('--customer-id', dest='customerId', required=True)
+    parser.add_argument('--tenant-id', dest='tenantId', required=True)
+    parser.add_argument('--batch-id', dest='batchId', required=True)
+    parser.add_argument('--destination', default='kafka')
+    parser.add_argument('--processes', type=int, default=BATCH_WORKER_PROCESSES)
+    return vars(parser.parse_args(argv))
+
+# One serializer and one sender per pool process, shared by every slice the process runs
+_process_state = {}
+
+def process_stats_path(work_dir: str, pid: int) -> str:
+    return os.path.join(work_dir, f"process-{pid}.json")
+
+def init_process(event: Dict[str, Any], work_dir: str):
+    """Pool initializer: create the process's sender, flushed once when the process exits"""
+    update_records = load_update_records()
+    destination = event.get('destination', 'kafka').lower()
+    kafka_topic = os.environ.get('KAFKA_TOPIC', 'processed-records')
+    sqs_core_queue = os.environ.get('SQS_CORE_QUEUE', '')
+    _process_state.update({
+        'workDir': work_dir,
+        'kafkaTopic': kafka_topic,
+        'sqsCoreQueue': sqs_core_queue,
+        'serializer': update_records.get_record_serializer(
+            kafka_topic if destination == 'kafka' else sqs_core_queue, event.get('recordEncoding')
+        ),
+        'producer': update_records.ShardedKafkaSender(os.environ.get('KAFKA_BROKERS', '').split(','))
+        if destination == 'kafka' else None,
+        'sqsClient': s3_io.get_client('sqs') if destination == 'sqs_core' else None,
+        'sqsLatency': stage_metrics.LatencyHistograms() if destination == 'sqs_core' else None
+    })
+    # Runs when the pool shuts its processes down, after the last slice
+    multiprocessing.util.Finalize(None, close_process, exitpriority=10)
+
+def close_process():
+    """Flush the process's sender and leave its delivery counts for the parent"""
+    stats = {}
+    producer = _process_state.get('producer')
+    if producer is not None:
+        try:
+            producer.flush(timeout=30)
+        finally:
+            producer.close()
+        stats['kafka'] = dict(producer.get_delivery_counts(), partitionStats=producer.get_partition_stats())
+    if _process_state.get('sqsLatency') is not None:
+        stats['sqsLatency'] = _process_state['sqsLatency'].to_dict()
+    with open(process_stats_path(_process_state['workDir'], os.getpid()), 'w') as stats_file:
+        json.dump(stats, stats_file)
+
+def process_slice(task: Dict[str, Any]) -> Dict[str, Any]:
+    """Transform and send one slice of a chunk inside a pool process.
+
+    Transformed records are written to a part file as comma separated JSON so the
+    parent can assemble the results array without records crossing process boundaries.
+    Kafka messages go to the process's sender, so 'sent' only counts queued messages;
+    deliveries are counted when the process flushes its sender on exit.
+    """
+    update_records = load_update_records()
+    event = task['event']
+    offset = task['offset']
+    start_index = event['startIndex'] + offset
+    destination = event.get('destination', 'kafka').lower()
+
+    processed = []
+    errors = []
+    for i, record in enumerate(task['records']):
+        try:
+            processed.append(update_records.transform_record(record, event['customerId'], event['tenantId']))
+        except Exception as e:
+            errors.append({'record_index': offset + i, 'error': str(e), 'record': record})
+
+    serializer = _process_state['serializer']
+    sent = {'success': 0, 'errors': 0}
+    send_start = time.time()
+    if destination == 'kafka':
+        sent = update_records.send_records_to_kafka(
+            processed, event['chunkId'], start_index, event['customerId'], event['tenantId'],
+            event['batchId'], [], _process_state['kafkaTopic'], producer=_process_state['producer'],
+            key_field=update_records.get_kafka_key_field(event),
+            envelope=update_records.get_kafka_envelope(event), serializer=serializer
+        )
+    elif destination == 'sqs_core':
+        sent = update_records.send_records_to_sqs(
+            processed, event['chunkId'], start_index, event['customerId'], event['tenantId'],
+            event['batchId'], _process_state['sqsCoreQueue'], sqs_client=_process_state['sqsClient'],
+            serializer=serializer, latency=_process_state['sqsLatency']
+        )
+
+    with open(task['partPath'], 'w') as part:
+        part.write(','.join(json.dumps(record) for record in processed))
+
+    return {
+        'offset': offset,
+        'partPath': task['partPath'],
+        'processed': len(processed),
+        'errors': errors,
+        'sent': sent,
+        'sendTime': time.time() - send_start,
+        'recordEncoding': serializer.name
+    }
+
+def load_process_stats(work_dir: str) -> List[Dict[str, Any]]:
+    """Delivery counts the pool processes left behind when they exited"""
+    stats = []
+    for name in sorted(os.listdir(work_dir)):
+        if name.startswith('process-'):
+            with open(os.path.join(work_dir, name)) as stats_file:
+                stats.append(json.load(stats_file))
+    return stats
+
+def batch_attempt() -> str:
+    """Attempt label of this job; a retry of the Batch job is a separate attempt of the chunk"""
+    job_attempt = int(os.environ.get('AWS_BATCH_JOB_ATTEMPT', 1))
+    return load_update_records().PRIMARY_ATTEMPT if job_attempt <= 1 else f"batch-retry-{job_attempt}"
+
+def run_slices(executor: concurrent.futures.Executor, blocks: Iterator[Dict[str, Any]], event: Dict[str, Any],
+               work_dir: str, max_in_flight: int) -> Tuple[List[Dict[str, Any]], float]:
+    """Submit slices to the pool as they are parsed, with at most max_in_flight submitted and unfinished.
+
+    Only the slices in flight are held in the parent, so its memory stays bounded however
+    large the chunk is. Returns the slice results in chunk order and the time spent reading.
+    """
+    results = []
+    pending = set()
+    read_time = 0.0
+    while True:
+        read_start = time.time()
+        block = next(blocks, None)
+        read_time += time.time() - read_start
+        if block is None:
+            break
+        offset = block['baseIndex']
+        pending.add(executor.submit(process_slice, {
+            'event': event,
+            'offset': offset,
+            'records': block['records'],
+            'partPath': os.path.join(work_dir, f"part-{offset:012d}.json")
+        }))
+        del block
+        if len(pending) >= max_in_flight:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            results.extend(future.result() for future in done)
+    results.extend(future.result() for future in concurrent.futures.as_completed(pending))
+    return sorted(results, key=lambda result: result['offset']), read_time
+
+def run_chunk(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Process one chunk across a process pool and upload results, errors and stats"""
+    start_time = time.time()
+    update_records = load_update_records()
+    chunk_id = event['chunkId']
+    batch_id = event['batchId']
+    bucket = event['bucket']
+    destination = event.get('destination', 'kafka').lower()
+    processes = event.get('processes') or available_cpus()
+    metrics = stage_metrics.StageMetrics.for_event('update-records', event)
+    metrics.set_property('chunkId', chunk_id)
+    metrics.set_property('executor', 'batch')
+
+    # A retried Batch job races any earlier attempt that is still sending, the commit decides the winner
+    event = dict(event, attempt=event.get('attempt') or batch_attempt())
+    attempt = event['attempt']
+    metrics.set_property('attempt', attempt)
+    heartbeat = update_records.ChunkHeartbeat(event)
+    heartbeat.check_commit()
+    if heartbeat.superseded:
+        logger.info(f"Chunk {chunk_id} was already committed, {attempt} attempt returns the committed result")
+        update_records.upload_chunk_stats(bucket, heartbeat.winner)
+        return dict(heartbeat.winner, supersededAttempt=attempt)
+
+    logger.info(f"Processing chunk {chunk_id}: records {event['startIndex']:,} to {event['endIndex']:,} "
+                f"with {processes} processes"
+                + (f" as {attempt} attempt" if attempt != update_records.PRIMARY_ATTEMPT else ""))
+
+    # The chunk is parsed from ranged reads as it is sliced, it is never held in memory whole
+    chunk_key = f"chunks/{batch_id}/{chunk_id}.json"
+    reader = update_records.RangedObjectReader(bucket, chunk_key)
+    blocks = update_records.iter_record_blocks(update_records.open_chunk_records(bucket, chunk_key, body=reader),
+                                               block_size=BATCH_WORKER_SLICE_SIZE)
+
+    work_dir = tempfile.mkdtemp(prefix=f"{chunk_id}-", dir=BATCH_WORKER_TEMP_DIR)
+    try:
+        # spawn keeps boto3 and Kafka client threads from being forked into the workers
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                                                    initializer=init_process, initargs=(event, work_dir)) as executor:
+            slices, download_time = run_slices(executor, blocks, event, work_dir,
+                                               max(1, processes * BATCH_WORKER_SLICES_IN_FLIGHT))
+        # The pool has shut down, so every process has flushed its sender
+        process_stats = load_process_stats(work_dir)
+        input_bytes = reader.bytes_read
+
+        # Assemble the parts into the same JSON array the Lambda path uploads
+        result_path = os.path.join(work_dir, 'result.json')
+        with open(result_path, 'w') as result_file:
+            result_file.write('[')
+            first = True
+            for slice_result in slices:
+                if not slice_result['processed']:
+                    continue
+                if not first:
+                    result_file.write(',')
+                with open(slice_result['partPath']) as part:
+                    shutil.copyfileobj(part, result_file)
+                first = False
+            result_file.write(']')
+
+        attempt_suffix = f".{attempt}" if attempt != update_records.PRIMARY_ATTEMPT else ""
+        result_key = f"results/{batch_id}/{chunk_id}{attempt_suffix}.json"
+        result_bytes = os.path.getsize(result_path)
+        s3_io.upload_file(result_path, bucket, result_key, {'ContentType': 'application/json'})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    processing_errors = [error for slice_result in slices for error in slice_result['errors']]
+    error_key = None
+    if processing_errors:
+        error_key = f"errors/{batch_id}/{chunk_id}{attempt_suffix}.json"
+        s3_io.upload_bytes(bucket, error_key, json.dumps(processing_errors).encode('utf-8'),
+                           {'ContentType': 'application/json'})
+
+    records_processed = sum(slice_result['processed'] for slice_result in slices)
+    sent_success = sum(slice_result['sent']['success'] for slice_result in slices)
+    sent_errors = sum(slice_result['sent']['errors'] for slice_result in slices)
+    if destination == 'kafka':
+        # Slices only queued their messages; a process that left no counts delivered nothing
+        queued = sent_success + sent_errors
+        sent_success = sum(stats['kafka']['success'] for stats in process_stats if stats.get('kafka'))
+        sent_errors = queued - sent_success
+    kafka_partition_stats = update_records.merge_partition_stats([stats.get('kafka', {}).get('partitionStats') for stats in process_stats])
+    sqs_queue_latency = stage_metrics.merge_latency([stats.get('sqsLatency') for stats in process_stats])
+    send_latency = update_records.get_send_latency(destination, kafka_partition_stats, sqs_queue_latency)
+    processing_time = time.time() - start_time
+    total_attempted = records_processed + len(processing_errors)
+
+    result = {
+        'chunkId': chunk_id,
+        'batchId': batch_id,
+        'customerId': event['customerId'],
+        'tenantId': event['tenantId'],
+        'bucket': bucket,
+        'deployment': 'WORKSPACE',
+        'status': 'SUCCESS',
+        'batchStatus': 'CHUNK_PROCESSED',
+        'destination': destination,
+        'recordsProcessed': records_processed,
+        'recordsAttempted': total_attempted,
+        'processingErrors': len(processing_errors),
+        'processingSuccessRate': ((records_processed - len(processing_errors)) / total_attempted * 100) if total_attempted > 0 else 0,
+        'processingTime': processing_time,
+        'recordsSentToKafka': sent_success if destination == 'kafka' else 0,
+        'kafkaErrors': sent_errors if destination == 'kafka' else 0,
+        'kafkaPartitionStats': kafka_partition_stats,
+        'recordEncoding': slices[0]['recordEncoding'] if slices else update_records.RECORD_ENCODING,
+        'recordsSentToSQSCore': sent_success if destination == 'sqs_core' else 0,
+        'sqsErrors': sent_errors if destination == 'sqs_core' else 0,
+        'sqsQueueLatency': sqs_queue_latency,
+        'sendLatency': send_latency,
+        'resultKey': result_key,
+        'errorKey': error_key,
+        'performance': {
+            'recordsPerSecond': records_processed / processing_time if processing_time > 0 else 0,
+            'processingTime': processing_time,
+            'downloadTime': download_time,
+            'processes': processes,
+            'slices': len(slices),
+            'executor': 'batch',
+            'inputBytes': input_bytes,
+            'peakMemoryMb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                             + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+        },
+        'metadata': {
+            'source': 'batch-processor',
+            'version': '1.0',
+            'chunkSize': event['endIndex'] - event['startIndex'] + 1,
+            'destination': destination,
+            'completedAt': datetime.now().isoformat()
+        }
+    }
+    result['attempt'] = attempt
+    # The commit marks the chunk done for the straggler monitor; an earlier attempt may have won it
+    if not heartbeat.commit(result):
+        logger.info(f"Chunk {chunk_id} was committed by another attempt first, discarding {attempt} output")
+        winner = heartbeat.winner
+        update_records.discard_attempt_outputs(
+            bucket, [key for key in (result_key, error_key) if key],
+            [winner.get('resultKey'), winner.get('errorKey')] + winner.get('resultKeys', []) + winner.get('errorKeys', [])
+        )
+        update_records.upload_chunk_stats(bucket, winner)
+        metrics.increment('AttemptsSuperseded')
+        metrics.flush()
+        return dict(winner, supersededAttempt=attempt)
+    update_records.upload_chunk_stats(bucket, result)
+    
+    metrics.increment('RecordsIn', total_attempted)
+    metrics.increment('RecordsOut', sent_success)
+    metrics.increment('RecordsFailed', len(processing_errors))
+    metrics.increment('SendErrors', sent_errors)
+    metrics.increment('BytesRead', input_bytes, stage_metrics.BYTES)
+    metrics.increment('BytesWritten', result_bytes, stage_metrics.BYTES)
+    metrics.increment('ChunksCompleted')
+    metrics.rate('Throughput', records_processed, processing_time)
+    metrics.latency_percentiles('SendLatency', send_latency)
+    # One sample per slice: the time a pool process spent sending its slice
+    for slice_result in slices:
+        metrics.record('SendLatency', slice_result['sendTime'] * 1000)
+    metrics.record('Duration', processing_time * 1000)
+    metrics.flush()
+    return result
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """CLI entry point, exits non-zero so the Batch job is marked FAILED"""
+    event = parse_args(argv)
+    try:
+        result = run_chunk(event)
+        logger.info(f"Chunk {event['chunkId']} completed: {result['recordsProcessed']:,} records "
+                    f"in {result['processingTime']:.1f}s")
+        return 0
+    except Exception as e:
+        logger.error(f"Batch chunk processing failed for {event['chunkId']}: {str(e)}")
+        metrics = stage_metrics.StageMetrics.for_event('update-records', event)
+        metrics.set_property('chunkId', event['chunkId'])
+        metrics.set_property('executor', 'batch')
+        metrics.increment('ChunksFailed')
+        metrics.flush()
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,46 @@
 import json
-import boto3
 import logging
 import math
+import os
+import time
 import uuid
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
+
+import s3_io
+import stage_metrics
+import stage_profiler
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client('s3')
+s3_client = s3_io.get_client('s3')
+
+# Lambda budget a planned chunk may fill
+LAMBDA_TIMEOUT_SECONDS = int(os.environ.get('LAMBDA_TIMEOUT_SECONDS', 900))
+LAMBDA_MEMORY_MB = int(os.environ.get('LAMBDA_MEMORY_MB', 10240))
+LAMBDA_BUDGET_UTILIZATION = float(os.environ.get('LAMBDA_BUDGET_UTILIZATION', 0.7))
+MODEL_BASE_MEMORY_MB = float(os.environ.get('MODEL_BASE_MEMORY_MB', 128))
+
+# Executor cost and latency model used for Lambda vs Batch routing
+LAMBDA_STARTUP_SECONDS = float(os.environ.get('LAMBDA_STARTUP_SECONDS', 1))
+BATCH_STARTUP_SECONDS = float(os.environ.get('BATCH_STARTUP_SECONDS', 120))
+BATCH_JOB_VCPUS = int(os.environ.get('BATCH_JOB_VCPUS', 4))
+LAMBDA_GB_SECOND_PRICE = float(os.environ.get('LAMBDA_GB_SECOND_PRICE', 0.0000166667))
+BATCH_VCPU_SECOND_PRICE = float(os.environ.get('BATCH_VCPU_SECOND_PRICE', 0.0000112))
+LATENCY_COST_PER_SECOND = float(os.environ.get('LATENCY_COST_PER_SECOND', 0.0001))
+
+# Chunk size search: geometric candidates between the smallest and largest chunk size
+MIN_CHUNK_SIZE = int(os.environ.get('MIN_CHUNK_SIZE', 1000))
+CHUNK_SIZE_CANDIDATES = int(os.environ.get('CHUNK_SIZE_CANDIDATES', 24))
+BATCH_DEADLINE_SECONDS = float(os.environ.get('BATCH_DEADLINE_SECONDS', 0))  # predicted makespan limit, 0 for none
+
+# Used until a tenant/destination has measured runs (5ms and 0.5KB per record)
+DEFAULT_EXECUTOR_MODELS = {
+    'lambda': {'recordsPerSecond': 200, 'bytesPerRecord': 1024, 'memoryMbPerRecord': 0.5 / 1024},
+    'batch': {'recordsPerSecond': 200 * BATCH_JOB_VCPUS, 'bytesPerRecord': 1024, 'memoryMbPerRecord': 0.5 / 1024}
+}
 
 def validate_input(event):
     """Validate input parameters"""
@@ -20,105 +50,224 @@ def validate_input(event):
         return f"Missing required fields: {', '.join(missing_fields)}"
     return None
 
-def get_file_size_and_estimate_records(bucket: str, file_key: str) -> tuple:
-    """Get file size and estimate number of records"""
+def get_file_size_and_estimate_records(bucket: str, file_key: str, estimate: bool = True) -> tuple:
+    """Get file size and estimate number of records from newline density samples"""
     try:
         head = s3_client.head_object(Bucket=bucket, Key=file_key)
         file_size = head['ContentLength']
+        if not estimate:
+            return file_size, None
         
-        # Estimate records based on file size (rough estimate: 1KB per record)
-        estimated_records = max(1000000, file_size // 1024)  # Minimum 1M records
-        
-        logger.info(f"File size: {file_size:,} bytes, estimated records: {estimated_records:,}")
-        return file_size, estimated_records
+        record_estimate = s3_io.estimate_line_count(bucket, file_key, file_size)
+        logger.info(f"File size: {file_size:,} bytes, estimated records: {record_estimate['records']:,} "
+                    f"(± {record_estimate['errorBound']:,})")
+        return file_size, record_estimate
         
     except Exception as e:
         logger.error(f"Error getting file size: {str(e)}")
         raise
 
-def calculate_optimal_chunk_size(total_records: int, max_concurrent: int, max_chunk_size: int) -> int:
-    """Calculate optimal chunk size based on total records and concurrency"""
-    # Start with max concurrent chunks
-    optimal_chunks = max_concurrent
+def load_performance_model(bucket: str, tenant_id: str, destination: str) -> Dict[str, Any]:
+    """Measured executor throughput for a tenant and destination, falling back to defaults"""
+    model_key = f"performance-model/{tenant_id}/{destination}.json"
+    executors = {name: dict(model, samples=0) for name, model in DEFAULT_EXECUTOR_MODELS.items()}
+    source = 'default'
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=model_key)
+        measured = json.loads(response['Body'].read().decode('utf-8')).get('executors', {})
+        for name, model in measured.items():
+            executors[name] = dict(executors.get(name, {}), **model)
+        source = 'measured' if measured else source
+    except Exception as e:
+        logger.info(f"No performance model at s3://{bucket}/{model_key}, using defaults: {str(e)}")
     
-    # Calculate chunk size
-    chunk_size = math.ceil(total_records / optimal_chunks)
+    # Batch jobs without history are assumed to scale the Lambda rate across their vCPUs
+    if executors['batch']['samples'] == 0 and executors['lambda']['samples'] > 0:
+        executors['batch']['recordsPerSecond'] = executors['lambda']['recordsPerSecond'] * BATCH_JOB_VCPUS
     
-    # Ensure chunk size doesn't exceed maximum
-    chunk_size = min(chunk_size, max_chunk_size)
+    return {'key': model_key, 'source': source, 'executors': executors}
+
+def calculate_lambda_capacity(model: Dict[str, Any]) -> int:
+    """Largest chunk that fits the Lambda time and memory budget"""
+    lambda_model = model['executors']['lambda']
+    time_budget = LAMBDA_TIMEOUT_SECONDS * LAMBDA_BUDGET_UTILIZATION - LAMBDA_STARTUP_SECONDS
+    memory_budget = LAMBDA_MEMORY_MB * LAMBDA_BUDGET_UTILIZATION - MODEL_BASE_MEMORY_MB
+    by_time = time_budget * lambda_model['recordsPerSecond']
+    by_memory = memory_budget / lambda_model['memoryMbPerRecord'] if lambda_model['memoryMbPerRecord'] > 0 else by_time
+    return max(1, int(min(by_time, by_memory)))
+
+def predict_chunk(chunk_size: int, model: Dict[str, Any], lambda_capacity: int) -> Dict[str, Dict[str, Any]]:
+    """Predicted duration, memory and cost of a chunk on each executor"""
+    lambda_model = model['executors']['lambda']
+    batch_model = model['executors']['batch']
     
-    # Recalculate number of chunks with the final chunk size
-    final_chunks = math.ceil(total_records / chunk_size)
+    lambda_seconds = LAMBDA_STARTUP_SECONDS + chunk_size / lambda_model['recordsPerSecond']
+    batch_seconds = BATCH_STARTUP_SECONDS + chunk_size / batch_model['recordsPerSecond']
     
-    logger.info(f"Optimal chunk size: {chunk_size:,}, total chunks: {final_chunks}")
+    return {
+        'lambda': {
+            'seconds': lambda_seconds,
+            'memoryMb': MODEL_BASE_MEMORY_MB + chunk_size * lambda_model['memoryMbPerRecord'],
+            'costUsd': lambda_seconds * LAMBDA_MEMORY_MB / 1024 * LAMBDA_GB_SECOND_PRICE,
+            'fits': chunk_size <= lambda_capacity
+        },
+        'batch': {
+            'seconds': batch_seconds,
+            'memoryMb': MODEL_BASE_MEMORY_MB + chunk_size * batch_model['memoryMbPerRecord'],
+            'costUsd': batch_seconds * BATCH_JOB_VCPUS * BATCH_VCPU_SECOND_PRICE,
+            'fits': True
+        }
+    }
+
+def choose_executor(prediction: Dict[str, Dict[str, Any]]) -> str:
+    """Pick the executor with the lowest cost plus weighted latency among those that fit"""
+    candidates = [name for name, predicted in prediction.items() if predicted['fits']]
+    return min(candidates, key=lambda name: prediction[name]['costUsd'] + LATENCY_COST_PER_SECOND * prediction[name]['seconds'])
+
+def chunk_size_candidates(min_size: int, max_size: int, steps: int = CHUNK_SIZE_CANDIDATES) -> List[int]:
+    """Chunk sizes spaced geometrically from min_size to max_size, both included"""
+    min_size = max(1, min(min_size, max_size))
+    if steps < 2 or min_size == max_size:
+        return sorted({min_size, max_size})
+    ratio = (max_size / min_size) ** (1 / (steps - 1))
+    return sorted({min_size, max_size} | {round(min_size * ratio ** step) for step in range(1, steps - 1)})
+
+def predict_plan(total_records: int, chunk_size: int, max_concurrent: int, model: Dict[str, Any],
+                 lambda_capacity: int) -> Dict[str, Any]:
+    """Predicted cost and makespan of splitting the batch into chunks of chunk_size"""
+    chunk_count = math.ceil(total_records / chunk_size)
+    last_size = total_records - (chunk_count - 1) * chunk_size
+    full, last = predict_chunk(chunk_size, model, lambda_capacity), predict_chunk(last_size, model, lambda_capacity)
+    full_choice, last_choice = full[choose_executor(full)], last[choose_executor(last)]
+    return {
+        'chunkSize': chunk_size,
+        'chunkCount': chunk_count,
+        'costUsd': full_choice['costUsd'] * (chunk_count - 1) + last_choice['costUsd'],
+        'makespanSeconds': math.ceil(chunk_count / max_concurrent) * max(full_choice['seconds'], last_choice['seconds'])
+    }
+
+def calculate_optimal_chunk_size(total_records: int, max_concurrent: int, max_chunk_size: int,
+                                 model: Optional[Dict[str, Any]] = None, min_chunk_size: int = MIN_CHUNK_SIZE,
+                                 deadline_seconds: float = BATCH_DEADLINE_SECONDS) -> tuple:
+    """Calculate optimal chunk size based on total records, concurrency and the throughput model.
+
+    Chunk sizes spaced geometrically between min_chunk_size and max_chunk_size are planned
+    with per-chunk routing, together with the concurrency-based size and the Lambda capacity.
+    With a deadline the cheapest plan whose predicted makespan meets it wins, or the fastest
+    plan when none does. Without one the lowest cost plus weighted makespan wins.
+    """
+    # Start with max concurrent chunks, capped at the maximum chunk size
+    base_size = min(math.ceil(total_records / max_concurrent), max_chunk_size)
+    if model is None:
+        final_chunks = math.ceil(total_records / base_size)
+        logger.info(f"Optimal chunk size: {base_size:,}, total chunks: {final_chunks}")
+        return base_size, final_chunks
+    
+    lambda_capacity = calculate_lambda_capacity(model)
+    largest = max(1, min(max_chunk_size, total_records))
+    sizes = set(chunk_size_candidates(min_chunk_size, largest))
+    sizes.update(size for size in (base_size, lambda_capacity) if size <= largest)
+    plans = [predict_plan(total_records, size, max_concurrent, model, lambda_capacity) for size in sorted(sizes)]
+    
+    on_time = [plan for plan in plans if plan['makespanSeconds'] <= deadline_seconds] if deadline_seconds > 0 else []
+    if on_time:
+        best = min(on_time, key=lambda plan: (plan['costUsd'], plan['makespanSeconds']))
+    elif deadline_seconds > 0:
+        best = min(plans, key=lambda plan: (plan['makespanSeconds'], plan['costUsd']))
+        logger.warning(f"No chunk size meets the {deadline_seconds:.0f}s deadline, "
+                       f"fastest plan takes {best['makespanSeconds']:.0f}s")
+    else:
+        best = min(plans, key=lambda plan: plan['costUsd'] + LATENCY_COST_PER_SECOND * plan['makespanSeconds'])
     
-    return chunk_size, final_chunks
+    logger.info(f"Optimal chunk size: {best['chunkSize']:,}, total chunks: {best['chunkCount']} "
+                f"(predicted cost ${best['costUsd']:.2f}, makespan {best['makespanSeconds']:.0f}s, "
+                f"{len(plans)} sizes from {plans[0]['chunkSize']:,} to {plans[-1]['chunkSize']:,}, "
+                f"Lambda capacity {lambda_capacity:,} records)")
+    return best['chunkSize'], best['chunkCount']
 
-def create_chunks(total_records: int, chunk_size: int, batch_id: str, 
-                 bucket: str, file_key: str, customer_id: str, tenant_id: str, destination: str) -> List[Dict[str, Any]]:
-    """Create chunk definitions for processing"""
+def create_chunks(total_records: int, chunk_size: int, model: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Create chunk definitions for processing.
+
+    Entries only hold the fields that change between chunks; the batch-wide fields
+    (bucket, file, customer, tenant, destination) live once in the plan header. With a
+    throughput model each entry also carries its executor and predicted duration.
+    """
     chunks = []
+    lambda_capacity = calculate_lambda_capacity(model) if model else None
+    predictions = {}
     
     for i in range(0, total_records, chunk_size):
-        chunk_id = f"chunk_{i//chunk_size:06d}"
         start_index = i
         end_index = min(i + chunk_size - 1, total_records - 1)
+        size = end_index - start_index + 1
         
         chunk = {
-            'chunkId': chunk_id,
+            'chunkId': f"chunk_{i//chunk_size:06d}",
             'startIndex': start_index,
             'endIndex': end_index,
-            'chunkSize': end_index - start_index + 1,
-            'bucket': bucket,
-            'file': file_key,
-            'customerId': customer_id,
-            'tenantId': tenant_id,
-            'batchId': batch_id,
-            'destination': destination,
-            'chunkNumber': len(chunks) + 1,
-            'estimatedProcessingTime': (end_index - start_index + 1) * 0.005,  # 5ms per record
-            'createdAt': datetime.now().isoformat()
+            'chunkSize': size
         }
+        if model:
+            if size not in predictions:
+                prediction = predict_chunk(size, model, lambda_capacity)
+                executor = choose_executor(prediction)
+                predictions[size] = (executor, prediction[executor])
+            executor, predicted = predictions[size]
+            chunk['executor'] = executor
+            chunk['predictedSeconds'] = round(predicted['seconds'], 1)
+            chunk['predictedMemoryMb'] = round(predicted['memoryMb'])
+            chunk['predictedCostUsd'] = round(predicted['costUsd'], 6)
         
         chunks.append(chunk)
     
     logger.info(f"Created {len(chunks)} chunks for {total_records:,} records")
     return chunks
 
-def upload_chunk_metadata(chunks: List[Dict[str, Any]], batch_id: str, bucket: str):
-    """Upload chunk metadata to S3"""
+def upload_chunk_plan(chunks: List[Dict[str, Any]], batch_id: str, bucket: str,
+                      batch_fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Upload the chunk plan as a JSONL manifest plus a small header, and return the manifest reference"""
     try:
-        metadata = {
-            'batchId': batch_id,
+        manifest_key = f"metadata/{batch_id}/chunk-plan.jsonl"
+        body = ''.join(json.dumps(chunk, separators=(',', ':')) + '\n' for chunk in chunks)
+        s3_io.upload_bytes(bucket, manifest_key, body.encode('utf-8'), {'ContentType': 'application/x-ndjson'})
+        
+        chunk_manifest = {
+            'bucket': bucket,
+            'key': manifest_key,
+            'format': 'jsonl',
             'totalChunks': len(chunks),
-            'totalRecords': sum(chunk['chunkSize'] for chunk in chunks),
-            'chunks': chunks,
-            'createdAt': datetime.now().isoformat(),
-            'metadataVersion': '1.0'
+            'totalRecords': sum(chunk['chunkSize'] for chunk in chunks)
         }
         
         metadata_key = f"metadata/{batch_id}/chunks.json"
         s3_client.put_object(
             Bucket=bucket,
             Key=metadata_key,
-            Body=json.dumps(metadata, indent=2),
+            Body=json.dumps({
+                'batchId': batch_id,
+                'chunkFields': batch_fields,
+                'chunkManifest': chunk_manifest,
+                'createdAt': datetime.now().isoformat(),
+                'metadataVersion': '2.0'
+            }, indent=2),
             ContentType='application/json'
         )
         
-        logger.info(f"Uploaded chunk metadata to s3://{bucket}/{metadata_key}")
-        return metadata_key
+        logger.info(f"Uploaded chunk plan with {len(chunks)} chunks to s3://{bucket}/{manifest_key} ({len(body):,} bytes)")
+        return dict(chunk_manifest, metadataKey=metadata_key)
         
     except Exception as e:
-        logger.error(f"Error uploading chunk metadata: {str(e)}")
+        logger.error(f"Error uploading chunk plan: {str(e)}")
         raise
 
-def calculate_processing_estimates(chunks: List[Dict[str, Any]], max_concurrent: int) -> Dict[str, Any]:
-    """Calculate processing time and resource estimates"""
+def calculate_processing_estimates(chunks: List[Dict[str, Any]], max_concurrent: int,
+                                   model: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Calculate processing time and resource estimates from the per-chunk predictions"""
     total_records = sum(chunk['chunkSize'] for chunk in chunks)
     total_chunks = len(chunks)
     
-    # Calculate processing time estimates
-    total_processing_time = sum(chunk['estimatedProcessingTime'] for chunk in chunks)
+    # Calculate processing time estimates (5ms per record without predictions)
+    total_processing_time = sum(chunk.get('predictedSeconds', chunk['chunkSize'] * 0.005) for chunk in chunks)
     parallel_processing_time = total_processing_time / max_concurrent
     
     # Add buffer for overhead (20%)
@@ -126,7 +275,8 @@ def calculate_processing_estimates(chunks: List[Dict[str, Any]], max_concurrent:
     
     # Calculate resource requirements
     avg_chunk_size = total_records / total_chunks
-    memory_per_chunk = avg_chunk_size * 0.5  # 0.5KB per record
+    memory_per_record_kb = model['executors']['lambda']['memoryMbPerRecord'] * 1024 if model else 0.5
+    memory_per_chunk = avg_chunk_size * memory_per_record_kb
     total_memory = memory_per_chunk * max_concurrent
     
     estimates = {
@@ -142,11 +292,25 @@ def calculate_processing_estimates(chunks: List[Dict[str, Any]], max_concurrent:
         'chunksPerHour': (3600 / estimated_total_time) * total_chunks if estimated_total_time > 0 else 0
     }
     
+    if model:
+        estimates['routing'] = {
+            'lambdaChunks': sum(1 for chunk in chunks if chunk.get('executor') == 'lambda'),
+            'batchChunks': sum(1 for chunk in chunks if chunk.get('executor') == 'batch'),
+            'lambdaCapacity': calculate_lambda_capacity(model),
+            'predictedCostUsd': sum(chunk.get('predictedCostUsd', 0) for chunk in chunks),
+            'modelSource': model['source'],
+            'modelKey': model['key'],
+            'executorModels': model['executors']
+        }
+    
     logger.info(f"Processing estimates: {json.dumps(estimates, indent=2)}")
     return estimates
 
+@stage_profiler.profiled('calculate-chunks')
 def lambda_handler(event, context):
     """Main Lambda handler for calculating chunks"""
+    start_time = time.time()
+    metrics = stage_metrics.StageMetrics.for_event('calculate-chunks', event)
     try:
         # Validate input
         error = validate_input(event)
@@ -165,36 +329,47 @@ def lambda_handler(event, context):
         # Get configuration from environment or use defaults
         max_concurrent_chunks = int(event.get('maxConcurrentChunks', 50))
         max_chunk_size = int(event.get('maxChunkSize', 500000))
-        target_total_records = int(event.get('targetTotalRecords', 60000000))
+        min_chunk_size = int(event.get('minChunkSize', MIN_CHUNK_SIZE))
+        deadline_seconds = float(event.get('deadlineSeconds', BATCH_DEADLINE_SECONDS))
+        target_total_records = int(event.get('targetTotalRecords') or 0)
         
         logger.info(f"Starting chunk calculation for batch {batch_id}")
         logger.info(f"Configuration: max_concurrent={max_concurrent_chunks}, max_chunk_size={max_chunk_size:,}")
         
-        # Get file size and estimate records
-        file_size, estimated_records = get_file_size_and_estimate_records(bucket, file_key)
+        # Get file size, and estimate records when no target was given (read-s3 passes its estimate)
+        file_size, record_estimate = get_file_size_and_estimate_records(bucket, file_key, target_total_records <= 0)
         
         # Use target total records if provided, otherwise use estimated
-        total_records = target_total_records if target_total_records > 0 else estimated_records
+        total_records = target_total_records if target_total_records > 0 else max(1, record_estimate['records'])
+        
+        # Get destination from environment or use default
+        destination = event.get('destination', 'kafka')
+        
+        # Size and route chunks from measured throughput of past runs
+        model = load_performance_model(bucket, tenant_id, destination)
         
         # Calculate optimal chunk size
         chunk_size, total_chunks = calculate_optimal_chunk_size(
-            total_records, max_concurrent_chunks, max_chunk_size
+            total_records, max_concurrent_chunks, max_chunk_size, model,
+            min_chunk_size=min_chunk_size, deadline_seconds=deadline_seconds
         )
         
-        # Get destination from environment or use default
-        destination = event.get('destination', 'kafka')
-        
         # Create chunks
-        chunks = create_chunks(
-            total_records, chunk_size, batch_id, 
-            bucket, file_key, customer_id, tenant_id, destination
-        )
+        chunks = create_chunks(total_records, chunk_size, model)
         
-        # Upload chunk metadata
-        metadata_key = upload_chunk_metadata(chunks, batch_id, bucket)
+        # Upload the chunk plan; the Map state reads its items from the manifest
+        chunk_manifest = upload_chunk_plan(chunks, batch_id, bucket, {
+            'bucket': bucket,
+            'file': file_key,
+            'customerId': customer_id,
+            'tenantId': tenant_id,
+            'batchId': batch_id,
+            'destination': destination
+        })
+        metadata_key = chunk_manifest.pop('metadataKey')
         
         # Calculate processing estimates
-        estimates = calculate_processing_estimates(chunks, max_concurrent_chunks)
+        estimates = calculate_processing_estimates(chunks, max_concurrent_chunks, model)
         
         # Prepare response
         response = {
@@ -205,16 +380,20 @@ def lambda_handler(event, context):
             'deployment': deployment,
             'bucket': bucket,
             'file': file_key,
+            'destination': destination,
             'batchStatus': 'CHUNKS_CALCULATED',
-            'chunks': chunks,
+            'chunkManifest': chunk_manifest,
             'metadataKey': metadata_key,
             'estimates': estimates,
             'configuration': {
                 'maxConcurrentChunks': max_concurrent_chunks,
                 'maxChunkSize': max_chunk_size,
+                'minChunkSize': min_chunk_size,
+                'deadlineSeconds': deadline_seconds,
                 'chunkSize': chunk_size,
                 'totalChunks': total_chunks,
-                'totalRecords': total_records
+                'totalRecords': total_records,
+                'recordEstimate': record_estimate
             },
             'progress': {
                 'stage': 'CHUNKS_CALCULATED',
@@ -228,6 +407,12 @@ def lambda_handler(event, context):
             }
         }
         
+        metrics.increment('ChunksPlanned', total_chunks)
+        metrics.increment('RecordsPlanned', total_records)
+        metrics.increment('InputBytes', file_size, stage_metrics.BYTES)
+        for executor in ('lambda', 'batch'):
+            metrics.increment(f"{executor.title()}Chunks", sum(1 for chunk in chunks if chunk.get('executor', 'lambda') == executor))
+        
         logger.info(f"Chunk calculation completed successfully for batch {batch_id}")
         logger.info(f"Created {total_chunks} chunks for {total_records:,} records")
         
@@ -235,11 +420,15 @@ def lambda_handler(event, context):
         
     except Exception as e:
         logger.error(f"Error in chunk calculation: {str(e)}")
+        metrics.increment('Errors')
         return create_error(f"Chunk calculation failed: {str(e)}", 
                           event.get('batchId', 'unknown'),
                           event.get('customerId', 'unknown'),
                           event.get('tenantId', 'unknown'),
                           event.get('deployment', 'unknown'))
+    finally:
+        metrics.record('Duration', (time.time() - start_time) * 1000)
+        metrics.flush()
 
 def create_error(error_message: str, batch_id: str = "unknown", 
                 customer_id: str = "unknown", tenant_id: str = "unknown", 
@@ -1,13 +1,30 @@
 import json
-import boto3
+import base64
+import bisect
+import gzip
+import hashlib
 import logging
+import struct
+import time
 from datetime import datetime
 
+import s3_io
+import stage_metrics
+import stage_profiler
+import validation_cache
+
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client('s3')
+s3_client = s3_io.get_client('s3')
+
+# Manifest index sections and fences cached across warm invocations, keyed by (bucket, batchId)
+_record_index_cache = {}
+
+# Validation error retrieval page sizes
+VALIDATION_ERRORS_DEFAULT_LIMIT = 100
+VALIDATION_ERRORS_MAX_LIMIT = 1000
 
 def validate_input(event):
     """Validate input parameters"""
@@ -18,32 +35,163 @@ def validate_input(event):
     return None
 
 def check_file_size(bucket, file):
-    """Check file size and estimate records"""
+    """Check file size and ETag"""
     try:
         head = s3_client.head_object(Bucket=bucket, Key=file)
-        file_size = head['ContentLength']
-        
-        # Estimate records based on file size (rough estimate: 1KB per record)
-        estimated_records = max(1000000, file_size // 1024)
-        
-        logger.info(f"File size: {file_size:,} bytes, estimated records: {estimated_records:,}")
-        return file_size, estimated_records
+        return head['ContentLength'], head['ETag'].strip('"')
         
     except Exception as e:
         logger.error(f"Error checking file size: {str(e)}")
         return None, None
 
-def get_validation_errors(bucket, batch_id):
-    """Retrieve validation errors from S3"""
+def estimate_records(bucket, file, file_size):
+    """Estimate records from the newline density of a few ranged samples of the file"""
+    try:
+        estimate = s3_io.estimate_line_count(bucket, file, file_size)
+    except Exception as e:
+        # Rough estimate: 1KB per record
+        logger.warning(f"Could not sample {file} for a record estimate: {str(e)}")
+        estimate = {'records': file_size // 1024, 'errorBound': None, 'method': 'size'}
+    
+    logger.info(f"File size: {file_size:,} bytes, estimated records: {estimate['records']:,}")
+    return estimate
+
+def get_cached_validation(bucket, file, etag, event):
+    """The cached validation verdict for this version of the file, or None"""
+    entry = validation_cache.load(bucket, file, etag, validation_cache.validation_options(event))
+    if entry is None:
+        return None
+    results = entry['results']
+    # Early-abort verdicts are cached without a line index, their record count is only a sample
+    line_index = entry.get('lineIndex') or {}
+    return {
+        'cached': True,
+        'cacheKey': entry['cacheKey'],
+        'cachedAt': entry['cachedAt'],
+        'sourceBatchId': entry['batchId'],
+        'status': results.get('status'),
+        'batchStatus': results.get('batchStatus'),
+        'errorMessage': results.get('errorMessage'),
+        'recordsProcessed': line_index.get('records'),
+        'recordsFailed': results.get('recordsFailed'),
+        'errorRate': results.get('errorRate')
+    }
+
+def encode_page_token(code, offset):
+    """Opaque continuation token: the error code and the offset within that code"""
+    return base64.urlsafe_b64encode(json.dumps([code, offset]).encode('utf-8')).decode('ascii')
+
+def decode_page_token(page_token):
     try:
+        code, offset = json.loads(base64.urlsafe_b64decode(page_token.encode('ascii')))
+        return code, int(offset)
+    except Exception:
+        raise ValueError(f"Invalid pageToken: {page_token}")
+
+def parse_error_query(event):
+    """pageToken, limit and error code filter of a validation error retrieval request"""
+    limit = min(max(int(event.get('limit') or VALIDATION_ERRORS_DEFAULT_LIMIT), 1), VALIDATION_ERRORS_MAX_LIMIT)
+    codes = event.get('codes') or event.get('code')
+    if isinstance(codes, str):
+        codes = [code.strip() for code in codes.split(',') if code.strip()]
+    return event.get('pageToken'), limit, set(codes) if codes else None
+
+def load_error_index(bucket, batch_id):
+    """The validation error page index, or None for results written before errors were paged"""
+    return s3_io.get_json(bucket, f"validation/{batch_id}/errors/index.json")
+
+def iter_error_page(bucket, key, skip):
+    """Stream the errors of one page, downloading no more of it than is consumed"""
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    try:
+        with gzip.GzipFile(fileobj=body) as lines:
+            for number, line in enumerate(lines):
+                if number >= skip:
+                    yield json.loads(line)
+    finally:
+        body.close()
+
+def read_error_pages(bucket, index, page_token, limit, codes):
+    """Up to limit errors of the selected codes, code by code, and the token that continues after them"""
+    selected = [code for code in index['codes'] if not codes or code in codes]
+    if not selected:
+        return [], None
+    code, offset = decode_page_token(page_token) if page_token else (selected[0], 0)
+    if code not in selected:
+        raise ValueError(f"pageToken does not match the code filter: {code}")
+    
+    errors = []
+    for position in range(selected.index(code), len(selected)):
+        code = selected[position]
+        total = index['codes'][code]['errors']
+        while offset < total and len(errors) < limit:
+            page, skip = divmod(offset, index['pageSize'])
+            page_errors = iter_error_page(bucket, index['pageKey'].format(code=code, page=page), skip)
+            read = 0
+            try:
+                for error in page_errors:
+                    errors.append(error)
+                    read += 1
+                    if len(errors) >= limit:
+                        break
+            finally:
+                page_errors.close()
+            if not read:
+                break
+            offset += read
+        if len(errors) >= limit:
+            if offset < total:
+                return errors, encode_page_token(code, offset)
+            if position + 1 < len(selected):
+                return errors, encode_page_token(selected[position + 1], 0)
+            return errors, None
+        offset = 0
+    return errors, None
+
+def read_legacy_errors(validation_results, page_token, limit, codes):
+    """Page through the sampled errors of a results document that has no error pages"""
+    errors = [error for error in validation_results.get('validationErrors', [])
+              if not codes or error.get('code') in codes]
+    _, offset = decode_page_token(page_token) if page_token else (None, 0)
+    next_token = encode_page_token(None, offset + limit) if offset + limit < len(errors) else None
+    return errors[offset:offset + limit], len(errors), next_token
+
+def load_validation_page(bucket, batch_id, page_token, limit, codes):
+    """Validation results without sampled records, plus one page of errors.
+
+    Reads the small error page index and only the pages the request covers; batches
+    validated before errors were paged fall back to the full results document.
+    """
+    index = load_error_index(bucket, batch_id)
+    if index is None:
         validation_key = f"validation/{batch_id}/validation-results.json"
         response = s3_client.get_object(Bucket=bucket, Key=validation_key)
         validation_results = json.loads(response['Body'].read().decode('utf-8'))
+        errors, total_errors, next_token = read_legacy_errors(validation_results, page_token, limit, codes)
+    else:
+        validation_results = dict(index['results'])
+        errors, next_token = read_error_pages(bucket, index, page_token, limit, codes)
+        total_errors = sum(code_info['errors'] for code, code_info in index['codes'].items()
+                           if not codes or code in codes)
+    validation_results.update({
+        'validationErrors': errors,
+        'matchingErrors': total_errors,
+        'nextPageToken': next_token
+    })
+    return validation_results
+
+def get_validation_errors(bucket, batch_id, page_token=None, limit=VALIDATION_ERRORS_DEFAULT_LIMIT, codes=None):
+    """Retrieve one page of validation errors from S3, optionally filtered by error code"""
+    try:
+        validation_results = load_validation_page(bucket, batch_id, page_token, limit, codes)
         
         return {
             'errorMessage': validation_results.get('errorMessage', 'Validation failed'),
-            'validationErrors': validation_results.get('validationErrors', []),
-            'validationSummary': validation_results.get('validationSummary', {})
+            'validationErrors': validation_results['validationErrors'],
+            'validationSummary': validation_results.get('validationSummary', {}),
+            'errorCodes': validation_results.get('errorCodes', {}),
+            'matchingErrors': validation_results['matchingErrors'],
+            'nextPageToken': validation_results['nextPageToken']
         }
         
     except Exception as e:
@@ -54,12 +202,10 @@ def get_validation_errors(bucket, batch_id):
             'validationSummary': {}
         }
 
-def get_validation_results(bucket, batch_id):
-    """Retrieve validation results from S3"""
+def get_validation_results(bucket, batch_id, page_token=None, limit=VALIDATION_ERRORS_DEFAULT_LIMIT, codes=None):
+    """Retrieve validation results from S3 with one page of validation errors"""
     try:
-        validation_key = f"validation/{batch_id}/validation-results.json"
-        response = s3_client.get_object(Bucket=bucket, Key=validation_key)
-        validation_results = json.loads(response['Body'].read().decode('utf-8'))
+        validation_results = load_validation_page(bucket, batch_id, page_token, limit, codes)
         
         logger.info(f"Retrieved validation results for batch {batch_id}")
         logger.info(f"Validation status: {validation_results.get('status')}")
@@ -81,8 +227,93 @@ def get_validation_results(bucket, batch_id):
             }
         }
 
+def read_range(bucket, key, offset, length):
+    """Read a byte range of an S3 object"""
+    return s3_io.read_range(bucket, key, offset, length)
+
+def load_record_index(bucket, batch_id):
+    """Load the manifest and index fence for a batch (cached per container)"""
+    cache_key = (bucket, batch_id)
+    if cache_key not in _record_index_cache:
+        manifest_key = f"final-results/{batch_id}/manifest.json"
+        manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=manifest_key)['Body'].read().decode('utf-8'))
+        index_info = manifest.get('index')
+        if not index_info:
+            raise ValueError(f"No record index for batch {batch_id}")
+        
+        fence_data = s3_client.get_object(Bucket=bucket, Key=index_info['fenceKey'])['Body'].read()
+        _record_index_cache[cache_key] = {
+            'index': index_info,
+            'entry': struct.Struct(index_info['entryFormat']),
+            'fence': list(struct.unpack(f">{len(fence_data) // 8}Q", fence_data)),
+            'shards': {shard['shardNumber']: shard['key'] for shard in manifest['shards']},
+            'compression': manifest.get('compression', 'none')
+        }
+    return _record_index_cache[cache_key]
+
+def find_index_entries(bucket, index, key_hash):
+    """Binary search the fence, then range-read the index block that may hold key_hash"""
+    entry = index['entry']
+    fence = index['fence']
+    interval = index['index']['fenceInterval']
+    total_entries = index['index']['entries']
+    
+    # Equal hashes may straddle a fence boundary, so start one block earlier when the hash sits on it
+    block = max(0, bisect.bisect_left(fence, key_hash) - 1)
+    first = block * interval
+    count = min(total_entries - first, interval * (2 if block + 1 < len(fence) else 1))
+    if count <= 0:
+        return []
+    
+    data = read_range(bucket, index['index']['key'], first * entry.size, count * entry.size)
+    entries = list(entry.iter_unpack(data))
+    position = bisect.bisect_left(entries, (key_hash,))
+    matches = []
+    while position < len(entries) and entries[position][0] == key_hash:
+        matches.append(entries[position])
+        position += 1
+    return matches
+
+def lookup_record(bucket, batch_id, key):
+    """Find a single record of a finished batch by id, originalId or gssId"""
+    try:
+        index = load_record_index(bucket, batch_id)
+        key_hash = int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(), 'big')
+        
+        for _, shard, block_offset, block_length, line_offset, line_length in find_index_entries(bucket, index, key_hash):
+            block = read_range(bucket, index['shards'][shard], block_offset, block_length)
+            if index['compression'] == 'gzip':
+                block = gzip.decompress(block)
+            record = json.loads(block[line_offset:line_offset + line_length])
+            
+            # Guard against hash collisions by checking the indexed fields
+            if any(str(record.get(field)) == str(key) for field in index['index']['keyFields']):
+                return {
+                    'batchId': batch_id,
+                    'found': True,
+                    'record': record,
+                    'location': {'shard': index['shards'][shard], 'blockOffset': block_offset}
+                }
+        
+        return {'batchId': batch_id, 'found': False, 'key': key}
+        
+    except Exception as e:
+        logger.error(f"Error looking up record {key}: {str(e)}")
+        return {
+            'batchId': batch_id,
+            'found': False,
+            'key': key,
+            'errorMessage': f"Error looking up record: {str(e)}"
+        }
+
+@stage_profiler.profiled('initialize')
 def lambda_handler(event, context):
     """Initialize batch processing or retrieve validation errors/results"""
+    start_time = time.time()
+    action = event.get('action') if isinstance(event, dict) else None
+    metrics = stage_metrics.StageMetrics.for_event('read-s3' if action else 'initialize', event)
+    if action:
+        metrics.set_property('action', action)
     try:
         # Check if this is a validation error retrieval request
         if event.get('action') == 'getValidationErrors':
@@ -90,7 +321,7 @@ def lambda_handler(event, context):
             batch_id = event['batchId']
             
             logger.info(f"Retrieving validation errors for batch {batch_id}")
-            return get_validation_errors(bucket, batch_id)
+            return get_validation_errors(bucket, batch_id, *parse_error_query(event))
         
         # Check if this is a validation results retrieval request
         if event.get('action') == 'getValidationResults':
@@ -98,7 +329,15 @@ def lambda_handler(event, context):
             batch_id = event['batchId']
             
             logger.info(f"Retrieving validation results for batch {batch_id}")
-            return get_validation_results(bucket, batch_id)
+            return get_validation_results(bucket, batch_id, *parse_error_query(event))
+        
+        # Check if this is a single record lookup request
+        if event.get('action') == 'lookupRecord':
+            bucket = event['bucket']
+            batch_id = event['batchId']
+            
+            logger.info(f"Looking up record {event['key']} in batch {batch_id}")
+            return lookup_record(bucket, batch_id, event['key'])
 
         # Normal initialization flow
         error = validate_input(event)
@@ -117,9 +356,25 @@ def lambda_handler(event, context):
         logger.info(f"BatchId: {batch_id}, CustomerId: {customer_id}, TenantId: {tenant_id}")
 
         # Check file size and estimate records
-        file_size, estimated_records = check_file_size(bucket, file)
+        file_size, etag = check_file_size(bucket, file)
         if file_size is None:
+            metrics.increment('Errors')
             return create_error("Error checking file size", batch_id, customer_id, tenant_id, deployment)
+        metrics.increment('InputBytes', file_size, stage_metrics.BYTES)
+        
+        # A file validated before unchanged comes with its verdict, and with its exact record
+        # count unless the verdict was reached on samples
+        cached_validation = get_cached_validation(bucket, file, etag, event)
+        if cached_validation:
+            logger.info(f"Cached validation verdict {cached_validation['status']} of batch "
+                        f"{cached_validation['sourceBatchId']}")
+            metrics.increment('ValidationCacheHits')
+        if cached_validation and cached_validation['recordsProcessed'] is not None:
+            record_estimate = {'records': cached_validation['recordsProcessed'], 'errorBound': 0, 'method': 'validation-cache'}
+        else:
+            record_estimate = estimate_records(bucket, file, file_size)
+        estimated_records = record_estimate['records']
+        metrics.increment('EstimatedRecords', estimated_records)
 
         # Get target total records from input or use estimated
         target_total_records = event.get('targetTotalRecords', estimated_records)
@@ -136,6 +391,9 @@ def lambda_handler(event, context):
             'targetTotalRecords': target_total_records,
             'estimatedFileSize': file_size,
             'estimatedRecords': estimated_records,
+            'recordEstimate': record_estimate,
+            'etag': etag,
+            'validation': cached_validation,
             'initializedAt': datetime.now().isoformat()
         }
         
@@ -144,7 +402,12 @@ def lambda_handler(event, context):
         
     except Exception as e:
         logger.error(f"Error in lambda_handler: {str(e)}")
+        metrics.increment('Errors')
         return create_error(f"Initialization error: {str(e)}", event.get('batchId', 'unknown'))
+    finally:
+        metrics.increment('Requests')
+        metrics.record('Duration', (time.time() - start_time) * 1000)
+        metrics.flush()
 
 def create_error(error_message, batch_id="unknown", customer_id="unknown", tenant_id="unknown", deployment="unknown"):
     """Create error response"""
@@ -1,14 +1,18 @@
 import json
-import boto3
 import logging
+import time
 from kafka import KafkaProducer
 from kafka.errors import KafkaError
 
+import s3_io
+import stage_metrics
+import stage_profiler
+
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3_client = boto3.client('s3')
+s3_client = s3_io.get_client('s3')
 
 def validate_input(event):
     """Validate input parameters"""
@@ -18,8 +22,11 @@ def validate_input(event):
         return f"Missing required fields: {', '.join(missing_fields)}"
     return None
 
+@stage_profiler.profiled('send-to-kafka')
 def lambda_handler(event, context):
     """Send batch completion notification to Kafka - lightweight summary only"""
+    start_time = time.time()
+    metrics = stage_metrics.StageMetrics.for_event('send-to-kafka', event)
     try:
         # Validate input parameters
         error = validate_input(event)
@@ -37,9 +44,10 @@ def lambda_handler(event, context):
         total_errors = event.get('totalErrors', 0)
         processing_time = event.get('processingTime', 0)
         final_result_key = event.get('finalResultKey', '')
+        record_encoding = event.get('recordEncoding', 'json')
         
         logger.info(f"Sending batch completion notification to Kafka for batch {batch_id}")
-        logger.info(f"Records processed: {total_records_processed:,}, Errors: {total_errors}")
+        logger.info(f"Records processed: {total_records_processed:,}, Errors: {total_errors}, Record encoding: {record_encoding}")
 
         # Initialize Kafka producer
         try:
@@ -73,30 +81,36 @@ def lambda_handler(event, context):
             },
             'resultLocation': {
                 'bucket': event.get('bucket', ''),
-                'key': final_result_key
+                'key': final_result_key,
+                'summaryKey': event.get('summaryKey', '')
             },
             'timestamp': event.get('completionTime', ''),
             'metadata': {
                 'source': 'batch-processing-workflow',
                 'version': '1.0',
-                'note': 'Individual records were sent to Kafka during processing (exclusive routing)'
+                'note': 'Individual records were sent to Kafka during processing (exclusive routing)',
+                'recordEncoding': record_encoding
             }
         }
 
         # Send notification to Kafka
         try:
-            future = producer.send(event.get('mskTopic', 'batch-notifications'), notification_message)
-            future.get(timeout=30)  # Wait for send to complete
+            with metrics.timer('SendLatency'):
+                future = producer.send(event.get('mskTopic', 'batch-notifications'), notification_message)
+                future.get(timeout=30)  # Wait for send to complete
+            metrics.increment('NotificationsSent')
             
             logger.info(f"Successfully sent batch completion notification to Kafka for batch {batch_id}")
             
         except KafkaError as ke:
             error_msg = f"Kafka error sending notification: {str(ke)}"
             logger.error(error_msg)
+            metrics.increment('SendErrors')
             return create_error(error_msg, batch_id, customer_id, tenant_id, deployment)
         except Exception as e:
             error_msg = f"Error sending notification to Kafka: {str(e)}"
             logger.error(error_msg)
+            metrics.increment('SendErrors')
             return create_error(error_msg, batch_id, customer_id, tenant_id, deployment)
         finally:
             producer.close()
@@ -115,11 +129,15 @@ def lambda_handler(event, context):
 
     except Exception as e:
         logger.error(f"Unexpected error in Kafka notification: {str(e)}")
+        metrics.increment('Errors')
         return create_error(f"Kafka notification failed: {str(e)}", 
                           event.get('batchId', 'unknown'),
                           event.get('customerId', 'unknown'),
                           event.get('tenantId', 'unknown'),
                           event.get('deployment', 'unknown'))
+    finally:
+        metrics.record('Duration', (time.time() - start_time) * 1000)
+        metrics.flush()
 
 def create_error(error_message, batch_id="unknown", customer_id="unknown", tenant_id="unknown", deployment="unknown"):
     """Create error response"""
@@ -1,12 +1,16 @@
 import json
-import boto3
 import logging
+import time
+
+import s3_io
+import stage_metrics
+import stage_profiler
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-sqs_client = boto3.client('sqs')
+sqs_client = s3_io.get_client('sqs')
 
 def validate_input(event):
     """Validate input parameters"""
@@ -16,8 +20,11 @@ def validate_input(event):
         return f"Missing required fields: {', '.join(missing_fields)}"
     return None
 
+@stage_profiler.profiled('send-to-sqs-core')
 def lambda_handler(event, context):
     """Send batch completion notification to SQS Core - lightweight summary only"""
+    start_time = time.time()
+    metrics = stage_metrics.StageMetrics.for_event('send-to-sqs-core', event)
     try:
         # Validate input parameters
         error = validate_input(event)
@@ -35,9 +42,10 @@ def lambda_handler(event, context):
         total_errors = event.get('totalErrors', 0)
         processing_time = event.get('processingTime', 0)
         final_result_key = event.get('finalResultKey', '')
+        record_encoding = event.get('recordEncoding', 'json')
         
         logger.info(f"Sending batch completion notification to SQS Core for batch {batch_id}")
-        logger.info(f"Records processed: {total_records_processed:,}, Errors: {total_errors}")
+        logger.info(f"Records processed: {total_records_processed:,}, Errors: {total_errors}, Record encoding: {record_encoding}")
 
         # Create summary notification message
         notification_message = {
@@ -57,21 +65,25 @@ def lambda_handler(event, context):
             },
             'resultLocation': {
                 'bucket': event.get('bucket', ''),
-                'key': final_result_key
+                'key': final_result_key,
+                'summaryKey': event.get('summaryKey', '')
             },
             'timestamp': event.get('completionTime', ''),
             'metadata': {
                 'source': 'batch-processing-workflow',
-                'version': '1.0'
+                'version': '1.0',
+                'recordEncoding': record_encoding
             }
         }
 
         # Send notification to SQS Core
         try:
-            response = sqs_client.send_message(
-                QueueUrl=event.get('sqsCoreQueue', ''),
-                MessageBody=json.dumps(notification_message)
-            )
+            with metrics.timer('SendLatency'):
+                response = sqs_client.send_message(
+                    QueueUrl=event.get('sqsCoreQueue', ''),
+                    MessageBody=json.dumps(notification_message)
+                )
+            metrics.increment('NotificationsSent')
             
             logger.info(f"Successfully sent batch completion notification to SQS Core for batch {batch_id}")
             logger.info(f"SQS Message ID: {response.get('MessageId', 'unknown')}")
@@ -79,6 +91,7 @@ def lambda_handler(event, context):
         except Exception as e:
             error_msg = f"Error sending notification to SQS Core: {str(e)}"
             logger.error(error_msg)
+            metrics.increment('SendErrors')
             return create_error(error_msg, batch_id, customer_id, tenant_id, deployment)
 
         # Return success response
@@ -96,11 +109,15 @@ def lambda_handler(event, context):
 
     except Exception as e:
         logger.error(f"Unexpected error in SQS Core notification: {str(e)}")
+        metrics.increment('Errors')
         return create_error(f"SQS Core notification failed: {str(e)}", 
                           event.get('batchId', 'unknown'),
                           event.get('customerId', 'unknown'),
                           event.get('tenantId', 'unknown'),
                           event.get('deployment', 'unknown'))
+    finally:
+        metrics.record('Duration', (time.time() - start_time) * 1000)
+        metrics.flush()
 
 def create_error(error_message, batch_id="unknown", customer_id="unknown", tenant_id="unknown", deployment="unknown"):
     """Create error response"""
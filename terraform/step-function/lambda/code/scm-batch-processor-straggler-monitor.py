@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import time
+import statistics
+import concurrent.futures
+from datetime import datetime
+from typing import Dict, List, Any, Optional
+
+import s3_io
+import stage_metrics
+import stage_profiler
+
+# Set up logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+s3_client = s3_io.get_client('s3')
+
+# Straggler detection
+STRAGGLER_FACTOR = float(os.environ.get('STRAGGLER_FACTOR', 2.0))  # projected finish vs peer median
+STRAGGLER_MIN_PEERS = int(os.environ.get('STRAGGLER_MIN_PEERS', 5))
+STRAGGLER_MIN_REMAINING_SECONDS = float(os.environ.get('STRAGGLER_MIN_REMAINING_SECONDS', 60))
+STRAGGLER_STALE_SECONDS = float(os.environ.get('STRAGGLER_STALE_SECONDS', 120))  # no heartbeat for this long
+STRAGGLER_MAX_SPECULATIVE = int(os.environ.get('STRAGGLER_MAX_SPECULATIVE', 10))  # per batch
+CHUNK_LOST_SECONDS = float(os.environ.get('CHUNK_LOST_SECONDS', 600))  # no heartbeat from any attempt for this long
+MONITOR_MAX_SECONDS = float(os.environ.get('MONITOR_MAX_SECONDS', 6 * 3600))
+CHUNK_FUNCTION_NAME = os.environ.get('CHUNK_FUNCTION_NAME', 'scm-batch-processor-update-records')
+SPECULATIVE_ATTEMPT = 'speculative-1'
+
+def validate_input(event):
+    """Validate input parameters"""
+    chunk_config = event.get('chunkConfig') if isinstance(event, dict) else None
+    if not chunk_config or not chunk_config.get('bucket') or not chunk_config.get('batchId'):
+        return "Input must include chunkConfig with bucket and batchId"
+    return None
+
+def list_chunk_ids(bucket: str, prefix: str) -> List[str]:
+    """File names (without .json) of the objects under a prefix"""
+    names = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            names.append(obj['Key'][len(prefix):].rsplit('.json', 1)[0])
+    return names
+
+def load_heartbeats(bucket: str, batch_id: str, chunk_ids: List[str]) -> List[Dict[str, Any]]:
+    """Read the heartbeat of each chunk attempt"""
+    def load(chunk_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            return s3_io.get_json(bucket, f"heartbeats/{batch_id}/{chunk_id}.json")
+        except Exception as e:
+            logger.warning(f"Could not read heartbeat for chunk {chunk_id}: {str(e)}")
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=s3_io.S3_IO_THREADS) as executor:
+        return [heartbeat for heartbeat in executor.map(load, chunk_ids) if heartbeat]
+
+def project_chunk(heartbeat: Dict[str, Any], now: float) -> Dict[str, Any]:
+    """Projected seconds until a running chunk finishes at its current rate"""
+    remaining = heartbeat['totalRecords'] - heartbeat['offset']
+    rate = heartbeat.get('recordsPerSecond', 0)
+    stale = now - heartbeat['updatedAt'] > STRAGGLER_STALE_SECONDS
+    return {
+        'chunkId': heartbeat['chunkId'],
+        'remainingRecords': remaining,
+        'recordsPerSecond': rate,
+        'stale': stale,
+        'projectedSeconds': remaining / rate if rate > 0 and not stale else float('inf')
+    }
+
+def find_stragglers(heartbeats: List[Dict[str, Any]], now: float) -> List[Dict[str, Any]]:
+    """Running chunks projected to finish much later than their peers.
+
+    A chunk only counts as a straggler when a fresh copy, resuming from the chunk's last
+    durable offset at the peers' median rate, is expected to finish before it.
+    """
+    projections = [project_chunk(heartbeat, now) for heartbeat in heartbeats]
+    peers = [projection for projection in projections if projection['projectedSeconds'] != float('inf')]
+    if len(peers) < STRAGGLER_MIN_PEERS:
+        return []
+
+    peer_seconds = statistics.median(projection['projectedSeconds'] for projection in peers)
+    peer_rate = statistics.median(projection['recordsPerSecond'] for projection in peers)
+
+    stragglers = []
+    for heartbeat, projection in zip(heartbeats, projections):
+        projected = projection['projectedSeconds']
+        if projected < STRAGGLER_MIN_REMAINING_SECONDS or projected < peer_seconds * STRAGGLER_FACTOR:
+            continue
+        copy_seconds = (heartbeat['totalRecords'] - heartbeat['forkOffset']) / peer_rate
+        if copy_seconds >= projected:
+            continue
+        stragglers.append(dict(projection, copySeconds=copy_seconds, peerSeconds=peer_seconds))
+
+    return sorted(stragglers, key=lambda straggler: straggler['projectedSeconds'], reverse=True)
+
+def is_map_done(bucket: str, batch_id: str) -> bool:
+    """Whether the Map branch has written its done marker, i.e. every chunk has returned"""
+    try:
+        return s3_io.get_json(bucket, f"map-done/{batch_id}.json") is not None
+    except Exception as e:
+        logger.warning(f"Could not read the Map done marker for batch {batch_id}: {str(e)}")
+        return False
+
+def launch_speculative_attempt(bucket: str, batch_id: str, heartbeat: Dict[str, Any]) -> bool:
+    """Start a copy of a straggling chunk from its last durable offset, at most once per chunk"""
+    marker_key = f"speculation/{batch_id}/{heartbeat['chunkId']}.json"
+    marker = json.dumps({'attempt': SPECULATIVE_ATTEMPT, 'forkOffset': heartbeat['forkOffset'],
+                         'launchedAt': time.time()})
+    if not s3_io.put_if_absent(bucket, marker_key, marker.encode('utf-8'), {'ContentType': 'application/json'}):
+        return False
+
+    event = dict(heartbeat['event'], attempt=SPECULATIVE_ATTEMPT)
+    try:
+        s3_io.get_client('lambda').invoke(
+            FunctionName=CHUNK_FUNCTION_NAME,
+            InvocationType='Event',
+            Payload=json.dumps(event, default=str).encode('utf-8')
+        )
+    except Exception as e:
+        # Without the marker the chunk is not counted as speculating and can be tried again next poll
+        logger.warning(f"Could not start a speculative attempt of chunk {heartbeat['chunkId']}: {str(e)}")
+        s3_io.get_client('s3').delete_object(Bucket=bucket, Key=marker_key)
+        return False
+    return True
+
+@stage_profiler.profiled('straggler-monitor')
+def lambda_handler(event, context):
+    """Poll chunk heartbeats and speculatively re-run stragglers until every chunk is settled.
+
+    A chunk is settled once it is committed, its attempts reported failure, or no attempt has
+    written a heartbeat for CHUNK_LOST_SECONDS. Monitoring also ends once the Map branch has
+    written its done marker and no speculative attempt is still running, which covers chunks
+    that failed without a heartbeat and chunks that ran on Batch.
+    """
+    metrics = stage_metrics.StageMetrics('straggler-monitor')
+    try:
+        # Validate input
+        error = validate_input(event)
+        if error:
+            return create_error(error)
+
+        chunk_config = event['chunkConfig']
+        bucket = chunk_config['bucket']
+        batch_id = chunk_config['batchId']
+        total_chunks = chunk_config.get('configuration', {}).get('totalChunks', 0)
+        metrics.set_dimensions(batch_id, chunk_config.get('tenantId'))
+        state = event.get('monitor') or {'startedAt': time.time(), 'polls': 0, 'speculativeAttempts': 0}
+        now = time.time()
+
+        committed = set(list_chunk_ids(bucket, f"commits/{batch_id}/"))
+        speculated = set(list_chunk_ids(bucket, f"speculation/{batch_id}/"))
+        # Speculative attempts write heartbeats as {chunkId}.{attempt}.json next to the primary's
+        attempts = [name for name in list_chunk_ids(bucket, f"heartbeats/{batch_id}/")
+                    if name.split('.', 1)[0] not in committed]
+        heartbeats = load_heartbeats(bucket, batch_id, attempts)
+        primaries = [heartbeat for heartbeat in heartbeats if heartbeat['attempt'] != SPECULATIVE_ATTEMPT]
+        # A speculative attempt still beating keeps its chunk open even if the primary failed or went quiet
+        speculating = {heartbeat['chunkId'] for heartbeat in heartbeats
+                       if heartbeat['attempt'] == SPECULATIVE_ATTEMPT and heartbeat['state'] == 'running'
+                       and now - heartbeat['updatedAt'] <= CHUNK_LOST_SECONDS}
+        lost = [heartbeat for heartbeat in primaries if heartbeat['state'] == 'running'
+                and now - heartbeat['updatedAt'] > CHUNK_LOST_SECONDS and heartbeat['chunkId'] not in speculating]
+        running = [heartbeat for heartbeat in primaries if heartbeat['state'] == 'running' and heartbeat not in lost]
+        failed = [heartbeat for heartbeat in primaries
+                  if heartbeat['state'] == 'failed' and heartbeat['chunkId'] not in speculating]
+
+        launched = []
+        budget = STRAGGLER_MAX_SPECULATIVE - len(speculated)
+        by_chunk = {heartbeat['chunkId']: heartbeat for heartbeat in running}
+        for straggler in find_stragglers(running, now):
+            if budget <= 0:
+                break
+            if straggler['chunkId'] in speculated:
+                continue
+            if launch_speculative_attempt(bucket, batch_id, by_chunk[straggler['chunkId']]):
+                logger.info(f"Speculating chunk {straggler['chunkId']}: projected {straggler['projectedSeconds']:.0f}s, "
+                            f"peers {straggler['peerSeconds']:.0f}s, copy {straggler['copySeconds']:.0f}s")
+                launched.append(straggler['chunkId'])
+                budget -= 1
+
+        settled = len(committed) + len(failed) + len(lost)
+        map_done = is_map_done(bucket, batch_id)
+        done = ((total_chunks > 0 and settled >= total_chunks) or (map_done and not speculating)
+                or now - state['startedAt'] > MONITOR_MAX_SECONDS)
+
+        metrics.gauge('ChunksCommitted', len(committed))
+        metrics.gauge('ChunksRunning', len(running))
+        metrics.gauge('ChunksFailed', len(failed))
+        metrics.gauge('ChunksLost', len(lost))
+        metrics.increment('SpeculativeAttemptsLaunched', len(launched))
+        
+        logger.info(f"Batch {batch_id}: {len(committed)}/{total_chunks} chunks committed, {len(running)} running, "
+                    f"{len(failed)} failed, {len(lost)} lost, {len(launched)} speculative attempts started"
+                    + (", Map branch done" if map_done else ""))
+
+        return {
+            'done': done,
+            'startedAt': state['startedAt'],
+            'polls': state['polls'] + 1,
+            'committedChunks': len(committed),
+            'runningChunks': len(running),
+            'failedChunks': len(failed),
+            'lostChunks': len(lost),
+            'mapDone': map_done,
+            'speculativeAttempts': len(speculated) + len(launched),
+            'launched': launched,
+            'lastPollAt': datetime.fromtimestamp(now).isoformat()
+        }
+
+    except Exception as e:
+        logger.error(f"Error in straggler monitoring: {str(e)}")
+        metrics.increment('Errors')
+        return create_error(f"Straggler monitoring failed: {str(e)}")
+    finally:
+        metrics.flush()
+
+def create_error(error_message: str):
+    """Create error response; monitoring stops but the batch carries on"""
+    return {
+        'done': True,
+        'errorMessage': error_message,
+        'errorTime': datetime.now().isoformat()
+    }
@@ -1,19 +1,577 @@
 import json
-import boto3
 import uuid
 import logging
 import time
 import os
+import base64
+import io
+import struct
+import queue
+import threading
+import zlib
+from itertools import islice
+from collections import defaultdict
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Iterator, Tuple
 from botocore.exceptions import ClientError
 
+import s3_io
+import spill_buffer
+import stage_memory
+import stage_metrics
+import stage_profiler
+
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Initialize AWS clients
-s3 = boto3.client('s3')
+s3 = s3_io.get_client('s3')
+
+STREAM_READ_CHUNK_SIZE = 1024 * 1024
+
+# Pipeline mode configuration
+PIPELINE_TRANSFORM_WORKERS = int(os.environ.get('PIPELINE_TRANSFORM_WORKERS', 2))
+PIPELINE_SENDER_THREADS = int(os.environ.get('PIPELINE_SENDER_THREADS', 4))
+PIPELINE_QUEUE_DEPTH = int(os.environ.get('PIPELINE_QUEUE_DEPTH', 8))
+PIPELINE_BLOCK_SIZE = int(os.environ.get('PIPELINE_BLOCK_SIZE', 1000))
+S3_RANGE_SIZE = int(os.environ.get('S3_RANGE_SIZE', 8 * 1024 * 1024))
+
+# Time kept back from the Lambda timeout for flushing sends and uploading a partial result
+CONTINUATION_RESERVE_MS = int(os.environ.get('CONTINUATION_RESERVE_MS', 45000))
+
+# Progress heartbeats read by the straggler monitor
+HEARTBEAT_INTERVAL_SECONDS = float(os.environ.get('HEARTBEAT_INTERVAL_SECONDS', 10))
+PRIMARY_ATTEMPT = 'primary'
+
+# Kafka fan-out configuration
+KAFKA_KEY_FIELD = os.environ.get('KAFKA_KEY_FIELD', '')
+KAFKA_PRODUCER_SHARDS = int(os.environ.get('KAFKA_PRODUCER_SHARDS', 1))
+KAFKA_SHARD_QUEUE_SIZE = int(os.environ.get('KAFKA_SHARD_QUEUE_SIZE', 10000))
+
+# Kafka message envelope: 'metadata' wraps each record in a JSON envelope, 'headers'
+# sends the record body as-is and carries the metadata in Kafka headers
+KAFKA_ENVELOPE = os.environ.get('KAFKA_ENVELOPE', 'metadata')
+
+# Record payload encoding ('json', 'msgpack' or 'avro'), optionally per topic or queue
+RECORD_ENCODING = os.environ.get('RECORD_ENCODING', 'json')
+RECORD_ENCODINGS = json.loads(os.environ.get('RECORD_ENCODINGS', '{}'))
+SCHEMA_REGISTRY_PATH = os.environ.get(
+    'SCHEMA_REGISTRY_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema_registry.json')
+)
+
+class RangedObjectReader:
+    """Streams an S3 object from a byte offset through sequential ranged GETs, exposing the StreamingBody iter_chunks interface"""
+    
+    def __init__(self, bucket: str, key: str, range_size: int = S3_RANGE_SIZE, start: int = 0):
+        self.bucket = bucket
+        self.key = key
+        self.range_size = range_size
+        self.start = start
+        self.bytes_read = 0
+    
+    def iter_chunks(self, chunk_size: int = STREAM_READ_CHUNK_SIZE) -> Iterator[bytes]:
+        size = s3.head_object(Bucket=self.bucket, Key=self.key)['ContentLength']
+        for offset in range(self.start, size, self.range_size):
+            # Ranged reads go through s3_io so slow ranges are hedged
+            data = s3_io.read_range(self.bucket, self.key, offset, min(self.range_size, size - offset))
+            self.bytes_read += len(data)
+            for position in range(0, len(data), chunk_size):
+                yield data[position:position + chunk_size]
+
+class ChunkPipeline:
+    """Runs download, transform and send stages concurrently with bounded queues between them.
+
+    The download stage runs on one thread, blocks of records are transformed by a
+    pool of worker threads and handed to sender threads. Queue depths are sampled on
+    every hand-off so the slowest stage shows up as the queue in front of it filling up.
+    """
+    
+    STAGES = ('download', 'transform', 'send')
+    
+    def __init__(self, transform_workers: int = PIPELINE_TRANSFORM_WORKERS,
+                 sender_threads: int = PIPELINE_SENDER_THREADS,
+                 queue_depth: int = PIPELINE_QUEUE_DEPTH):
+        self.transform_workers = max(1, transform_workers)
+        self.sender_threads = max(1, sender_threads)
+        self.queue_depth = queue_depth
+        self.queues = {
+            'transform': queue.Queue(maxsize=queue_depth),
+            'send': queue.Queue(maxsize=queue_depth)
+        }
+        self.abort = threading.Event()
+        self.errors = []
+        self._lock = threading.Lock()
+        self._stage_stats = {stage: {'blocks': 0, 'busyTime': 0.0} for stage in self.STAGES}
+        self._queue_stats = {name: {'samples': 0, 'depthTotal': 0, 'maxDepth': 0} for name in self.queues}
+    
+    def _record_busy(self, stage: str, busy_time: float):
+        with self._lock:
+            self._stage_stats[stage]['blocks'] += 1
+            self._stage_stats[stage]['busyTime'] += busy_time
+    
+    def _put(self, name: str, item: Any):
+        """Put with a timeout loop so producers stop if a downstream stage failed"""
+        target = self.queues[name]
+        while not self.abort.is_set():
+            try:
+                target.put(item, timeout=0.5)
+            except queue.Full:
+                continue
+            depth = target.qsize()
+            with self._lock:
+                stats = self._queue_stats[name]
+                stats['samples'] += 1
+                stats['depthTotal'] += depth
+                stats['maxDepth'] = max(stats['maxDepth'], depth)
+            return
+    
+    def _fail(self, stage: str, error: Exception):
+        logger.error(f"Pipeline stage {stage} failed: {str(error)}")
+        with self._lock:
+            self.errors.append(f"{stage}: {str(error)}")
+        self.abort.set()
+    
+    def _download(self, blocks: Iterator[Any]):
+        try:
+            while not self.abort.is_set():
+                started = time.time()
+                block = next(blocks, None)
+                if block is None:
+                    break
+                self._record_busy('download', time.time() - started)
+                self._put('transform', block)
+        except Exception as e:
+            self._fail('download', e)
+    
+    def _worker(self, stage: str, source: str, handler, target: Optional[str]):
+        try:
+            while True:
+                try:
+                    block = self.queues[source].get(timeout=0.5)
+                except queue.Empty:
+                    if self.abort.is_set():
+                        return
+                    continue
+                if block is None:
+                    return
+                if self.abort.is_set():
+                    continue  # Drain so upstream puts do not block
+                started = time.time()
+                result = handler(block)
+                self._record_busy(stage, time.time() - started)
+                if target:
+                    self._put(target, result)
+        except Exception as e:
+            self._fail(stage, e)
+    
+    def _start(self, count: int, name: str, *args) -> List[threading.Thread]:
+        threads = [threading.Thread(target=self._worker, args=(name,) + args, name=f"{name}-{i}", daemon=True)
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+    
+    def run(self, blocks: Iterator[Any], transform_block, send_block) -> Dict[str, Any]:
+        """Run all stages to completion and return per-stage metrics"""
+        started = time.time()
+        transformers = self._start(self.transform_workers, 'transform', 'transform', transform_block, 'send')
+        senders = self._start(self.sender_threads, 'send', 'send', send_block, None)
+        
+        downloader = threading.Thread(target=self._download, args=(blocks,), name='download', daemon=True)
+        downloader.start()
+        downloader.join()
+        
+        # Shut stages down in order once everything upstream has been handed off
+        for _ in transformers:
+            self._put('transform', None)
+        for thread in transformers:
+            thread.join()
+        for _ in senders:
+            self._put('send', None)
+        for thread in senders:
+            thread.join()
+        
+        if self.errors:
+            raise RuntimeError(f"Chunk pipeline failed: {'; '.join(self.errors)}")
+        
+        return self.get_metrics(time.time() - started)
+    
+    def get_metrics(self, wall_time: float) -> Dict[str, Any]:
+        """Per-stage busy time and utilisation plus queue depth statistics"""
+        threads = {'download': 1, 'transform': self.transform_workers, 'send': self.sender_threads}
+        stages = {}
+        for stage, stats in self._stage_stats.items():
+            # Busy time per thread approximates the wall time a stage would need on its own
+            stage_time = stats['busyTime'] / threads[stage]
+            stages[stage] = {
+                'threads': threads[stage],
+                'blocks': stats['blocks'],
+                'busyTime': stats['busyTime'],
+                'utilization': (stage_time / wall_time * 100) if wall_time > 0 else 0
+            }
+        queues = {
+            name: {
+                'capacity': self.queue_depth,
+                'maxDepth': stats['maxDepth'],
+                'avgDepth': stats['depthTotal'] / stats['samples'] if stats['samples'] > 0 else 0
+            }
+            for name, stats in self._queue_stats.items()
+        }
+        return {
+            'wallTime': wall_time,
+            'stages': stages,
+            'queues': queues,
+            'bottleneckStage': max(stages, key=lambda stage: stages[stage]['utilization'])
+        }
+
+def iter_record_blocks(records: Iterator[Any], block_size: int = PIPELINE_BLOCK_SIZE,
+                       start: int = 0) -> Iterator[Dict[str, Any]]:
+    """Group a record stream into numbered blocks that remember their offset in the chunk.
+
+    Blocks cut from a JsonArrayStream also carry the byte offset of their first record.
+    """
+    stream = records if isinstance(records, s3_io.JsonArrayStream) else None
+    block = []
+    sequence = 0
+    base_index = start
+    byte_offset = stream.offset if stream is not None else None
+    for record in records:
+        block.append(record)
+        if len(block) >= block_size:
+            yield {'sequence': sequence, 'baseIndex': base_index, 'byteOffset': byte_offset, 'records': block}
+            sequence += 1
+            base_index += len(block)
+            block = []
+            byte_offset = stream.offset if stream is not None else None
+    if block:
+        yield {'sequence': sequence, 'baseIndex': base_index, 'byteOffset': byte_offset, 'records': block}
+
+def open_chunk_records(bucket: str, chunk_key: str, resume_offset: int = 0, resume_byte: Optional[int] = None,
+                       body=None) -> s3_io.JsonArrayStream:
+    """Parse a chunk's records from body, or from a ranged read starting at resume_byte.
+
+    A continuation resumes at the byte offset of its next record. Continuations without one
+    (written before byte offsets were tracked) re-parse the records before resume_offset.
+    """
+    if body is None:
+        body = RangedObjectReader(bucket, chunk_key, start=resume_byte or 0)
+    records = s3_io.JsonArrayStream(body, STREAM_READ_CHUNK_SIZE, offset=resume_byte or 0, resume=bool(resume_byte))
+    if resume_offset and resume_byte is None:
+        for _ in islice(records, resume_offset):
+            pass
+    return records
+
+class ChunkDeadline:
+    """Stops handing out record blocks when the invocation is running out of time.
+
+    A block is only started while the remaining time covers the reserve for flushing
+    and uploading plus the average block time for every block still in flight. The
+    first block is always started so each invocation makes progress.
+    """
+    
+    def __init__(self, context=None, reserve_ms: Optional[int] = None):
+        self.context = context if hasattr(context, 'get_remaining_time_in_millis') else None
+        self.reserve_ms = reserve_ms if reserve_ms is not None else CONTINUATION_RESERVE_MS
+        self.next_offset = None
+        self.next_byte = None
+    
+    @property
+    def stopped(self) -> bool:
+        return self.next_offset is not None
+    
+    def limit(self, blocks: Iterator[Dict[str, Any]], in_flight: int = 1) -> Iterator[Dict[str, Any]]:
+        """Yield blocks while there is time to finish them, recording where the chunk stopped"""
+        started = time.time()
+        emitted = 0
+        for block in blocks:
+            if self.context is not None and emitted:
+                block_ms = (time.time() - started) * 1000 / emitted
+                remaining_ms = self.context.get_remaining_time_in_millis()
+                if remaining_ms < self.reserve_ms + block_ms * in_flight:
+                    self.next_offset = block['baseIndex']
+                    self.next_byte = block.get('byteOffset')
+                    logger.info(f"Stopping at record offset {self.next_offset:,} with {remaining_ms:,}ms left")
+                    return
+            yield block
+            emitted += 1
+
+class ChunkHeartbeat:
+    """Publishes chunk progress for the straggler monitor and settles speculative races.
+
+    Each attempt of a chunk (the primary and any speculative copy started by the monitor)
+    writes its progress to heartbeats/ while it hands out blocks, and stops once another
+    attempt has committed the chunk. The first attempt to create commits/{batchId}/{chunkId}.json
+    owns the chunk: only its results, errors and stats are kept.
+    """
+    
+    def __init__(self, event: Dict[str, Any], interval: Optional[float] = None):
+        continuation = event.get('continuation') or {}
+        self.event = event
+        self.bucket = event['bucket']
+        self.batch_id = event['batchId']
+        self.chunk_id = event['chunkId']
+        self.attempt = event.get('attempt', PRIMARY_ATTEMPT)
+        self.interval = interval if interval is not None else HEARTBEAT_INTERVAL_SECONDS
+        self.total_records = event['endIndex'] - event['startIndex'] + 1
+        self.fork_offset = continuation.get('nextOffset', 0)
+        self.started_at = continuation.get('startTime', continuation.get('totals', {}).get('startTime', time.time()))
+        self.invocation_started = time.time()
+        self.last_beat = 0
+        self.winner = None
+    
+    @property
+    def key(self) -> str:
+        suffix = '' if self.attempt == PRIMARY_ATTEMPT else f".{self.attempt}"
+        return f"heartbeats/{self.batch_id}/{self.chunk_id}{suffix}.json"
+    
+    @property
+    def commit_key(self) -> str:
+        return f"commits/{self.batch_id}/{self.chunk_id}.json"
+    
+    @property
+    def superseded(self) -> bool:
+        return self.winner is not None
+    
+    def check_commit(self):
+        """Pick up the result of another attempt that already committed this chunk"""
+        commit = s3_io.get_json(self.bucket, self.commit_key)
+        if commit and commit['attempt'] != self.attempt:
+            self.winner = commit['result']
+    
+    def beat(self, offset: int, state: str = 'running', force: bool = False):
+        """Write the chunk's progress, at most once per interval unless forced"""
+        now = time.time()
+        if not force and now - self.last_beat < self.interval:
+            return
+        self.last_beat = now
+        try:
+            if state == 'running':
+                self.check_commit()
+            elapsed = now - self.invocation_started
+            records = offset - self.fork_offset
+            s3.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=json.dumps({
+                    'chunkId': self.chunk_id,
+                    'attempt': self.attempt,
+                    'state': state,
+                    'offset': offset,
+                    'totalRecords': self.total_records,
+                    'forkOffset': self.fork_offset,
+                    'recordsPerSecond': records / elapsed if elapsed > 0 and records > 0 else 0,
+                    'startedAt': self.started_at,
+                    'updatedAt': now,
+                    # The invocation's input, so a speculative copy can resume from the same point
+                    'event': self.event
+                }, default=str),
+                ContentType='application/json'
+            )
+        except Exception as e:
+            logger.warning(f"Heartbeat for chunk {self.chunk_id} failed: {str(e)}")
+    
+    def track(self, blocks: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """Yield blocks, beating as they are handed out and stopping if the chunk was committed elsewhere"""
+        for block in blocks:
+            self.beat(block['baseIndex'])
+            if self.superseded:
+                logger.info(f"Chunk {self.chunk_id} was committed by another attempt, {self.attempt} stops "
+                            f"at record offset {block['baseIndex']:,}")
+                return
+            yield block
+    
+    def commit(self, result: Dict[str, Any]) -> bool:
+        """Claim the chunk for this attempt, False if another attempt committed it first"""
+        body = json.dumps({'attempt': self.attempt, 'committedAt': time.time(), 'result': result}, default=str)
+        if s3_io.put_if_absent(self.bucket, self.commit_key, body.encode('utf-8'), {'ContentType': 'application/json'}):
+            return True
+        self.check_commit()
+        return not self.superseded
+
+def discard_attempt_outputs(bucket: str, keys: List[str], kept_keys: List[str]):
+    """Delete the result and error objects a losing attempt wrote that the winner does not use"""
+    for key in set(keys) - set(kept_keys):
+        try:
+            s3.delete_object(Bucket=bucket, Key=key)
+        except Exception as e:
+            logger.warning(f"Could not delete {key}: {str(e)}")
+
+def continue_speculative_attempt(response: Dict[str, Any], context, heartbeat: ChunkHeartbeat) -> bool:
+    """Re-invoke this function for the rest of a speculative attempt.
+
+    Primary attempts are looped by the state machine; speculative ones are started
+    asynchronously by the straggler monitor and have to chain themselves. When the
+    invoke fails the attempt reports itself failed and drops its speculation marker,
+    so the monitor neither waits on it nor counts it against the chunk.
+    """
+    try:
+        if context is None or not hasattr(context, 'invoked_function_arn'):
+            raise ValueError('no function ARN in the invocation context')
+        s3_io.get_client('lambda').invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps(response, default=str).encode('utf-8')
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Could not continue speculative attempt of chunk {response['chunkId']}: {str(e)}")
+        heartbeat.beat(response['continuation']['nextOffset'], state='failed', force=True)
+        try:
+            s3.delete_object(Bucket=heartbeat.bucket, Key=f"speculation/{heartbeat.batch_id}/{heartbeat.chunk_id}.json")
+        except Exception as e:
+            logger.warning(f"Could not delete the speculation marker of chunk {heartbeat.chunk_id}: {str(e)}")
+        return False
+
+def save_continuation_totals(bucket: str, batch_id: str, chunk_id: str, attempt: str, segment: int,
+                             totals: Dict[str, Any]) -> str:
+    """Write the running totals a continued chunk resumes with; the continuation only carries their key.
+
+    Every segment writes its own object, so a speculative copy forked from an earlier segment
+    never sees totals written after its fork point.
+    """
+    attempt_suffix = f".{attempt}" if attempt != PRIMARY_ATTEMPT else ""
+    totals_key = f"continuations/{batch_id}/{chunk_id}{attempt_suffix}.seg-{segment:04d}.json"
+    s3_io.upload_bytes(bucket, totals_key, json.dumps(totals, separators=(',', ':'), default=str).encode('utf-8'),
+                       {'ContentType': 'application/json'})
+    return totals_key
+
+def load_continuation_totals(bucket: str, continuation: Dict[str, Any]) -> Dict[str, Any]:
+    """Running totals of the earlier invocations of a chunk, empty for its first invocation"""
+    totals_key = continuation.get('totalsKey')
+    if not totals_key:
+        # Continuations written before the totals moved to S3 carry them inline
+        return continuation.get('totals', {})
+    totals = s3_io.get_json(bucket, totals_key)
+    if totals is None:
+        raise RuntimeError(f"Continuation totals s3://{bucket}/{totals_key} not found")
+    return totals
+
+def is_pipeline_enabled(event: Dict[str, Any]) -> bool:
+    """Pipeline mode is enabled per chunk via the event or for all chunks via PIPELINE_MODE"""
+    if 'pipelined' in event:
+        return bool(event['pipelined'])
+    return os.environ.get('PIPELINE_MODE', 'false').lower() == 'true'
+
+class FileSchemaRegistry:
+    """Schema registry stand-in backed by a local JSON file.
+
+    The file maps subjects to their registered versions:
+    {"subjects": {"<topic>-value": [{"id": 1, "schema": {...}}]}}
+    """
+    
+    def __init__(self, path: str = SCHEMA_REGISTRY_PATH):
+        with open(path) as f:
+            config = json.load(f)
+        self.path = path
+        self._subjects = config.get('subjects', {})
+        self._by_id = {}
+        for versions in self._subjects.values():
+            for version in versions:
+                self._by_id[version['id']] = version['schema']
+    
+    def get_latest(self, subject: str) -> Tuple[int, Dict[str, Any]]:
+        """Return (schema id, schema) for the latest version of a subject"""
+        versions = self._subjects.get(subject)
+        if not versions:
+            raise KeyError(f"Subject {subject} not found in schema registry {self.path}")
+        latest = versions[-1]
+        return latest['id'], latest['schema']
+    
+    def get_by_id(self, schema_id: int) -> Dict[str, Any]:
+        if schema_id not in self._by_id:
+            raise KeyError(f"Schema id {schema_id} not found in schema registry {self.path}")
+        return self._by_id[schema_id]
+
+class JsonRecordSerializer:
+    """Compact JSON record payloads (the default)"""
+    name = 'json'
+    content_type = 'application/json'
+    binary = False
+    
+    def encode(self, record: Dict[str, Any]) -> bytes:
+        return json.dumps(record, separators=(',', ':')).encode('utf-8')
+    
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        return json.loads(data)
+
+class MsgpackRecordSerializer:
+    """MessagePack record payloads"""
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+    binary = True
+    
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+    
+    def encode(self, record: Dict[str, Any]) -> bytes:
+        return self._msgpack.packb(record, use_bin_type=True)
+    
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        return self._msgpack.unpackb(data, raw=False)
+
+class AvroRecordSerializer:
+    """Avro record payloads in the schema registry wire format (magic byte, 4-byte schema id, body)"""
+    name = 'avro'
+    content_type = 'application/vnd.apache.avro'
+    binary = True
+    MAGIC_BYTE = 0
+    
+    def __init__(self, subject: str, registry: FileSchemaRegistry):
+        import fastavro
+        self._fastavro = fastavro
+        self.registry = registry
+        self.schema_id, schema = registry.get_latest(subject)
+        self._schema = fastavro.parse_schema(schema)
+        self._header = struct.pack('>bI', self.MAGIC_BYTE, self.schema_id)
+        self._readers = {self.schema_id: self._schema}
+    
+    def encode(self, record: Dict[str, Any]) -> bytes:
+        buffer = io.BytesIO()
+        buffer.write(self._header)
+        self._fastavro.schemaless_writer(buffer, self._schema, record)
+        return buffer.getvalue()
+    
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        magic, schema_id = struct.unpack('>bI', data[:5])
+        if magic != self.MAGIC_BYTE:
+            raise ValueError(f"Unknown Avro magic byte: {magic}")
+        if schema_id not in self._readers:
+            self._readers[schema_id] = self._fastavro.parse_schema(self.registry.get_by_id(schema_id))
+        return self._fastavro.schemaless_reader(io.BytesIO(data[5:]), self._readers[schema_id])
+
+_serializer_cache = {}
+
+def get_record_serializer(destination_name: str, encoding: Optional[str] = None):
+    """Serializer for a topic or queue: explicit encoding, RECORD_ENCODINGS entry, then RECORD_ENCODING"""
+    encoding = (encoding or RECORD_ENCODINGS.get(destination_name) or RECORD_ENCODING).lower()
+    cache_key = (destination_name, encoding)
+    if cache_key not in _serializer_cache:
+        if encoding == 'json':
+            serializer = JsonRecordSerializer()
+        elif encoding == 'msgpack':
+            serializer = MsgpackRecordSerializer()
+        elif encoding == 'avro':
+            serializer = AvroRecordSerializer(f"{destination_name}-value", FileSchemaRegistry())
+        else:
+            raise ValueError(f"Unsupported record encoding: {encoding}")
+        _serializer_cache[cache_key] = serializer
+    return _serializer_cache[cache_key]
+
+def spill_records(records: List[Any]) -> spill_buffer.SpillBuffer:
+    """Move records held in memory into a new spill buffer"""
+    sink = spill_buffer.SpillBuffer()
+    for record in records:
+        sink.append(record)
+    records.clear()
+    return sink
+
+def is_spill_enabled(event: Dict[str, Any]) -> bool:
+    """Spill mode is enabled per chunk via the event or for all chunks via SPILL_TO_DISK"""
+    if 'spillToDisk' in event:
+        return bool(event['spillToDisk'])
+    return os.environ.get('SPILL_TO_DISK', 'false').lower() == 'true'
 
 def transform_record(record: Dict[str, Any], customer_id: str, tenant_id: str) -> Dict[str, Any]:
     """Apply business logic transformations to a record (same as batch processor)"""
@@ -35,47 +593,259 @@ def transform_record(record: Dict[str, Any], customer_id: str, tenant_id: str) -
     
     return record
 
-def send_records_to_kafka(records: List[Dict[str, Any]], chunk_id: str, start_index: int, 
+def create_kafka_producer(kafka_brokers: List[str]):
+    """Create the Kafka producer used for record sends (thread-safe, can be shared by sender threads)"""
+    from kafka import KafkaProducer
+    
+    return KafkaProducer(
+        bootstrap_servers=kafka_brokers,
+        # Already serialized record bodies (header envelope) are passed through unchanged
+        value_serializer=lambda v: v if isinstance(v, bytes) else json.dumps(v).encode('utf-8'),
+        security_protocol='SASL_SSL',
+        sasl_mechanism='AWS_MSK_IAM',
+        sasl_plain_username='',
+        sasl_plain_password='',
+        batch_size=16384,
+        linger_ms=10,
+        compression_type='gzip'
+    )
+
+class ShardedKafkaSender:
+    """Fans Kafka sends out over one producer per shard, each driven by its own thread.
+
+    Messages are routed to a shard by a stable hash of their key, so a key is always
+    sent by the same producer thread and keeps its order, while the partitioner spreads
+    keys over all broker partitions. Keyless messages are spread round-robin. Delivery
+    callbacks count sends per partition so hot keys show up as skewed partitions, and
+    record the send-to-acknowledgement latency per partition so a slow broker does too.
+    Queuing a message is not a success; only acknowledged messages count as delivered.
+    """
+    
+    def __init__(self, kafka_brokers: List[str], shards: Optional[int] = None,
+                 queue_size: int = KAFKA_SHARD_QUEUE_SIZE):
+        shards = KAFKA_PRODUCER_SHARDS if shards is None else shards
+        self.producers = [create_kafka_producer(kafka_brokers) for _ in range(max(1, shards))]
+        self.partition_counts = defaultdict(int)
+        self.partition_latency = stage_metrics.LatencyHistograms()
+        self.sent = 0
+        self.unsent = 0
+        self.delivery_errors = 0
+        self._lock = threading.Lock()
+        self._next_shard = 0
+        self._queues = []
+        self._threads = []
+        
+        # A single shard sends inline on the caller's thread
+        if len(self.producers) > 1:
+            for i, producer in enumerate(self.producers):
+                shard_queue = queue.Queue(maxsize=queue_size)
+                thread = threading.Thread(target=self._drain, args=(producer, shard_queue),
+                                          name=f"kafka-shard-{i}", daemon=True)
+                thread.start()
+                self._queues.append(shard_queue)
+                self._threads.append(thread)
+    
+    def _shard_for(self, key: Optional[bytes]) -> int:
+        if key is not None:
+            return zlib.crc32(key) % len(self.producers)
+        with self._lock:
+            self._next_shard = (self._next_shard + 1) % len(self.producers)
+            return self._next_shard
+    
+    def _on_delivered(self, sent_at: float, metadata):
+        self.partition_latency.record(metadata.partition, time.time() - sent_at)
+        with self._lock:
+            self.partition_counts[metadata.partition] += 1
+    
+    def _on_error(self, error):
+        logger.error(f"Kafka delivery error: {str(error)}")
+        with self._lock:
+            self.delivery_errors += 1
+    
+    def _send(self, producer, topic: str, value: Any, key: Optional[bytes],
+              headers: Optional[List[Tuple[str, bytes]]] = None):
+        sent_at = time.time()
+        future = producer.send(topic, value=value, key=key, headers=headers)
+        with self._lock:
+            self.sent += 1
+        future.add_callback(self._on_delivered, sent_at)
+        future.add_errback(self._on_error)
+    
+    def _drain(self, producer, shard_queue: queue.Queue):
+        while True:
+            item = shard_queue.get()
+            try:
+                if item is None:
+                    return
+                self._send(producer, *item)
+            except Exception as e:
+                with self._lock:
+                    self.unsent += 1
+                self._on_error(e)
+            finally:
+                shard_queue.task_done()
+    
+    def send(self, topic: str, value: Any, key: Optional[bytes] = None,
+             headers: Optional[List[Tuple[str, bytes]]] = None):
+        """Queue a message on the shard that owns its key"""
+        shard = self._shard_for(key)
+        if self._queues:
+            self._queues[shard].put((topic, value, key, headers))
+        else:
+            self._send(self.producers[shard], topic, value, key, headers)
+    
+    def flush(self, timeout: Optional[float] = None):
+        for shard_queue in self._queues:
+            shard_queue.join()
+        for producer in self.producers:
+            producer.flush(timeout=timeout)
+    
+    def close(self):
+        for shard_queue in self._queues:
+            shard_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        for producer in self.producers:
+            producer.close()
+    
+    def get_delivery_counts(self) -> Dict[str, int]:
+        """Acknowledged messages and failed ones, for use after flush.
+
+        A message still unacknowledged when flush gave up counts as failed, as do
+        messages a shard thread could not hand to its producer.
+        """
+        with self._lock:
+            delivered = sum(self.partition_counts.values())
+            unacknowledged = self.sent - delivered - (self.delivery_errors - self.unsent)
+            failed = self.delivery_errors + max(0, unacknowledged)
+        return {'success': delivered, 'errors': failed}
+    
+    def get_partition_stats(self) -> Dict[str, Any]:
+        """Per-partition delivered counts, how concentrated they are and delivery latency"""
+        with self._lock:
+            counts = {str(partition): count for partition, count in sorted(self.partition_counts.items())}
+            delivery_errors = self.delivery_errors
+        total = sum(counts.values())
+        return {
+            'shards': len(self.producers),
+            'partitions': counts,
+            'deliveryErrors': delivery_errors,
+            'hottestPartition': max(counts, key=counts.get) if counts else None,
+            'hottestPartitionShare': (max(counts.values()) / total * 100) if total > 0 else 0,
+            'latency': self.partition_latency.to_dict()
+        }
+
+def merge_partition_stats(stats_list: List[Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """Combine partition stats from several senders (processes or invocations)"""
+    stats_list = [stats for stats in stats_list if stats]
+    if not stats_list:
+        return None
+    counts = defaultdict(int)
+    for stats in stats_list:
+        for partition, count in stats['partitions'].items():
+            counts[partition] += count
+    total = sum(counts.values())
+    return {
+        'shards': max(stats['shards'] for stats in stats_list),
+        'partitions': dict(sorted(counts.items(), key=lambda item: int(item[0]))),
+        'deliveryErrors': sum(stats['deliveryErrors'] for stats in stats_list),
+        'hottestPartition': max(counts, key=counts.get) if counts else None,
+        'hottestPartitionShare': (max(counts.values()) / total * 100) if total > 0 else 0,
+        'latency': stage_metrics.merge_latency([stats.get('latency') for stats in stats_list])
+    }
+
+def get_send_latency(destination: str, kafka_partition_stats: Optional[Dict[str, Any]],
+                     sqs_queue_latency: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Send latency percentiles per Kafka partition or per SQS queue"""
+    if destination == 'kafka':
+        return stage_metrics.summarize_latency((kafka_partition_stats or {}).get('latency'), 'partition')
+    return stage_metrics.summarize_latency(sqs_queue_latency, 'queue')
+
+def get_kafka_key_field(event: Dict[str, Any]) -> Optional[str]:
+    """Message key field (e.g. gssId, customerId, id) from the event or KAFKA_KEY_FIELD"""
+    return event.get('kafkaKeyField', KAFKA_KEY_FIELD) or None
+
+def get_record_key(record: Dict[str, Any], key_field: Optional[str]) -> Optional[bytes]:
+    """Encode the configured key field of a record, or None to leave partitioning to the producer"""
+    if not key_field or record.get(key_field) is None:
+        return None
+    return str(record[key_field]).encode('utf-8')
+
+def get_kafka_envelope(event: Dict[str, Any]) -> str:
+    """Kafka envelope mode ('metadata' or 'headers') from the event or KAFKA_ENVELOPE"""
+    envelope = event.get('kafkaEnvelope', KAFKA_ENVELOPE).lower()
+    if envelope not in ('metadata', 'headers'):
+        raise ValueError(f"Unsupported Kafka envelope: {envelope}")
+    return envelope
+
+def build_kafka_chunk_headers(batch_id: str, chunk_id: str, customer_id: str,
+                              tenant_id: str) -> List[Tuple[str, bytes]]:
+    """Encode the headers that are constant for every message sent from one chunk"""
+    return [
+        ('batchId', batch_id.encode('utf-8')),
+        ('chunkId', chunk_id.encode('utf-8')),
+        ('customerId', customer_id.encode('utf-8')),
+        ('tenantId', tenant_id.encode('utf-8')),
+        ('processedAt', datetime.now().isoformat().encode('utf-8')),
+        ('source', b'lambda-processor'),
+        ('destination', b'kafka')
+    ]
+
+def send_records_to_kafka(records: Any, chunk_id: str, start_index: int, 
                          customer_id: str, tenant_id: str, batch_id: str, 
-                         kafka_brokers: List[str], kafka_topic: str) -> Dict[str, int]:
-    """Send records to Kafka (simplified version for Lambda)"""
+                         kafka_brokers: List[str], kafka_topic: str, producer=None,
+                         key_field: Optional[str] = None, envelope: str = 'metadata',
+                         serializer=None) -> Dict[str, Any]:
+    """Send records to Kafka (simplified version for Lambda)
+
+    records may be a list or a SpillBuffer; both support len() and iteration. With the
+    headers envelope records may also be JSON bytes that were serialized already.
+    When a sender is passed in the caller owns it and is responsible for flushing it;
+    'success' then only counts messages handed to the sender, and the caller takes the
+    delivered counts from its get_delivery_counts() after the flush. A sender created
+    here is flushed before returning and 'success' counts acknowledged messages.
+    Binary serializers always use the headers envelope.
+    """
+    serializer = serializer or JsonRecordSerializer()
+    owns_producer = producer is None
     try:
-        from kafka import KafkaProducer
-        from kafka.errors import KafkaError
-        
-        producer = KafkaProducer(
-            bootstrap_servers=kafka_brokers,
-            value_serializer=lambda v: json.dumps(v).encode('utf-8'),
-            security_protocol='SASL_SSL',
-            sasl_mechanism='AWS_MSK_IAM',
-            sasl_plain_username='',
-            sasl_plain_password='',
-            batch_size=16384,
-            linger_ms=10,
-            compression_type='gzip'
-        )
+        if owns_producer:
+            producer = ShardedKafkaSender(kafka_brokers)
         
         success_count = 0
         error_count = 0
         
-        for i, record in enumerate(records):
+        if serializer.binary:
+            envelope = 'headers'
+        if envelope == 'headers':
+            chunk_headers = build_kafka_chunk_headers(batch_id, chunk_id, customer_id, tenant_id)
+            chunk_headers.append(('contentType', serializer.content_type.encode('utf-8')))
+        
+        items = ((record, get_record_key(record, key_field)) for record in records)
+        
+        for i, (record, key) in enumerate(items):
             try:
-                # Add metadata to the record
-                kafka_message = {
-                    'record': record,
-                    'metadata': {
-                        'batchId': batch_id,
-                        'chunkId': chunk_id,
-                        'recordIndex': start_index + i,
-                        'customerId': customer_id,
-                        'tenantId': tenant_id,
-                        'processedAt': datetime.now().isoformat(),
-                        'source': 'lambda-processor',
-                        'destination': 'kafka'
+                if envelope == 'headers':
+                    if not isinstance(record, bytes):
+                        record = serializer.encode(record)
+                    headers = chunk_headers + [('recordIndex', str(start_index + i).encode('utf-8'))]
+                    producer.send(kafka_topic, record, key=key, headers=headers)
+                else:
+                    # Add metadata to the record
+                    kafka_message = {
+                        'record': record,
+                        'metadata': {
+                            'batchId': batch_id,
+                            'chunkId': chunk_id,
+                            'recordIndex': start_index + i,
+                            'customerId': customer_id,
+                            'tenantId': tenant_id,
+                            'processedAt': datetime.now().isoformat(),
+                            'source': 'lambda-processor',
+                            'destination': 'kafka'
+                        }
                     }
-                }
-                
-                future = producer.send(kafka_topic, kafka_message)
+                    producer.send(kafka_topic, kafka_message, key=key)
                 success_count += 1
                 
             except Exception as e:
@@ -83,63 +853,356 @@ def send_records_to_kafka(records: List[Dict[str, Any]], chunk_id: str, start_in
                 logger.error(f"Kafka send error for record {i}: {str(e)}")
         
         # Flush producer
-        producer.flush(timeout=30)
-        producer.close()
+        result = {'success': success_count, 'errors': error_count}
+        if owns_producer:
+            try:
+                producer.flush(timeout=30)
+            finally:
+                producer.close()
+            delivery = producer.get_delivery_counts()
+            result = {'success': delivery['success'], 'errors': error_count + delivery['errors'],
+                      'partitionStats': producer.get_partition_stats()}
         
-        return {'success': success_count, 'errors': error_count}
+        return result
         
     except Exception as e:
         logger.error(f"Failed to initialize Kafka producer: {str(e)}")
         return {'success': 0, 'errors': len(records)}
 
-def send_records_to_sqs(records: List[Dict[str, Any]], chunk_id: str, start_index: int,
+def send_records_to_sqs(records: Any, chunk_id: str, start_index: int,
                        customer_id: str, tenant_id: str, batch_id: str,
-                       sqs_queue_url: str) -> Dict[str, int]:
-    """Send records to SQS Core"""
+                       sqs_queue_url: str, sqs_client=None, serializer=None,
+                       latency: Optional[stage_metrics.LatencyHistograms] = None) -> Dict[str, Any]:
+    """Send records to SQS Core
+
+    JSON records keep the record/metadata envelope. Binary encodings send the base64
+    encoded record as the body and carry the metadata in message attributes. Each
+    SendMessage round trip is recorded in a latency histogram for the queue; when the
+    caller passes latency histograms in it owns them, otherwise they are returned.
+    """
+    serializer = serializer or JsonRecordSerializer()
+    owns_latency = latency is None
+    if owns_latency:
+        latency = stage_metrics.LatencyHistograms()
+    queue_name = sqs_queue_url.rsplit('/', 1)[-1]
     try:
-        sqs_client = boto3.client('sqs')
+        if sqs_client is None:
+            sqs_client = s3_io.get_client('sqs')
         
         success_count = 0
         error_count = 0
         
         for i, record in enumerate(records):
             try:
-                # Create SQS message
-                sqs_message = {
-                    'record': record,
-                    'metadata': {
-                        'batchId': batch_id,
-                        'chunkId': chunk_id,
-                        'recordIndex': start_index + i,
-                        'customerId': customer_id,
-                        'tenantId': tenant_id,
-                        'processedAt': datetime.now().isoformat(),
-                        'source': 'lambda-processor',
-                        'destination': 'sqs-core'
-                    }
+                metadata = {
+                    'batchId': batch_id,
+                    'chunkId': chunk_id,
+                    'recordIndex': start_index + i,
+                    'customerId': customer_id,
+                    'tenantId': tenant_id,
+                    'processedAt': datetime.now().isoformat(),
+                    'source': 'lambda-processor',
+                    'destination': 'sqs-core'
                 }
                 
-                response = sqs_client.send_message(
-                    QueueUrl=sqs_queue_url,
-                    MessageBody=json.dumps(sqs_message)
-                )
+                if serializer.binary:
+                    attributes = {
+                        name: {'DataType': 'Number' if name == 'recordIndex' else 'String', 'StringValue': str(value)}
+                        for name, value in metadata.items()
+                    }
+                    attributes['encoding'] = {'DataType': 'String', 'StringValue': serializer.name}
+                    sent_at = time.time()
+                    response = sqs_client.send_message(
+                        QueueUrl=sqs_queue_url,
+                        MessageBody=base64.b64encode(serializer.encode(record)).decode('ascii'),
+                        MessageAttributes=attributes
+                    )
+                else:
+                    # Create SQS message
+                    sqs_message = {
+                        'record': record,
+                        'metadata': metadata
+                    }
+                    
+                    sent_at = time.time()
+                    response = sqs_client.send_message(
+                        QueueUrl=sqs_queue_url,
+                        MessageBody=json.dumps(sqs_message)
+                    )
+                latency.record(queue_name, time.time() - sent_at)
                 success_count += 1
                 
             except Exception as e:
                 error_count += 1
                 logger.error(f"SQS send error for record {i}: {str(e)}")
         
-        return {'success': success_count, 'errors': error_count}
+        result = {'success': success_count, 'errors': error_count}
+        if owns_latency:
+            result['latency'] = latency.to_dict()
+        return result
         
     except Exception as e:
         logger.error(f"Failed to initialize SQS client: {str(e)}")
         return {'success': 0, 'errors': len(records)}
 
-def process_chunk(event: Dict[str, Any]) -> Dict[str, Any]:
-    """Process a chunk of records using Lambda (for smaller chunks)"""
-    try:
-        start_time = time.time()
+def run_chunk_pipeline(bucket: str, chunk_key: str, chunk_id: str, start_index: int,
+                       customer_id: str, tenant_id: str, batch_id: str, destination: str,
+                       kafka_brokers: List[str], kafka_topic: str, sqs_core_queue: str,
+                       sink: Any, key_field: Optional[str] = None,
+                       envelope: str = 'metadata', serializer=None,
+                       deadline: Optional[ChunkDeadline] = None, resume_offset: int = 0,
+                       heartbeat: Optional[ChunkHeartbeat] = None,
+                       metrics: Optional[stage_metrics.StageMetrics] = None,
+                       memory: Optional[stage_memory.MemoryGuard] = None,
+                       resume_byte: Optional[int] = None) -> Dict[str, Any]:
+    """Stream a chunk through ranged S3 reads, threaded transforms and threaded sends.
+
+    Transformed blocks are appended to sink in chunk order as they are sent. For an
+    in-memory list sink the blocks are re-assembled once the pipeline finishes, unless
+    the memory budget runs out first and the sink is moved to a spill buffer; a spill
+    buffer only receives a block once every earlier block has been appended.
+    Reading starts at resume_byte, the record at resume_offset; a deadline stops the
+    download stage and lets the blocks already in flight drain.
+    """
+    lock = threading.Lock()
+    errors = []
+    counts = {'kafka': {'success': 0, 'errors': 0}, 'sqs': {'success': 0, 'errors': 0}}
+    ordered_blocks = {}
+    next_sequence = 0
+    # The caller closes the sink it passed in; a spill buffer the pipeline switched to is its own
+    caller_sink = sink
+    
+    producer = ShardedKafkaSender(kafka_brokers) if destination == 'kafka' else None
+    sqs_client = s3_io.get_client('sqs') if destination == 'sqs_core' else None
+    sqs_latency = stage_metrics.LatencyHistograms() if destination == 'sqs_core' else None
+    
+    def transform_block(block: Dict[str, Any]) -> Dict[str, Any]:
+        processed = []
+        for i, record in enumerate(block['records']):
+            try:
+                processed.append(transform_record(record, customer_id, tenant_id))
+            except Exception as e:
+                with lock:
+                    errors.append({
+                        'record_index': block['baseIndex'] + i,
+                        'error': str(e),
+                        'record': record
+                    })
+        return {'sequence': block['sequence'], 'baseIndex': block['baseIndex'], 'records': processed}
+    
+    def send_block(block: Dict[str, Any]):
+        nonlocal sink, next_sequence
+        block_start = start_index + block['baseIndex']
+        send_start = time.time()
+        if destination == 'kafka':
+            result = send_records_to_kafka(
+                block['records'], chunk_id, block_start, customer_id, tenant_id, batch_id,
+                kafka_brokers, kafka_topic, producer=producer, key_field=key_field,
+                envelope=envelope, serializer=serializer
+            )
+            key = 'kafka'
+        elif destination == 'sqs_core':
+            result = send_records_to_sqs(
+                block['records'], chunk_id, block_start, customer_id, tenant_id, batch_id,
+                sqs_core_queue, sqs_client=sqs_client, serializer=serializer, latency=sqs_latency
+            )
+            key = 'sqs'
+        else:
+            result = None
+        if result and metrics is not None:
+            metrics.record('SendLatency', (time.time() - send_start) * 1000)
         
+        with lock:
+            if result:
+                # Kafka successes are only known from delivery callbacks once the producer is flushed
+                if key != 'kafka':
+                    counts[key]['success'] += result['success']
+                counts[key]['errors'] += result['errors']
+            ordered_blocks[block['sequence']] = block['records']
+            if memory is not None and not isinstance(sink, spill_buffer.SpillBuffer) and memory.over_budget():
+                memory.note('spill', f"at block {block['sequence']}")
+                sink = spill_buffer.SpillBuffer()
+                memory.set_buffer('results', 0)
+            if isinstance(sink, spill_buffer.SpillBuffer):
+                # Sender threads finish out of order; ordered_blocks is the reorder buffer and
+                # only the next expected sequence is appended so the spill file stays in chunk order
+                while next_sequence in ordered_blocks:
+                    for record in ordered_blocks.pop(next_sequence):
+                        sink.append(record)
+                    next_sequence += 1
+            elif memory is not None:
+                memory.add_buffer('results', stage_memory.estimate_bytes(block['records']))
+    
+    reader = RangedObjectReader(bucket, chunk_key, start=resume_byte or 0)
+    pipeline = ChunkPipeline()
+    blocks = iter_record_blocks(open_chunk_records(bucket, chunk_key, resume_offset, resume_byte, reader), start=resume_offset)
+    if heartbeat is not None:
+        blocks = heartbeat.track(blocks)
+    if deadline is not None:
+        in_flight = 2 * pipeline.queue_depth + pipeline.transform_workers + pipeline.sender_threads
+        blocks = deadline.limit(blocks, in_flight=in_flight)
+    partition_stats = None
+    succeeded = False
+    try:
+        pipeline_metrics = pipeline.run(blocks, transform_block, send_block)
+        if isinstance(sink, spill_buffer.SpillBuffer) and ordered_blocks:
+            raise RuntimeError(f"Chunk {chunk_id} is missing block {next_sequence} of the spill file")
+        succeeded = True
+    finally:
+        if not succeeded and sink is not caller_sink:
+            # The spill file was created with delete=False, only close() removes it
+            sink.close()
+        if producer is not None:
+            try:
+                producer.flush(timeout=30)
+            finally:
+                producer.close()
+            delivery = producer.get_delivery_counts()
+            counts['kafka']['success'] = delivery['success']
+            counts['kafka']['errors'] += delivery['errors']
+            partition_stats = producer.get_partition_stats()
+    
+    pipeline_metrics['bytesRead'] = reader.bytes_read
+    logger.info(f"Pipeline metrics for chunk {chunk_id}: {json.dumps(pipeline_metrics)}")
+    
+    records = sink
+    if not isinstance(sink, spill_buffer.SpillBuffer):
+        records = [record for sequence in sorted(ordered_blocks) for record in ordered_blocks[sequence]]
+    
+    return {
+        'records': records,
+        'errors': errors,
+        'kafka': dict(counts['kafka'], partitionStats=partition_stats),
+        'sqs': dict(counts['sqs'], latency=sqs_latency.to_dict() if sqs_latency else None),
+        'metrics': pipeline_metrics
+    }
+
+def upload_chunk_stats(bucket: str, result: Dict[str, Any]) -> str:
+    """Write a chunk result to stats/ so aggregation reads Lambda and Batch chunks the same way"""
+    stats_key = f"stats/{result['batchId']}/{result['chunkId']}.json"
+    s3.put_object(
+        Bucket=bucket,
+        Key=stats_key,
+        Body=json.dumps(result, default=str),
+        ContentType='application/json'
+    )
+    return stats_key
+
+def run_chunk_blocks(records: Iterator[Any], chunk_id: str, start_index: int,
+                     customer_id: str, tenant_id: str, batch_id: str, destination: str,
+                     kafka_brokers: List[str], kafka_topic: str, sqs_core_queue: str,
+                     sink: Any, key_field: Optional[str] = None,
+                     envelope: str = 'metadata', serializer=None,
+                     deadline: Optional[ChunkDeadline] = None, resume_offset: int = 0,
+                     heartbeat: Optional[ChunkHeartbeat] = None,
+                     metrics: Optional[stage_metrics.StageMetrics] = None,
+                     memory: Optional[stage_memory.MemoryGuard] = None) -> Dict[str, Any]:
+    """Transform and send a chunk block by block on the calling thread.
+
+    Each block is sent right after it is transformed, so a deadline can stop the chunk
+    at any block boundary with everything before it delivered. records starts at the
+    record at resume_offset. Spilled records are serialized once and, with the JSON
+    headers envelope, sent as those bytes. An in-memory list sink is moved to a spill
+    buffer when the memory budget runs out.
+    """
+    serializer = serializer or JsonRecordSerializer()
+    errors = []
+    counts = {'kafka': {'success': 0, 'errors': 0}, 'sqs': {'success': 0, 'errors': 0}}
+    passthrough_envelope = envelope == 'headers' and not key_field and serializer.name == 'json'
+    
+    producer = ShardedKafkaSender(kafka_brokers) if destination == 'kafka' else None
+    sqs_client = s3_io.get_client('sqs') if destination == 'sqs_core' else None
+    sqs_latency = stage_metrics.LatencyHistograms() if destination == 'sqs_core' else None
+    
+    blocks = iter_record_blocks(records, start=resume_offset)
+    if heartbeat is not None:
+        blocks = heartbeat.track(blocks)
+    if deadline is not None:
+        blocks = deadline.limit(blocks)
+    partition_stats = None
+    try:
+        for block in blocks:
+            processed = []
+            for i, record in enumerate(block['records']):
+                try:
+                    # Apply business logic transformations
+                    processed.append(transform_record(record, customer_id, tenant_id))
+                except Exception as e:
+                    errors.append({
+                        'record_index': block['baseIndex'] + i,
+                        'error': str(e),
+                        'record': record
+                    })
+            
+            if memory is not None and not isinstance(sink, spill_buffer.SpillBuffer) and memory.over_budget():
+                memory.note('spill', f"at record {block['baseIndex']:,}")
+                sink = spill_records(sink)
+                memory.set_buffer('results', 0)
+            
+            if isinstance(sink, spill_buffer.SpillBuffer):
+                # Keep the transformed output as bytes on disk
+                encoded = [json.dumps(record, separators=(',', ':')).encode('utf-8') for record in processed]
+                for data in encoded:
+                    sink.append_bytes(data)
+                if passthrough_envelope:
+                    processed = encoded
+            else:
+                sink.extend(processed)
+                if memory is not None:
+                    memory.add_buffer('results', stage_memory.estimate_bytes(processed))
+            
+            block_start = start_index + block['baseIndex']
+            send_start = time.time()
+            if destination == 'kafka':
+                result = send_records_to_kafka(
+                    processed, chunk_id, block_start, customer_id, tenant_id, batch_id,
+                    kafka_brokers, kafka_topic, producer=producer, key_field=key_field,
+                    envelope=envelope, serializer=serializer
+                )
+                # Successes are only known from delivery callbacks once the producer is flushed
+                counts['kafka']['errors'] += result['errors']
+            elif destination == 'sqs_core':
+                result = send_records_to_sqs(
+                    processed, chunk_id, block_start, customer_id, tenant_id, batch_id,
+                    sqs_core_queue, sqs_client=sqs_client, serializer=serializer, latency=sqs_latency
+                )
+                counts['sqs']['success'] += result['success']
+                counts['sqs']['errors'] += result['errors']
+            if destination in ('kafka', 'sqs_core') and metrics is not None:
+                metrics.record('SendLatency', (time.time() - send_start) * 1000)
+    finally:
+        if producer is not None:
+            try:
+                producer.flush(timeout=30)
+            finally:
+                producer.close()
+            delivery = producer.get_delivery_counts()
+            counts['kafka']['success'] = delivery['success']
+            counts['kafka']['errors'] += delivery['errors']
+            partition_stats = producer.get_partition_stats()
+    
+    return {
+        'records': sink,
+        'errors': errors,
+        'kafka': dict(counts['kafka'], partitionStats=partition_stats),
+        'sqs': dict(counts['sqs'], latency=sqs_latency.to_dict() if sqs_latency else None)
+    }
+
+def process_chunk(event: Dict[str, Any], context=None) -> Dict[str, Any]:
+    """Process a chunk of records using Lambda (for smaller chunks).
+
+    When the invocation runs low on time the chunk stops at a block boundary, uploads
+    what it has as a result segment and returns a CONTINUE response carrying the next
+    offset and running totals, which is re-invoked to process the rest.
+    """
+    start_time = time.time()
+    processed_records = []
+    heartbeat = None
+    # One EMF document per invocation; continued chunks emit one per segment
+    metrics = stage_metrics.StageMetrics.for_event('update-records', event)
+    metrics.set_property('chunkId', event.get('chunkId'))
+    memory = stage_memory.MemoryGuard('update-records', context).start()
+    try:
         # Extract parameters
         chunk_id = event['chunkId']
         start_index = event['startIndex']
@@ -150,71 +1213,159 @@ def process_chunk(event: Dict[str, Any]) -> Dict[str, Any]:
         tenant_id = event['tenantId']
         batch_id = event['batchId']
         destination = event.get('destination', 'kafka').lower()
+        spill_mode = is_spill_enabled(event)
+        pipelined = is_pipeline_enabled(event)
+        kafka_key_field = get_kafka_key_field(event)
+        kafka_envelope = get_kafka_envelope(event)
         
         # Configuration from environment
         kafka_brokers = os.environ.get('KAFKA_BROKERS', '').split(',')
         kafka_topic = os.environ.get('KAFKA_TOPIC', 'processed-records')
         sqs_core_queue = os.environ.get('SQS_CORE_QUEUE', '')
+        record_serializer = get_record_serializer(
+            kafka_topic if destination == 'kafka' else sqs_core_queue, event.get('recordEncoding')
+        )
+        if record_serializer.binary:
+            kafka_envelope = 'headers'
         
-        logger.info(f"Processing chunk {chunk_id}: records {start_index:,} to {end_index:,}")
-        logger.info(f"Destination: {destination}")
+        # Continuation state from a previous invocation of the same chunk
+        continuation = event.get('continuation') or {}
+        resume_offset = continuation.get('nextOffset', 0)
+        resume_byte = continuation.get('nextByte')
+        segment = continuation.get('segment', 0)
+        totals = load_continuation_totals(bucket, continuation)
+        deadline = ChunkDeadline(context)
         
-        # Download chunk data from S3
-        chunk_key = f"chunks/{batch_id}/{chunk_id}.json"
-        response = s3.get_object(Bucket=bucket, Key=chunk_key)
-        records = json.loads(response['Body'].read().decode('utf-8'))
+        # Progress heartbeats; a chunk already committed by another attempt is not processed again
+        heartbeat = ChunkHeartbeat(event)
+        attempt = heartbeat.attempt
+        metrics.set_property('attempt', attempt)
+        heartbeat.check_commit()
+        if heartbeat.superseded:
+            logger.info(f"Chunk {chunk_id} was already committed, {attempt} attempt returns the committed result")
+            return dict(heartbeat.winner, supersededAttempt=attempt)
+        heartbeat.beat(resume_offset, force=True)
         
-        # Process all records first
-        processed_records = []
-        processing_errors = []
+        logger.info(f"Processing chunk {chunk_id}: records {start_index:,} to {end_index:,}"
+                    + (f" (segment {segment}, resuming at offset {resume_offset:,}"
+                       + (f", byte {resume_byte:,})" if resume_byte is not None else ")") if segment else "")
+                    + (f" as {attempt} attempt" if attempt != PRIMARY_ATTEMPT else ""))
+        logger.info(f"Destination: {destination}, spill mode: {spill_mode}, pipelined: {pipelined}, encoding: {record_serializer.name}")
         
-        for i, record in enumerate(records):
-            try:
-                # Apply business logic transformations
-                processed_record = transform_record(record, customer_id, tenant_id)
-                processed_records.append(processed_record)
-                
-            except Exception as e:
-                processing_errors.append({
-                    'record_index': i,
-                    'error': str(e),
-                    'record': record
-                })
+        chunk_key = f"chunks/{batch_id}/{chunk_id}.json"
+        chunk_bytes = None
+        if not spill_mode and memory.budget is not None:
+            # Stream and spill a chunk that would not fit in the memory budget once parsed
+            chunk_bytes = s3.head_object(Bucket=bucket, Key=chunk_key)['ContentLength']
+            if memory.would_exceed(chunk_bytes):
+                memory.note('spill', f"for a {chunk_bytes:,} byte chunk")
+                spill_mode = True
+        if spill_mode:
+            processed_records = spill_buffer.SpillBuffer()
+        processing_errors = []
+        pipeline_metrics = None
+        input_bytes = 0
+        s3_io.reset_hedge_stats()
         
-        # Send processed records to configured destination
         kafka_success_count = 0
         kafka_error_count = 0
+        kafka_partition_stats = None
         sqs_success_count = 0
         sqs_error_count = 0
+        sqs_queue_latency = None
         
-        if destination == 'kafka':
-            kafka_result = send_records_to_kafka(
-                processed_records, chunk_id, start_index, customer_id, tenant_id, batch_id,
-                kafka_brokers, kafka_topic
+        if pipelined:
+            # Download, transform and send overlap inside this worker
+            pipeline_result = run_chunk_pipeline(
+                bucket, chunk_key, chunk_id, start_index, customer_id, tenant_id, batch_id,
+                destination, kafka_brokers, kafka_topic, sqs_core_queue, processed_records,
+                key_field=kafka_key_field, envelope=kafka_envelope, serializer=record_serializer,
+                deadline=deadline, resume_offset=resume_offset, heartbeat=heartbeat,
+                metrics=metrics, memory=memory, resume_byte=resume_byte
             )
-            kafka_success_count = kafka_result['success']
-            kafka_error_count = kafka_result['errors']
-        elif destination == 'sqs_core':
-            sqs_result = send_records_to_sqs(
-                processed_records, chunk_id, start_index, customer_id, tenant_id, batch_id,
-                sqs_core_queue
+            processed_records = pipeline_result['records']
+            processing_errors = pipeline_result['errors']
+            pipeline_metrics = pipeline_result['metrics']
+            input_bytes = pipeline_metrics['bytesRead']
+            kafka_success_count = pipeline_result['kafka']['success']
+            kafka_error_count = pipeline_result['kafka']['errors']
+            kafka_partition_stats = pipeline_result['kafka']['partitionStats']
+            sqs_success_count = pipeline_result['sqs']['success']
+            sqs_error_count = pipeline_result['sqs']['errors']
+            sqs_queue_latency = pipeline_result['sqs']['latency']
+        else:
+            # Download chunk data from S3, from the next record's byte offset when continuing
+            if spill_mode:
+                # Stream records in and keep the transformed output as bytes on disk
+                ranged = {'Range': f"bytes={resume_byte}-"} if resume_byte else {}
+                response = s3.get_object(Bucket=bucket, Key=chunk_key, **ranged)
+                input_bytes = response.get('ContentLength', 0)
+                records = open_chunk_records(bucket, chunk_key, resume_offset, resume_byte, response['Body'])
+            else:
+                data = s3_io.download_bytes(bucket, chunk_key, size=chunk_bytes, offset=resume_byte or 0)
+                input_bytes = len(data)
+                memory.set_buffer('input', input_bytes)
+                records = open_chunk_records(bucket, chunk_key, resume_offset, resume_byte, data)
+            
+            # Transform and send block by block so the chunk can stop at a block boundary
+            block_result = run_chunk_blocks(
+                records, chunk_id, start_index, customer_id, tenant_id, batch_id,
+                destination, kafka_brokers, kafka_topic, sqs_core_queue, processed_records,
+                key_field=kafka_key_field, envelope=kafka_envelope, serializer=record_serializer,
+                deadline=deadline, resume_offset=resume_offset, heartbeat=heartbeat,
+                metrics=metrics, memory=memory
             )
-            sqs_success_count = sqs_result['success']
-            sqs_error_count = sqs_result['errors']
-        
-        # Upload processed results to S3 (for backup/audit)
-        result_key = f"results/{batch_id}/{chunk_id}.json"
-        s3.put_object(
-            Bucket=bucket,
-            Key=result_key,
-            Body=json.dumps(processed_records),
-            ContentType='application/json'
-        )
+            processed_records = block_result['records']
+            processing_errors = block_result['errors']
+            kafka_success_count = block_result['kafka']['success']
+            kafka_error_count = block_result['kafka']['errors']
+            kafka_partition_stats = block_result['kafka']['partitionStats']
+            sqs_success_count = block_result['sqs']['success']
+            sqs_error_count = block_result['sqs']['errors']
+            sqs_queue_latency = block_result['sqs']['latency']
+        
+        if heartbeat.superseded:
+            # Another attempt committed while this one was running; its records were sent
+            # but this attempt's output is dropped and nothing is counted twice
+            discard_attempt_outputs(bucket, totals.get('resultKeys', []) + totals.get('errorKeys', []),
+                                    heartbeat.winner.get('resultKeys', []) + heartbeat.winner.get('errorKeys', []))
+            heartbeat.beat(resume_offset, state='superseded', force=True)
+            metrics.increment('AttemptsSuperseded')
+            return dict(heartbeat.winner, supersededAttempt=attempt)
+        
+        # The budget guard may have moved the records to disk; serializing an in-memory
+        # result for the upload needs about twice its size again
+        if not isinstance(processed_records, spill_buffer.SpillBuffer) and memory.over_budget(2 * memory.buffers.get('results', 0)):
+            memory.note('spill', 'before the results upload')
+            processed_records = spill_records(processed_records)
+        spill_mode = isinstance(processed_records, spill_buffer.SpillBuffer)
+        if spill_mode:
+            processed_records.finalize()
+            logger.info(f"Spilled {len(processed_records):,} records ({processed_records.size:,} bytes) to {processed_records.path}")
+        
+        # Upload processed results to S3 (for backup/audit); a chunk that spans several
+        # invocations writes one result segment per invocation, and speculative attempts
+        # write under their own names until one of them commits
+        attempt_suffix = f".{attempt}" if attempt != PRIMARY_ATTEMPT else ""
+        segment_suffix = f".seg-{segment:04d}" if segment or deadline.stopped else ""
+        result_key = f"results/{batch_id}/{chunk_id}{attempt_suffix}{segment_suffix}.json"
+        if spill_mode:
+            # The spill file is already a JSON array, upload it straight from disk
+            s3_io.upload_file(
+                processed_records.path, bucket, result_key,
+                {'ContentType': 'application/json'}
+            )
+            output_bytes = processed_records.size
+        else:
+            result_data = json.dumps(processed_records).encode('utf-8')
+            s3_io.upload_bytes(bucket, result_key, result_data, {'ContentType': 'application/json'})
+            output_bytes = len(result_data)
+            del result_data
         
         # Upload processing errors if any
         error_key = None
         if processing_errors:
-            error_key = f"errors/{batch_id}/{chunk_id}.json"
+            error_key = f"errors/{batch_id}/{chunk_id}{attempt_suffix}{segment_suffix}.json"
             s3.put_object(
                 Bucket=bucket,
                 Key=error_key,
@@ -222,46 +1373,128 @@ def process_chunk(event: Dict[str, Any]) -> Dict[str, Any]:
                 ContentType='application/json'
             )
         
-        processing_time = time.time() - start_time
+        # This invocation's counters; the running totals below feed the chunk result
+        invocation_time = time.time() - start_time
+        memory.stop()
+        memory.record_metrics(metrics)
+        metrics.increment('RecordsIn', len(processed_records) + len(processing_errors))
+        metrics.increment('RecordsOut', kafka_success_count + sqs_success_count)
+        metrics.increment('RecordsFailed', len(processing_errors))
+        metrics.increment('SendErrors', kafka_error_count + sqs_error_count)
+        metrics.increment('BytesRead', input_bytes, stage_metrics.BYTES)
+        metrics.increment('BytesWritten', output_bytes, stage_metrics.BYTES)
+        metrics.rate('Throughput', len(processed_records), invocation_time)
+        metrics.latency_percentiles('SendLatency', get_send_latency(destination, kafka_partition_stats, sqs_queue_latency))
+        
+        # Running totals across all invocations of this chunk
+        totals = {
+            'recordsProcessed': totals.get('recordsProcessed', 0) + len(processed_records),
+            'processingErrors': totals.get('processingErrors', 0) + len(processing_errors),
+            'kafkaSuccess': totals.get('kafkaSuccess', 0) + kafka_success_count,
+            'kafkaErrors': totals.get('kafkaErrors', 0) + kafka_error_count,
+            'sqsSuccess': totals.get('sqsSuccess', 0) + sqs_success_count,
+            'sqsErrors': totals.get('sqsErrors', 0) + sqs_error_count,
+            'inputBytes': max(totals.get('inputBytes', 0), input_bytes),
+            'processingTime': totals.get('processingTime', 0) + time.time() - start_time,
+            'startTime': totals.get('startTime', start_time),
+            'resultKeys': totals.get('resultKeys', []) + [result_key],
+            'errorKeys': totals.get('errorKeys', []) + ([error_key] if error_key else []),
+            'kafkaPartitionStats': merge_partition_stats([totals.get('kafkaPartitionStats'), kafka_partition_stats]),
+            'sqsQueueLatency': stage_metrics.merge_latency([totals.get('sqsQueueLatency'), sqs_queue_latency]),
+            'peakMemoryMb': max(totals.get('peakMemoryMb', 0), memory.get_report()['peakRssMb'])
+        }
+        
+        if deadline.stopped:
+            logger.info(f"Chunk {chunk_id} continues at offset {deadline.next_offset:,} "
+                        f"after {totals['recordsProcessed']:,} records in {segment + 1} invocations")
+            heartbeat.beat(deadline.next_offset, force=True)
+            metrics.increment('Continuations')
+            # The state stays a few hundred bytes however many segments the chunk takes: totals,
+            # result keys and histograms go to S3 and the next invocation resumes at nextByte
+            response = dict(
+                event,
+                status='CONTINUE',
+                batchStatus='CHUNK_CONTINUING',
+                continuation={
+                    'nextOffset': deadline.next_offset,
+                    'nextByte': deadline.next_byte,
+                    'segment': segment + 1,
+                    'startTime': totals['startTime'],
+                    'totalsKey': save_continuation_totals(bucket, batch_id, chunk_id, attempt, segment + 1, totals)
+                },
+                progress={
+                    'stage': 'CHUNK_CONTINUING',
+                    'chunkId': chunk_id,
+                    'nextIndex': start_index + deadline.next_offset,
+                    'endIndex': end_index,
+                    'recordsProcessed': totals['recordsProcessed']
+                }
+            )
+            if attempt != PRIMARY_ATTEMPT:
+                continue_speculative_attempt(response, context, heartbeat)
+            return response
+        
+        processing_time = totals['processingTime']
+        processed_count = totals['recordsProcessed']
+        error_count = totals['processingErrors']
+        kafka_success_count = totals['kafkaSuccess']
+        kafka_error_count = totals['kafkaErrors']
+        kafka_partition_stats = totals['kafkaPartitionStats']
+        sqs_success_count = totals['sqsSuccess']
+        sqs_error_count = totals['sqsErrors']
+        sqs_queue_latency = totals['sqsQueueLatency']
         
         # Calculate success rates and performance metrics
-        total_records_attempted = len(processed_records) + len(processing_errors)
-        processing_success_rate = ((len(processed_records) - len(processing_errors)) / total_records_attempted * 100) if total_records_attempted > 0 else 0
+        total_records_attempted = processed_count + error_count
+        processing_success_rate = ((processed_count - error_count) / total_records_attempted * 100) if total_records_attempted > 0 else 0
         
         if destination == 'kafka':
-            streaming_success_rate = ((kafka_success_count - kafka_error_count) / kafka_success_count * 100) if kafka_success_count > 0 else 0
+            streaming_attempted = kafka_success_count + kafka_error_count
+            streaming_success_rate = (kafka_success_count / streaming_attempted * 100) if streaming_attempted > 0 else 0
         else:
-            streaming_success_rate = ((sqs_success_count - sqs_error_count) / sqs_success_count * 100) if sqs_success_count > 0 else 0
+            streaming_attempted = sqs_success_count + sqs_error_count
+            streaming_success_rate = (sqs_success_count / streaming_attempted * 100) if streaming_attempted > 0 else 0
         
-        records_per_second = len(processed_records) / processing_time if processing_time > 0 else 0
+        records_per_second = processed_count / processing_time if processing_time > 0 else 0
         
-        return {
+        result = {
             'chunkId': chunk_id,
             'batchId': batch_id,
             'customerId': customer_id,
             'tenantId': tenant_id,
+            'bucket': bucket,
             'deployment': 'WORKSPACE',
             'status': 'SUCCESS',
             'batchStatus': 'CHUNK_PROCESSED',
             'destination': destination,
+            'attempt': attempt,
             
             # Processing statistics
-            'recordsProcessed': len(processed_records),
+            'recordsProcessed': processed_count,
             'recordsAttempted': total_records_attempted,
-            'processingErrors': len(processing_errors),
+            'processingErrors': error_count,
             'processingSuccessRate': processing_success_rate,
             'processingTime': processing_time,
             
             # Streaming statistics
             'recordsSentToKafka': kafka_success_count if destination == 'kafka' else 0,
             'kafkaErrors': kafka_error_count if destination == 'kafka' else 0,
+            'kafkaKeyField': kafka_key_field if destination == 'kafka' else None,
+            'kafkaEnvelope': kafka_envelope if destination == 'kafka' else None,
+            'recordEncoding': record_serializer.name,
+            'kafkaPartitionStats': kafka_partition_stats,
             'recordsSentToSQSCore': sqs_success_count if destination == 'sqs_core' else 0,
             'sqsErrors': sqs_error_count if destination == 'sqs_core' else 0,
+            'sqsQueueLatency': sqs_queue_latency,
+            'sendLatency': get_send_latency(destination, kafka_partition_stats, sqs_queue_latency),
             'streamingSuccessRate': streaming_success_rate,
             
             # File locations
             'resultKey': result_key,
             'errorKey': error_key if processing_errors else None,
+            'resultKeys': totals['resultKeys'],
+            'errorKeys': totals['errorKeys'],
+            'invocations': segment + 1,
             'kafkaTopic': kafka_topic if destination == 'kafka' else None,
             'sqsCoreQueue': sqs_core_queue if destination == 'sqs_core' else None,
             
@@ -271,10 +1504,10 @@ def process_chunk(event: Dict[str, Any]) -> Dict[str, Any]:
                 'chunkId': chunk_id,
                 'startIndex': start_index,
                 'endIndex': end_index,
-                'recordsProcessed': len(processed_records),
-                'processingErrors': len(processing_errors),
+                'recordsProcessed': processed_count,
+                'processingErrors': error_count,
                 'streamingErrors': kafka_error_count + sqs_error_count,
-                'startTime': datetime.fromtimestamp(start_time).isoformat(),
+                'startTime': datetime.fromtimestamp(totals['startTime']).isoformat(),
                 'completionTime': datetime.now().isoformat(),
                 'processingTime': processing_time
             },
@@ -285,7 +1518,14 @@ def process_chunk(event: Dict[str, Any]) -> Dict[str, Any]:
                 'processingTime': processing_time,
                 'successRate': processing_success_rate,
                 'streamingSuccessRate': streaming_success_rate,
-                'totalErrors': len(processing_errors) + kafka_error_count + sqs_error_count
+                'totalErrors': error_count + kafka_error_count + sqs_error_count,
+                'pipeline': pipeline_metrics,
+                's3Hedging': s3_io.get_hedge_stats(),
+                # Inputs for the planner's throughput model
+                'executor': 'lambda',
+                'inputBytes': totals['inputBytes'],
+                'peakMemoryMb': totals['peakMemoryMb'],
+                'memory': memory.get_report()
             },
             
             # Metadata
@@ -294,12 +1534,31 @@ def process_chunk(event: Dict[str, Any]) -> Dict[str, Any]:
                 'version': '1.0',
                 'chunkSize': end_index - start_index + 1,
                 'destination': destination,
+                'spillMode': spill_mode,
+                'spillBytes': processed_records.size if spill_mode else 0,
+                'pipelined': pipelined,
                 'processedAt': datetime.now().isoformat()
             }
         }
         
+        # First commit wins; a losing attempt drops its output and returns the winner's result
+        if not heartbeat.commit(result):
+            logger.info(f"Chunk {chunk_id} was committed by another attempt first, discarding {attempt} output")
+            discard_attempt_outputs(bucket, totals['resultKeys'] + totals['errorKeys'],
+                                    heartbeat.winner.get('resultKeys', []) + heartbeat.winner.get('errorKeys', []))
+            heartbeat.beat(end_index - start_index + 1, state='superseded', force=True)
+            metrics.increment('AttemptsSuperseded')
+            return dict(heartbeat.winner, supersededAttempt=attempt)
+        heartbeat.beat(end_index - start_index + 1, state='done', force=True)
+        upload_chunk_stats(bucket, result)
+        metrics.increment('ChunksCompleted')
+        return result
+        
     except Exception as e:
         logger.error(f"Error processing chunk {event.get('chunkId', 'unknown')}: {str(e)}")
+        if heartbeat is not None:
+            heartbeat.beat(heartbeat.fork_offset, state='failed', force=True)
+        metrics.increment('ChunksFailed')
         return {
             'chunkId': event.get('chunkId', 'unknown'),
             'batchId': event.get('batchId', 'unknown'),
@@ -325,14 +1584,21 @@ def process_chunk(event: Dict[str, Any]) -> Dict[str, Any]:
                 'processedAt': datetime.now().isoformat()
             }
         }
+    finally:
+        if isinstance(processed_records, spill_buffer.SpillBuffer):
+            processed_records.close()
+        memory.stop()
+        metrics.record('Duration', (time.time() - start_time) * 1000)
+        metrics.flush()
 
+@stage_profiler.profiled('update-records')
 def lambda_handler(event, context):
     """Lambda handler for processing chunks (hybrid approach)"""
     try:
         logger.info(f"Received event: {json.dumps(event)}")
         
         # Process the chunk
-        result = process_chunk(event)
+        result = process_chunk(event, context)
         
         logger.info(f"Chunk processing completed: {result['status']}")
         return result
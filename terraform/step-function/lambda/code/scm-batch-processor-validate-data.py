@@ -1,21 +1,32 @@
+import io
 import json
-import boto3
+import gzip
 import logging
 import time
 import os
 import re
+import math
+import random
+import hashlib
+import statistics
 from datetime import datetime
 from typing import Dict, List, Any, Optional, Tuple
+from array import array
 from collections import defaultdict
 import concurrent.futures
 from functools import lru_cache
 
+import s3_io
+import stage_metrics
+import stage_profiler
+import validation_cache
+
 # Set up logging with structured logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Initialize AWS clients outside handler for reuse
-s3_client = boto3.client('s3')
+s3_client = s3_io.get_client('s3')
 
 # Constants for validation
 REQUIRED_FIELDS = frozenset(['id', 'name', 'email', 'status', 'createdAt', 'updatedAt'])
@@ -27,49 +38,284 @@ TIMESTAMP_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{3})?(
 CRITICAL_ERROR_THRESHOLD = 1.0
 MISSING_FIELDS_THRESHOLD = 0.5
 EMPTY_FIELDS_THRESHOLD = 0.5
-MAX_ERRORS_TO_COLLECT = 1000
+MAX_ERRORS_TO_COLLECT = int(os.environ.get('MAX_ERRORS_TO_COLLECT', 1000))  # reservoir of sampled errors
+MAX_ERROR_RECORD_BYTES = int(os.environ.get('MAX_ERROR_RECORD_BYTES', 2048))  # record copy kept per sample
 PROGRESS_LOG_INTERVAL = 100000
 
+# Every failure is also written to paged gzip NDJSON objects, one page series per error code
+ERROR_PAGE_SIZE = int(os.environ.get('ERROR_PAGE_SIZE', 1000))  # errors per page
+
+# Optional duplicate id check, a fixed-size Bloom filter pass then an exact count of the candidates;
+# enabled by DUPLICATE_CHECK or the input's checkDuplicates (validation_cache.validation_options)
+DUPLICATE_ID_FIELD = os.environ.get('DUPLICATE_ID_FIELD', 'id')
+DUPLICATE_FILTER_MB = float(os.environ.get('DUPLICATE_FILTER_MB', 128))  # rounded down to a power of two
+DUPLICATE_MAX_CANDIDATES = int(os.environ.get('DUPLICATE_MAX_CANDIDATES', 1000000))
+DUPLICATE_SAMPLE_SIZE = int(os.environ.get('DUPLICATE_SAMPLE_SIZE', 100))
+
+# Optional early abort: a sequential test over random byte-range samples rejects a file whose error rate
+# is clearly above CRITICAL_ERROR_THRESHOLD before the full scan; enabled by EARLY_ABORT or the input's earlyAbort
+EARLY_ABORT_CONFIDENCE = float(os.environ.get('EARLY_ABORT_CONFIDENCE', 0.99))  # of not rejecting a file at the threshold
+EARLY_ABORT_MISS_RATE = float(os.environ.get('EARLY_ABORT_MISS_RATE', 0.05))  # a missed reject only costs the full scan
+EARLY_ABORT_REJECT_FACTOR = float(os.environ.get('EARLY_ABORT_REJECT_FACTOR', 3))  # reject rate as a multiple of the threshold
+EARLY_ABORT_RANGE_BYTES = int(os.environ.get('EARLY_ABORT_RANGE_BYTES', 64 * 1024))
+EARLY_ABORT_MAX_RANGES = int(os.environ.get('EARLY_ABORT_MAX_RANGES', 32))
+EARLY_ABORT_MIN_RANGES = int(os.environ.get('EARLY_ABORT_MIN_RANGES', 4))  # and ranges with errors needed to reject
+EARLY_ABORT_MIN_FILE_BYTES = int(os.environ.get('EARLY_ABORT_MIN_FILE_BYTES', 64 * 1024 * 1024))  # smaller files are scanned in full
+EARLY_ABORT_THREADS = 8
+
+# Validation error codes
+EMPTY_RECORD = 'EMPTY_RECORD'
+NOT_AN_OBJECT = 'NOT_AN_OBJECT'
+MISSING_REQUIRED_FIELDS = 'MISSING_REQUIRED_FIELDS'
+EMPTY_REQUIRED_FIELDS = 'EMPTY_REQUIRED_FIELDS'
+INVALID_EMAIL = 'INVALID_EMAIL'
+INVALID_STATUS = 'INVALID_STATUS'
+INVALID_ID = 'INVALID_ID'
+INVALID_NAME = 'INVALID_NAME'
+INVALID_TIMESTAMP = 'INVALID_TIMESTAMP'
+MALFORMED_JSON = 'MALFORMED_JSON'
+VALIDATOR_ERROR = 'VALIDATOR_ERROR'
+
+# Error codes behind the missingRecordPatterns counters
+ERROR_PATTERNS = {
+    EMPTY_RECORD: 'empty_records',
+    MISSING_REQUIRED_FIELDS: 'missing_required_fields',
+    EMPTY_REQUIRED_FIELDS: 'empty_required_fields',
+    INVALID_EMAIL: 'invalid_emails',
+    INVALID_STATUS: 'invalid_statuses',
+    INVALID_TIMESTAMP: 'invalid_timestamps',
+    MALFORMED_JSON: 'malformed_json'
+}
+
 class ValidationError(Exception):
     """Custom exception for validation errors"""
     pass
 
+class ErrorPageWriter:
+    """Writes every validation error to gzip compressed NDJSON pages, one series of pages per error code.
+
+    Page n of a code holds that code's errors from n * page_size on, so a reader can go
+    from the small index written by close() straight to any offset of any code. Only the
+    open page of each code is held in memory and full pages are uploaded as they fill.
+    """
+    
+    def __init__(self, bucket: str, batch_id: str, page_size: int = ERROR_PAGE_SIZE):
+        self.bucket = bucket
+        self.page_key = f"validation/{batch_id}/errors/{{code}}/page-{{page:05d}}.ndjson.gz"
+        self.index_key = f"validation/{batch_id}/errors/index.json"
+        self.page_size = page_size
+        self.codes = defaultdict(lambda: {'errors': 0, 'pages': 0, 'bytes': 0})
+        self._pages = {}
+    
+    def write(self, error: Dict[str, Any]):
+        code = error['code']
+        page = self._pages.get(code)
+        if page is None:
+            buffer = io.BytesIO()
+            page = self._pages[code] = {'buffer': buffer, 'gzip': gzip.GzipFile(fileobj=buffer, mode='wb'), 'errors': 0}
+        page['gzip'].write(json.dumps(error, separators=(',', ':'), default=str).encode('utf-8') + b'\n')
+        page['errors'] += 1
+        self.codes[code]['errors'] += 1
+        if page['errors'] >= self.page_size:
+            self._flush_page(code)
+    
+    def _flush_page(self, code: str):
+        page = self._pages.pop(code)
+        page['gzip'].close()
+        body = page['buffer'].getvalue()
+        code_info = self.codes[code]
+        key = self.page_key.format(code=code, page=code_info['pages'])
+        s3_io.upload_bytes(self.bucket, key, body, {'ContentType': 'application/gzip'})
+        code_info['pages'] += 1
+        code_info['bytes'] += len(body)
+    
+    def close(self) -> Dict[str, Any]:
+        """Upload the partial last pages and return the page index"""
+        for code in list(self._pages):
+            self._flush_page(code)
+        return {
+            'format': 'ndjson',
+            'compression': 'gzip',
+            'pageSize': self.page_size,
+            'pageKey': self.page_key,
+            'indexKey': self.index_key,
+            'errors': sum(code_info['errors'] for code_info in self.codes.values()),
+            'bytes': sum(code_info['bytes'] for code_info in self.codes.values()),
+            'codes': {code: dict(self.codes[code]) for code in sorted(self.codes)}
+        }
+
+class DuplicateIdDetector:
+    """Memory-bounded duplicate check over one record field.
+
+    The first pass adds every id to a blocked Bloom filter: each id sets 8 bits of a single
+    64-bit word, so a lookup touches one word. An id whose bits were all set already is a
+    duplicate or a false positive, and its hash is kept as a candidate. The second pass
+    re-reads only the ids and counts the candidates exactly, which drops the false positives.
+    Memory is the filter plus at most max_candidates hashes and counts, however large the
+    file; candidates past the cap are counted but not checked.
+    """
+    
+    # Two bit positions of a 64-bit word per 12-bit index, four lookups give the 8 bits of an id
+    BIT_PAIRS = [(1 << (index & 63)) | (1 << (index >> 6)) for index in range(4096)]
+    
+    def __init__(self, field: str = DUPLICATE_ID_FIELD, filter_mb: float = DUPLICATE_FILTER_MB,
+                 max_candidates: int = DUPLICATE_MAX_CANDIDATES):
+        self.field = field
+        # The largest power of two of 64-bit words that fits, so a block is picked with a mask
+        self.block_bits = max(0, int(filter_mb * 1024 * 1024 // 8).bit_length() - 1)
+        self.block_mask = (1 << self.block_bits) - 1
+        self.filter = array('Q', bytes(8 << self.block_bits))
+        self.max_candidates = max_candidates
+        self.candidates = set()
+        self.candidates_dropped = 0
+        self.ids_checked = 0
+        self.counts = {}
+    
+    def id_key(self, record: Any) -> Optional[str]:
+        """The id compared as a string, None when the record has no usable id"""
+        if not isinstance(record, dict):
+            return None
+        value = record.get(self.field)
+        if isinstance(value, bool) or not isinstance(value, (str, int)) or value == '':
+            return None
+        return str(value)
+    
+    @staticmethod
+    def hash_key(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest(), 'little')
+    
+    def add(self, record: Any):
+        """First pass: set the id's bits and keep it as a candidate when they were all set"""
+        key = self.id_key(record)
+        if key is None:
+            return
+        self.ids_checked += 1
+        h = self.hash_key(key)
+        pairs = self.BIT_PAIRS
+        pattern = pairs[(h >> 64) & 4095] | pairs[(h >> 76) & 4095] | pairs[(h >> 88) & 4095] | pairs[(h >> 100) & 4095]
+        block = h & self.block_mask
+        word = self.filter[block]
+        if word & pattern != pattern:
+            self.filter[block] = word | pattern
+        elif h not in self.candidates:
+            if len(self.candidates) < self.max_candidates:
+                self.candidates.add(h)
+            else:
+                self.candidates_dropped += 1
+    
+    def count(self, record: Any, line_number: int):
+        """Second pass: count every occurrence of a candidate id exactly"""
+        key = self.id_key(record)
+        if key is None or self.hash_key(key) not in self.candidates:
+            return
+        entry = self.counts.get(key)
+        if entry is None:
+            self.counts[key] = [1, line_number, None]
+        else:
+            entry[0] += 1
+            if entry[2] is None:
+                entry[2] = line_number
+    
+    def false_positive_rate(self) -> float:
+        """False positive rate of the full filter over the Poisson spread of ids per word.
+
+        Ids added earlier met an emptier filter, so this bounds the share of false candidates.
+        """
+        load = self.ids_checked / len(self.filter)
+        rate = 0.0
+        probability = math.exp(-load)
+        for ids in range(int(load + 10 * math.sqrt(load)) + 20):
+            rate += probability * (1 - (63 / 64) ** (8 * ids)) ** 8
+            probability *= load / (ids + 1)
+        return rate
+    
+    def get_summary(self) -> Dict[str, Any]:
+        duplicates = sorted((entry[1], key, entry) for key, entry in self.counts.items() if entry[0] > 1)
+        return {
+            'field': self.field,
+            'idsChecked': self.ids_checked,
+            'duplicateIds': len(duplicates),
+            'duplicateRecords': sum(entry[0] - 1 for _, _, entry in duplicates),
+            'candidates': len(self.candidates),
+            'candidatesDropped': self.candidates_dropped,
+            'complete': self.candidates_dropped == 0,
+            'filterBytes': len(self.filter) * 8,
+            'falsePositiveRate': self.false_positive_rate(),
+            'samples': [
+                {'id': key, 'occurrences': entry[0], 'firstLine': entry[1], 'secondLine': entry[2]}
+                for _, key, entry in duplicates[:DUPLICATE_SAMPLE_SIZE]
+            ]
+        }
+
+def truncate_record(record: Any, max_bytes: int = MAX_ERROR_RECORD_BYTES) -> Tuple[Any, bool]:
+    """The record itself when it serializes within max_bytes, else a prefix of its JSON"""
+    data = record if isinstance(record, str) else json.dumps(record, separators=(',', ':'), default=str)
+    if len(data) <= max_bytes:
+        return record, False
+    return data[:max_bytes], True
+
 class ValidationResult:
-    """Class to hold validation results with better memory management"""
+    """Class to hold validation results with better memory management.
+
+    Every error is counted by code and written to the error pages, while a fixed-size
+    reservoir (algorithm R) keeps a uniform sample of the errors of the whole file.
+    """
     
-    def __init__(self):
+    def __init__(self, error_pages: Optional[ErrorPageWriter] = None, seed: Optional[str] = None):
         self.records_processed = 0
         self.records_validated = 0
         self.records_failed = 0
         self.validation_errors = []
-        self.error_patterns = defaultdict(int)
+        self.errors_seen = 0
+        self.error_codes = defaultdict(int)
+        self.error_pages = error_pages
+        self.rng = random.Random(seed)
         self.start_time = time.time()
     
-    def add_error(self, line_number: int, error_message: str, field_errors: List[str], record: Any):
-        """Add validation error with memory management"""
+    def add_error(self, line_number: Optional[int], code: str, error_message: str, field_errors: List[str], record: Any,
+                  byte_offset: Optional[int] = None):
+        """Count an error, page it and offer it to the sample reservoir.
+
+        Errors found in byte-range samples have no line number, only the byte offset of their line.
+        """
+        self.errors_seen += 1
+        self.error_codes[code] += 1
+        error = {
+            'lineNumber': line_number,
+            'code': code,
+            'error': error_message,
+            'fieldErrors': field_errors,
+            'record': record
+        }
+        if byte_offset is not None:
+            error['byteOffset'] = byte_offset
+        if self.error_pages is not None:
+            self.error_pages.write(error)
+        
+        # Reservoir sampling: the n-th error replaces a kept one with probability k/n
         if len(self.validation_errors) < MAX_ERRORS_TO_COLLECT:
-            self.validation_errors.append({
-                'lineNumber': line_number,
-                'error': error_message,
-                'fieldErrors': field_errors,
-                'record': record
-            })
-        
-        # Categorize error for pattern analysis
-        if "empty or null" in error_message:
-            self.error_patterns['empty_records'] += 1
-        elif "Missing required fields" in error_message:
-            self.error_patterns['missing_required_fields'] += 1
-        elif "Empty required fields" in error_message:
-            self.error_patterns['empty_required_fields'] += 1
-        elif "Invalid email" in error_message:
-            self.error_patterns['invalid_emails'] += 1
-        elif "Invalid status" in error_message:
-            self.error_patterns['invalid_statuses'] += 1
-        elif "Invalid timestamp" in error_message:
-            self.error_patterns['invalid_timestamps'] += 1
-        elif "Invalid JSON" in error_message:
-            self.error_patterns['malformed_json'] += 1
+            slot = len(self.validation_errors)
+            self.validation_errors.append(None)
+        else:
+            slot = self.rng.randrange(self.errors_seen)
+            if slot >= MAX_ERRORS_TO_COLLECT:
+                return
+        error['record'], truncated = truncate_record(record)
+        if truncated:
+            error['recordTruncated'] = True
+        self.validation_errors[slot] = error
+    
+    @property
+    def error_patterns(self) -> Dict[str, int]:
+        """Error counts under their missingRecordPatterns names"""
+        patterns = defaultdict(int)
+        for code, count in self.error_codes.items():
+            if code in ERROR_PATTERNS:
+                patterns[ERROR_PATTERNS[code]] = count
+        return patterns
+    
+    def get_sampled_errors(self) -> List[Dict[str, Any]]:
+        return sorted(self.validation_errors, key=lambda error: (error['lineNumber'] or 0, error.get('byteOffset', 0)))
     
     def get_statistics(self) -> Dict[str, Any]:
         """Get validation statistics"""
@@ -99,16 +345,19 @@ def is_valid_timestamp(timestamp: str) -> bool:
         return False
     return bool(TIMESTAMP_PATTERN.match(timestamp))
 
-def validate_record_format(record: Any, line_number: int) -> Tuple[bool, str, List[str]]:
-    """Optimized record validation with early returns and better error handling"""
+def validate_record_format(record: Any, line_number: int) -> Tuple[bool, Optional[str], str, List[str]]:
+    """Optimized record validation with early returns and better error handling.
+
+    Returns (is_valid, error code, error message, field errors).
+    """
     try:
         # Quick null/empty check
         if not record:
-            return False, "Record is empty or null", []
+            return False, EMPTY_RECORD, "Record is empty or null", []
         
         # Type check
         if not isinstance(record, dict):
-            return False, f"Record must be a JSON object, got {type(record).__name__}", []
+            return False, NOT_AN_OBJECT, f"Record must be a JSON object, got {type(record).__name__}", []
         
         # Check required fields efficiently
         missing_fields = []
@@ -124,44 +373,45 @@ def validate_record_format(record: Any, line_number: int) -> Tuple[bool, str, Li
         
         # Early return for missing fields
         if missing_fields:
-            return False, f"Missing required fields: {missing_fields}", missing_fields
+            return False, MISSING_REQUIRED_FIELDS, f"Missing required fields: {missing_fields}", missing_fields
         
         if empty_fields:
-            return False, f"Empty required fields: {empty_fields}", empty_fields
+            return False, EMPTY_REQUIRED_FIELDS, f"Empty required fields: {empty_fields}", empty_fields
         
         # Validate email efficiently
         if 'email' in record:
             if not is_valid_email(record['email']):
-                return False, f"Invalid email format: {record['email']}", ['email']
+                return False, INVALID_EMAIL, f"Invalid email format: {record['email']}", ['email']
         
         # Validate status efficiently
         if 'status' in record and record['status'] not in VALID_STATUSES:
-            return False, f"Invalid status: {record['status']}", ['status']
+            return False, INVALID_STATUS, f"Invalid status: {record['status']}", ['status']
         
         # Validate ID
         if 'id' in record:
             record_id = record['id']
             if not isinstance(record_id, (str, int)) or str(record_id).strip() == "":
-                return False, f"Invalid ID format: {record_id}", ['id']
+                return False, INVALID_ID, f"Invalid ID format: {record_id}", ['id']
         
         # Validate name length
         if 'name' in record:
             name = record['name']
             if not isinstance(name, str) or len(name.strip()) < 2 or len(name) > 255:
-                return False, f"Invalid name length: {name}", ['name']
+                return False, INVALID_NAME, f"Invalid name length: {name}", ['name']
         
         # Validate timestamps efficiently
         for field in ['createdAt', 'updatedAt']:
             if field in record and not is_valid_timestamp(record[field]):
-                return False, f"Invalid timestamp format for {field}: {record[field]}", [field]
+                return False, INVALID_TIMESTAMP, f"Invalid timestamp format for {field}: {record[field]}", [field]
         
-        return True, "", []
+        return True, None, "", []
         
     except Exception as e:
         logger.error(f"Validation error on line {line_number}: {str(e)}")
-        return False, f"Validation error: {str(e)}", []
+        return False, VALIDATOR_ERROR, f"Validation error: {str(e)}", []
 
-def process_chunk(chunk_data: str, start_line: int, validation_result: ValidationResult) -> None:
+def process_chunk(chunk_data: str, start_line: int, validation_result: ValidationResult,
+                  duplicates: Optional[DuplicateIdDetector] = None) -> None:
     """Process a chunk of data efficiently"""
     chunk_lines = chunk_data.splitlines()
     
@@ -173,18 +423,21 @@ def process_chunk(chunk_data: str, start_line: int, validation_result: Validatio
         
         try:
             record = json.loads(line)
-            is_valid, error_message, field_errors = validate_record_format(record, line_number)
+            if duplicates is not None:
+                duplicates.add(record)
+            is_valid, code, error_message, field_errors = validate_record_format(record, line_number)
             
             if is_valid:
                 validation_result.records_validated += 1
             else:
                 validation_result.records_failed += 1
-                validation_result.add_error(line_number, error_message, field_errors, record)
+                validation_result.add_error(line_number, code, error_message, field_errors, record)
                 
         except json.JSONDecodeError as je:
             validation_result.records_failed += 1
             validation_result.add_error(
                 line_number, 
+                MALFORMED_JSON,
                 f"Invalid JSON: {str(je)}", 
                 [], 
                 line
@@ -197,9 +450,268 @@ def process_chunk(chunk_data: str, start_line: int, validation_result: Validatio
             logger.info(f"Validated {validation_result.records_processed:,} records... "
                        f"({validation_result.records_failed:,} errors so far)")
 
-def validate_file_with_s3_select(bucket: str, file_key: str, batch_id: str) -> Dict[str, Any]:
+class SequentialErrorRateTest:
+    """Sequential test of a file's record error rate with byte ranges as the sampling unit.
+
+    The records of one range are read together and their errors cluster, so the ranges are the
+    independent samples, not the records. The rate is the ratio estimate over all ranges read so
+    far, with the variance of a ratio estimator over clusters (never below the binomial variance)
+    and Student t quantiles for the ranges read. The file is rejected once the rate is above the
+    threshold at the given confidence and errors were seen in at least min_ranges ranges, and
+    accepted once it is below the reject rate at 1 - miss_rate. Both error budgets are split
+    evenly over max_looks, so testing after every range keeps the overall levels.
+    """
+    
+    def __init__(self, threshold_rate: float, reject_factor: float = EARLY_ABORT_REJECT_FACTOR,
+                 confidence: float = EARLY_ABORT_CONFIDENCE, miss_rate: float = EARLY_ABORT_MISS_RATE,
+                 min_ranges: int = EARLY_ABORT_MIN_RANGES, max_looks: int = EARLY_ABORT_MAX_RANGES):
+        self.threshold_rate = threshold_rate
+        self.reject_rate = min(threshold_rate * reject_factor, 0.999)
+        self.confidence = confidence
+        self.min_ranges = max(2, min_ranges)
+        looks = max(1, max_looks - self.min_ranges + 1)
+        self.reject_z = statistics.NormalDist().inv_cdf(1 - (1 - confidence) / looks)
+        self.accept_z = statistics.NormalDist().inv_cdf(1 - miss_rate / looks)
+        self.ranges = []
+    
+    @staticmethod
+    def t_quantile(z: float, degrees: int) -> float:
+        """Student t quantile for a normal quantile z (Cornish-Fisher expansion)"""
+        return (z + (z ** 3 + z) / (4 * degrees)
+                + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * degrees ** 2))
+    
+    def add_range(self, records: int, errors: int):
+        """Add the counts of one validated range; ranges without a complete record carry no information"""
+        if records > 0:
+            self.ranges.append((records, errors))
+    
+    def estimate(self) -> Dict[str, Any]:
+        """Ratio estimate of the error rate and its standard error over the ranges read"""
+        count = len(self.ranges)
+        records = sum(range_records for range_records, _ in self.ranges)
+        errors = sum(range_errors for _, range_errors in self.ranges)
+        rate = errors / records if records else 0.0
+        if count < 2:
+            return {'ranges': count, 'records': records, 'errors': errors, 'rate': rate,
+                    'standardError': float('inf'), 'errorRanges': sum(1 for _, e in self.ranges if e)}
+        mean_records = records / count
+        residuals = sum((range_errors - rate * range_records) ** 2 for range_records, range_errors in self.ranges)
+        cluster_variance = residuals / (count * (count - 1) * mean_records ** 2)
+        binomial_variance = rate * (1 - rate) / records
+        return {
+            'ranges': count,
+            'records': records,
+            'errors': errors,
+            'rate': rate,
+            'standardError': math.sqrt(max(cluster_variance, binomial_variance)),
+            'errorRanges': sum(1 for _, range_errors in self.ranges if range_errors)
+        }
+    
+    def bounds(self, estimate: Dict[str, Any]) -> Tuple[float, float]:
+        """Lower bound for rejecting and upper bound for accepting at the current number of ranges"""
+        if estimate['ranges'] < 2:
+            return 0.0, 1.0
+        degrees = estimate['ranges'] - 1
+        lower = estimate['rate'] - self.t_quantile(self.reject_z, degrees) * estimate['standardError']
+        upper = estimate['rate'] + self.t_quantile(self.accept_z, degrees) * estimate['standardError']
+        return lower, upper
+    
+    def decision(self) -> Optional[str]:
+        """REJECTED or ACCEPTED once a bound is crossed, None while the ranges are inconclusive"""
+        estimate = self.estimate()
+        if estimate['ranges'] < self.min_ranges:
+            return None
+        lower, upper = self.bounds(estimate)
+        if lower > self.threshold_rate and estimate['errorRanges'] >= self.min_ranges:
+            return 'REJECTED'
+        if upper < self.reject_rate:
+            return 'ACCEPTED'
+        return None
+
+def validate_sample(data: bytes, offset: int, at_end: bool, sample: ValidationResult):
+    """Validate the complete lines of a byte range; the cut lines at either end are skipped"""
+    lines = data.split(b'\n')
+    position = offset
+    if offset > 0:
+        position += len(lines.pop(0)) + 1
+    if not at_end and lines:
+        lines.pop()
+    for line in lines:
+        line_offset = position
+        position += len(line) + 1
+        text = line.decode('utf-8', errors='replace')
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+            is_valid, code, error_message, field_errors = validate_record_format(record, 0)
+            if is_valid:
+                sample.records_validated += 1
+            else:
+                sample.records_failed += 1
+                sample.add_error(None, code, error_message, field_errors, record, line_offset)
+        except json.JSONDecodeError as je:
+            sample.records_failed += 1
+            sample.add_error(None, MALFORMED_JSON, f"Invalid JSON: {str(je)}", [], text, line_offset)
+        sample.records_processed += 1
+
+def sample_error_rate(bucket: str, file_key: str, batch_id: str, file_size: int) -> Tuple[Dict[str, Any], ValidationResult]:
+    """Validate random byte ranges until the sequential test decides or the ranges run out.
+
+    One range is drawn at random from each of EARLY_ABORT_MAX_RANGES equal strata of the object
+    and the ranges are tested in random order, so early decisions already see the whole file.
+    """
+    start_time = time.time()
+    rng = random.Random(f"{batch_id}:{file_key}")
+    range_count = max(1, min(EARLY_ABORT_MAX_RANGES, file_size // EARLY_ABORT_RANGE_BYTES))
+    stratum = file_size // range_count
+    offsets = [index * stratum + rng.randrange(max(1, stratum - EARLY_ABORT_RANGE_BYTES + 1)) for index in range(range_count)]
+    rng.shuffle(offsets)
+    
+    test = SequentialErrorRateTest(CRITICAL_ERROR_THRESHOLD / 100)
+    sample = ValidationResult(seed=batch_id)
+    decision = None
+    ranges_read = 0
+    bytes_read = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=EARLY_ABORT_THREADS) as executor:
+        futures = [executor.submit(s3_io.read_range, bucket, file_key, offset,
+                                   min(EARLY_ABORT_RANGE_BYTES, file_size - offset)) for offset in offsets]
+        for offset, future in zip(offsets, futures):
+            data = future.result()
+            records, errors = sample.records_processed, sample.records_failed
+            validate_sample(data, offset, offset + len(data) >= file_size, sample)
+            test.add_range(sample.records_processed - records, sample.records_failed - errors)
+            ranges_read += 1
+            bytes_read += len(data)
+            decision = test.decision()
+            if decision:
+                break
+        for future in futures:
+            future.cancel()
+    
+    estimate = test.estimate()
+    lower, upper = test.bounds(estimate)
+    summary = {
+        'decision': decision or 'INCONCLUSIVE',
+        'confidence': test.confidence,
+        'thresholdRate': CRITICAL_ERROR_THRESHOLD,
+        'rejectRate': test.reject_rate * 100,
+        'sampledRanges': ranges_read,
+        'sampledBytes': bytes_read,
+        'sampledRecords': sample.records_processed,
+        'sampledErrors': sample.records_failed,
+        'sampleErrorRate': sample.records_failed / sample.records_processed * 100 if sample.records_processed else 0,
+        'errorRanges': estimate['errorRanges'],
+        'standardError': estimate['standardError'] * 100 if estimate['ranges'] >= 2 else None,
+        # Error rate bounds the decision compares with the threshold (lower) and reject rate (upper)
+        'bounds': [lower * 100, upper * 100],
+        'samplingTime': time.time() - start_time
+    }
+    logger.info(f"Early abort sampling of {file_key}: {summary['decision']} after {ranges_read} ranges, "
+                f"{sample.records_failed:,} errors in {sample.records_processed:,} records")
+    return summary, sample
+
+def early_abort_results(bucket: str, file_key: str, batch_id: str, sample: ValidationResult,
+                        early_abort: Dict[str, Any]) -> Dict[str, Any]:
+    """Results of a file rejected on its samples, in the shape of full validation results"""
+    stats = sample.get_statistics()
+    sampled_errors = sample.get_sampled_errors()
+    error_pages = ErrorPageWriter(bucket, batch_id)
+    for error in sampled_errors:
+        error_pages.write(error)
+    error_patterns = sample.error_patterns
+    records = stats['recordsProcessed']
+    critical_issue = (f"Sampled error rate {stats['errorRate']:.2f}% is above the {CRITICAL_ERROR_THRESHOLD}% "
+                      f"threshold at {early_abort['confidence']:.0%} confidence ({records:,} records in "
+                      f"{early_abort['sampledRanges']} sampled ranges)")
+    return {
+        'batchId': batch_id,
+        'status': 'FAILED',
+        'batchStatus': 'VALIDATION_FAILED_CRITICAL',
+        'errorMessage': f"Validation failed - Critical data quality issues detected: {critical_issue}",
+        'validationTime': stats['validationTime'],
+        'recordsProcessed': records,
+        'recordsValidated': stats['recordsValidated'],
+        'recordsFailed': stats['recordsFailed'],
+        'errorRate': stats['errorRate'],
+        'validationErrors': sampled_errors,
+        'errorCodes': dict(sample.error_codes),
+        'errorPages': error_pages.close(),
+        'missingRecordPatterns': dict(error_patterns),
+        'validationSummary': {
+            'totalErrors': stats['recordsFailed'],
+            'sampledErrors': len(sampled_errors),
+            'totalRecords': records,
+            'errorRate': stats['errorRate'],
+            'missingFieldsRate': error_patterns['missing_required_fields'] / records * 100 if records else 0,
+            'emptyFieldsRate': error_patterns['empty_required_fields'] / records * 100 if records else 0,
+            'validationType': 'EARLY_ABORT_SAMPLED',
+            'criticalIssues': [critical_issue],
+            'duplicates': None,
+            'earlyAbort': early_abort
+        },
+        'performance': {
+            'recordsPerSecond': stats['recordsPerSecond'],
+            'validationTime': stats['validationTime'],
+            'successRate': stats['recordsValidated'] / records * 100 if records else 0,
+            'totalErrors': stats['recordsFailed'],
+            'bytesScanned': early_abort['sampledBytes']
+        },
+        'metadata': {
+            'source': 'lambda-validator-optimized',
+            'version': '3.0',
+            'validationType': 'EARLY_ABORT_SAMPLED',
+            'fileKey': file_key,
+            'bucket': bucket,
+            'processedAt': datetime.now().isoformat()
+        }
+    }
+
+def count_duplicate_ids(bucket: str, file_key: str, duplicates: DuplicateIdDetector) -> int:
+    """Second pass of the duplicate check over the id column only, returns the bytes scanned"""
+    response = s3_client.select_object_content(
+        Bucket=bucket,
+        Key=file_key,
+        Expression=f'SELECT s."{duplicates.field}" FROM S3Object s',
+        ExpressionType='SQL',
+        InputSerialization={'JSON': {'Type': 'LINES'}},
+        OutputSerialization={'JSON': {'RecordDelimiter': '\n'}}
+    )
+    
+    line_number = 0
+    bytes_scanned = 0
+    for event in response['Payload']:
+        if 'Records' in event:
+            for line in event['Records']['Payload'].splitlines():
+                if not line.strip():
+                    continue
+                line_number += 1
+                try:
+                    duplicates.count(json.loads(line), line_number)
+                except json.JSONDecodeError:
+                    pass
+        elif 'Stats' in event:
+            bytes_scanned = event['Stats']['Details'].get('BytesScanned', 0)
+        elif 'End' in event:
+            break
+        elif 'Error' in event:
+            raise ValidationError(f"S3 Select error: {event['Error']['Message']}")
+    return bytes_scanned
+
+def validate_file_with_s3_select(bucket: str, file_key: str, batch_id: str, check_duplicates: bool = False,
+                                 early_abort: bool = False, file_size: Optional[int] = None) -> Dict[str, Any]:
     """Optimized file validation using S3 Select with better memory management"""
-    validation_result = ValidationResult()
+    # Files large enough to be worth it are sampled first, a clearly bad one is rejected on its samples
+    early_abort_summary = None
+    if early_abort and file_size and file_size >= EARLY_ABORT_MIN_FILE_BYTES:
+        early_abort_summary, sample = sample_error_rate(bucket, file_key, batch_id, file_size)
+        if early_abort_summary['decision'] == 'REJECTED':
+            return early_abort_results(bucket, file_key, batch_id, sample, early_abort_summary)
+    
+    error_pages = ErrorPageWriter(bucket, batch_id)
+    validation_result = ValidationResult(error_pages, seed=batch_id)
+    duplicates = DuplicateIdDetector() if check_duplicates else None
+    bytes_scanned = 0
     
     try:
         logger.info(f"Starting optimized validation for {file_key}")
@@ -224,7 +736,10 @@ def validate_file_with_s3_select(bucket: str, file_key: str, batch_id: str) -> D
         for event in response['Payload']:
             if 'Records' in event:
                 chunk_data = event['Records']['Payload'].decode('utf-8')
-                process_chunk(chunk_data, validation_result.records_processed + 1, validation_result)
+                process_chunk(chunk_data, validation_result.records_processed + 1, validation_result, duplicates)
+                
+            elif 'Stats' in event:
+                bytes_scanned = event['Stats']['Details'].get('BytesScanned', 0)
                 
             elif 'End' in event:
                 break
@@ -234,8 +749,22 @@ def validate_file_with_s3_select(bucket: str, file_key: str, batch_id: str) -> D
                 logger.error(f"S3 Select error: {error_msg}")
                 raise ValidationError(f"S3 Select error: {error_msg}")
         
+        # Only files whose first pass found candidates are read a second time
+        duplicate_summary = None
+        if duplicates is not None:
+            if duplicates.candidates:
+                logger.info(f"Counting {len(duplicates.candidates):,} duplicate id candidates")
+                bytes_scanned += count_duplicate_ids(bucket, file_key, duplicates)
+            duplicate_summary = duplicates.get_summary()
+            if duplicate_summary['duplicateIds']:
+                logger.warning(f"Found {duplicate_summary['duplicateIds']:,} duplicate {duplicates.field} values "
+                               f"in {duplicate_summary['duplicateRecords']:,} extra records")
+        
         # Calculate final statistics
         stats = validation_result.get_statistics()
+        error_index = error_pages.close()
+        sampled_errors = validation_result.get_sampled_errors()
+        error_patterns = validation_result.error_patterns
         
         # Check for critical issues
         critical_issues = []
@@ -243,27 +772,27 @@ def validate_file_with_s3_select(bucket: str, file_key: str, batch_id: str) -> D
         if stats['errorRate'] > CRITICAL_ERROR_THRESHOLD:
             critical_issues.append(f"Critical error rate: {stats['errorRate']:.2f}% (threshold: {CRITICAL_ERROR_THRESHOLD}%)")
         
-        missing_fields_rate = (validation_result.error_patterns['missing_required_fields'] / stats['recordsProcessed'] * 100) if stats['recordsProcessed'] > 0 else 0
+        missing_fields_rate = (error_patterns['missing_required_fields'] / stats['recordsProcessed'] * 100) if stats['recordsProcessed'] > 0 else 0
         if missing_fields_rate > MISSING_FIELDS_THRESHOLD:
             critical_issues.append(f"Critical missing fields rate: {missing_fields_rate:.2f}% (threshold: {MISSING_FIELDS_THRESHOLD}%)")
         
-        empty_fields_rate = (validation_result.error_patterns['empty_required_fields'] / stats['recordsProcessed'] * 100) if stats['recordsProcessed'] > 0 else 0
+        empty_fields_rate = (error_patterns['empty_required_fields'] / stats['recordsProcessed'] * 100) if stats['recordsProcessed'] > 0 else 0
         if empty_fields_rate > EMPTY_FIELDS_THRESHOLD:
             critical_issues.append(f"Critical empty fields rate: {empty_fields_rate:.2f}% (threshold: {EMPTY_FIELDS_THRESHOLD}%)")
         
         # Check specific patterns
-        if validation_result.error_patterns['malformed_json'] > 100:
-            critical_issues.append(f"Too many malformed JSON records: {validation_result.error_patterns['malformed_json']}")
+        if error_patterns['malformed_json'] > 100:
+            critical_issues.append(f"Too many malformed JSON records: {error_patterns['malformed_json']}")
         
-        if validation_result.error_patterns['empty_records'] > 1000:
-            critical_issues.append(f"Too many empty records: {validation_result.error_patterns['empty_records']}")
+        if error_patterns['empty_records'] > 1000:
+            critical_issues.append(f"Too many empty records: {error_patterns['empty_records']}")
         
         # Determine validation status
         if critical_issues:
             status = 'FAILED'
             batch_status = 'VALIDATION_FAILED_CRITICAL'
             error_message = f"Validation failed - Critical data quality issues detected: {'; '.join(critical_issues)}"
-        elif stats['errorRate'] > 5 or len(validation_result.validation_errors) > MAX_ERRORS_TO_COLLECT:
+        elif stats['errorRate'] > 5:
             status = 'FAILED'
             batch_status = 'VALIDATION_FAILED'
             error_message = f"Validation failed - {stats['errorRate']:.2f}% error rate ({stats['recordsFailed']:,} errors out of {stats['recordsProcessed']:,} records)"
@@ -283,22 +812,28 @@ def validate_file_with_s3_select(bucket: str, file_key: str, batch_id: str) -> D
             'recordsValidated': stats['recordsValidated'],
             'recordsFailed': stats['recordsFailed'],
             'errorRate': stats['errorRate'],
-            'validationErrors': validation_result.validation_errors,
-            'missingRecordPatterns': dict(validation_result.error_patterns),
+            'validationErrors': sampled_errors,
+            'errorCodes': dict(validation_result.error_codes),
+            'errorPages': error_index,
+            'missingRecordPatterns': dict(error_patterns),
             'validationSummary': {
-                'totalErrors': len(validation_result.validation_errors),
+                'totalErrors': stats['recordsFailed'],
+                'sampledErrors': len(sampled_errors),
                 'totalRecords': stats['recordsProcessed'],
                 'errorRate': stats['errorRate'],
                 'missingFieldsRate': missing_fields_rate,
                 'emptyFieldsRate': empty_fields_rate,
                 'validationType': 'OPTIMIZED_FULL_FILE_VALIDATION',
-                'criticalIssues': critical_issues
+                'criticalIssues': critical_issues,
+                'duplicates': duplicate_summary,
+                'earlyAbort': early_abort_summary
             },
             'performance': {
                 'recordsPerSecond': stats['recordsPerSecond'],
                 'validationTime': stats['validationTime'],
                 'successRate': ((stats['recordsProcessed'] - stats['recordsFailed']) / stats['recordsProcessed'] * 100) if stats['recordsProcessed'] > 0 else 0,
-                'totalErrors': len(validation_result.validation_errors)
+                'totalErrors': stats['recordsFailed'],
+                'bytesScanned': bytes_scanned + (early_abort_summary['sampledBytes'] if early_abort_summary else 0)
             },
             'metadata': {
                 'source': 'lambda-validator-optimized',
@@ -322,6 +857,37 @@ def validate_file_with_s3_select(bucket: str, file_key: str, batch_id: str) -> D
         logger.error(f"Error in optimized validation: {str(e)}")
         raise
 
+def results_from_cache(entry: Dict[str, Any], batch_id: str) -> Dict[str, Any]:
+    """The cached validation results of an earlier batch over the same object version, for this batch"""
+    validation_results = dict(entry['results'], batchId=batch_id)
+    error_pages = validation_results.get('errorPages')
+    if error_pages:
+        # The error pages stay with the batch that wrote them, only their index is written for this one
+        validation_results['errorPages'] = dict(error_pages, indexKey=f"validation/{batch_id}/errors/index.json")
+    validation_results['validationCache'] = {
+        'hit': True,
+        'cacheKey': entry['cacheKey'],
+        'cachedAt': entry['cachedAt'],
+        'sourceBatchId': entry['batchId']
+    }
+    return validation_results
+
+def cache_validation_results(bucket: str, file_key: str, source: Dict[str, Any], options: Dict[str, Any],
+                             validation_results: Dict[str, Any]) -> Optional[str]:
+    """Cache the verdict unless the object changed while it was being validated.
+
+    A verdict reached on samples is cached without a line index, its record count only covers
+    the sampled ranges.
+    """
+    if validation_cache.head_object(bucket, file_key)['etag'] != source['etag']:
+        logger.warning(f"s3://{bucket}/{file_key} changed during validation, not caching the verdict")
+        return None
+    line_index = None
+    if validation_results['validationSummary']['validationType'] != 'EARLY_ABORT_SAMPLED':
+        line_index = {'records': validation_results['recordsProcessed'], 'bytes': source['size']}
+    return validation_cache.store(bucket, file_key, source['etag'], options, validation_results['batchId'],
+                                  validation_results, line_index)
+
 def upload_validation_results(validation_results: Dict[str, Any], batch_id: str, bucket: str) -> str:
     """Upload validation results to S3 with compression"""
     try:
@@ -339,14 +905,29 @@ def upload_validation_results(validation_results: Dict[str, Any], batch_id: str,
         )
         
         logger.info(f"Uploaded validation results to s3://{bucket}/{validation_key}")
+        
+        # The page index repeats the results without the sampled records, so error
+        # retrieval reads a few kilobytes instead of the whole results document
+        error_pages = validation_results.get('errorPages')
+        if error_pages:
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=error_pages['indexKey'],
+                Body=json.dumps(dict(error_pages, results={
+                    name: value for name, value in validation_results.items() if name not in ('validationErrors', 'errorPages')
+                }), separators=(',', ':'), default=str),
+                ContentType='application/json'
+            )
         return validation_key
         
     except Exception as e:
         logger.error(f"Error uploading validation results: {str(e)}")
         raise
 
+@stage_profiler.profiled('validate')
 def lambda_handler(event, context):
     """Optimized Lambda handler with better error handling and performance monitoring"""
+    metrics = stage_metrics.StageMetrics.for_event('validate', event)
     try:
         logger.info(f"Starting optimized data validation Lambda")
         logger.info(f"Event: {json.dumps(event, default=str)}")
@@ -364,12 +945,43 @@ def lambda_handler(event, context):
         batch_id = event['batchId']
         deployment = event.get('deployment', 'WORKSPACE')
         snapshot_id = event.get('snapshotId')
+        options = validation_cache.validation_options(event)
         
         logger.info(f"Validating file: s3://{bucket}/{file_key}")
         logger.info(f"BatchId: {batch_id}, CustomerId: {customer_id}, TenantId: {tenant_id}")
         
-        # Perform validation
-        validation_results = validate_file_with_s3_select(bucket, file_key, batch_id)
+        # An unchanged object validated before with the same rules is answered from the cache
+        with metrics.timer('Duration'):
+            source = validation_cache.head_object(bucket, file_key)
+            cached = validation_cache.load(bucket, file_key, source['etag'], options) if event.get('useValidationCache', True) else None
+            if cached:
+                logger.info(f"Using cached validation verdict of batch {cached['batchId']} from {cached['cacheKey']}")
+                validation_results = results_from_cache(cached, batch_id)
+            else:
+                validation_results = validate_file_with_s3_select(bucket, file_key, batch_id, options['checkDuplicates'],
+                                                                  options['earlyAbort'], source['size'])
+                validation_results['validationCache'] = {
+                    'hit': False,
+                    'cacheKey': cache_validation_results(bucket, file_key, source, options, validation_results)
+                }
+        
+        if cached:
+            metrics.increment('ValidationCacheHits')
+        else:
+            metrics.increment('ValidationCacheMisses')
+            if validation_results['validationSummary']['validationType'] == 'EARLY_ABORT_SAMPLED':
+                metrics.increment('EarlyAborts')
+            metrics.increment('RecordsIn', validation_results['recordsProcessed'])
+            metrics.increment('RecordsOut', validation_results['recordsValidated'])
+            metrics.increment('RecordsFailed', validation_results['recordsFailed'])
+            metrics.increment('BytesRead', validation_results['performance']['bytesScanned'], stage_metrics.BYTES)
+            metrics.rate('ValidationRate', validation_results['recordsProcessed'], validation_results['validationTime'])
+            duplicate_summary = validation_results['validationSummary']['duplicates']
+            if duplicate_summary:
+                metrics.increment('DuplicateIds', duplicate_summary['duplicateIds'])
+                metrics.increment('DuplicateRecords', duplicate_summary['duplicateRecords'])
+        metrics.gauge('ErrorRate', validation_results['errorRate'], stage_metrics.PERCENT)
+        metrics.increment('ValidationFailed' if validation_results['status'] == 'FAILED' else 'ValidationPassed')
         
         # Update with metadata
         validation_results.update({
@@ -395,6 +1007,7 @@ def lambda_handler(event, context):
         
     except ValidationError as e:
         logger.error(f"Validation error: {str(e)}")
+        metrics.increment('Errors')
         return {
             'statusCode': 400,
             'body': {
@@ -406,6 +1019,7 @@ def lambda_handler(event, context):
         }
     except Exception as e:
         logger.error(f"Unexpected error in validation Lambda: {str(e)}")
+        metrics.increment('Errors')
         return {
             'statusCode': 500,
             'body': {
@@ -414,4 +1028,6 @@ def lambda_handler(event, context):
                 'customerId': event.get('customerId', 'unknown'),
                 'tenantId': event.get('tenantId', 'unknown')
             }
-        } 
\ No newline at end of file
+        } 
+    finally:
+        metrics.flush()
@@ -0,0 +1,83 @@
+import os
+import json
+import mmap
+import tempfile
+from array import array
+from typing import Dict, Any, Iterator
+
+# Disk spill store shared by the stages that can hold more records than fit in memory.
+# Records are kept serialized in a file on the Lambda ephemeral storage, which can be
+# raised to 10GB, and replayed one at a time through an offset array.
+
+SPILL_DIR = os.environ.get('SPILL_DIR', '/tmp')
+SPILL_MAX_BYTES = int(os.environ.get('SPILL_MAX_BYTES', 10 * 1024 ** 3))
+
+class SpillBuffer:
+    """Append-only store of serialized records kept in a memory-mapped file on local disk.
+
+    The file is laid out as a JSON array so it can be uploaded as-is, and an
+    offset array allows records to be replayed one at a time for sending.
+    """
+    
+    def __init__(self, directory: str = SPILL_DIR, max_bytes: int = SPILL_MAX_BYTES):
+        self._file = tempfile.NamedTemporaryFile(dir=directory, prefix='spill-', suffix='.json', delete=False)
+        self.path = self._file.name
+        self.max_bytes = max_bytes
+        self._offsets = array('Q')
+        self._lengths = array('I')
+        self._size = 0
+        self._mmap = None
+        self._write(b'[')
+    
+    def _write(self, data: bytes):
+        if self._size + len(data) > self.max_bytes:
+            raise IOError(f"Spill file exceeded {self.max_bytes:,} bytes")
+        self._file.write(data)
+        self._size += len(data)
+    
+    def append(self, record: Dict[str, Any]):
+        """Serialize a record and append it to the spill file"""
+        self.append_bytes(json.dumps(record, separators=(',', ':')).encode('utf-8'))
+    
+    def append_bytes(self, data: bytes):
+        """Append an already serialized record"""
+        if self._offsets:
+            self._write(b',')
+        self._offsets.append(self._size)
+        self._lengths.append(len(data))
+        self._write(data)
+    
+    def finalize(self):
+        """Close the JSON array and map the file for replay"""
+        if self._mmap is None:
+            self._write(b']')
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def get_bytes(self, index: int) -> bytes:
+        """Return the serialized bytes of a record"""
+        offset = self._offsets[index]
+        return self._mmap[offset:offset + self._lengths[index]]
+    
+    @property
+    def size(self) -> int:
+        return self._size
+    
+    def __len__(self) -> int:
+        return len(self._offsets)
+    
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        self.finalize()
+        for index in range(len(self._offsets)):
+            yield json.loads(self.get_bytes(index))
+    
+    def close(self):
+        """Release the mapping and remove the spill file"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import random
+import logging
+import resource
+import threading
+import tracemalloc
+from typing import Dict, List, Any, Optional
+
+import stage_metrics
+
+# Memory accounting and a memory budget for stage handlers. A MemoryGuard samples the
+# resident set size of the process while a stage runs, keeps the bytes held in named record
+# buffers and tells the stage when it is about to run past its budget, so it can switch to
+# streaming or spilling to disk before Lambda kills it for running out of memory.
+
+logger = logging.getLogger()
+
+MEMORY_BUDGET_FRACTION = float(os.environ.get('MEMORY_BUDGET_FRACTION', 0.8))  # of the Lambda memory size
+MEMORY_BUDGET_MB = int(os.environ.get('MEMORY_BUDGET_MB', 0))  # overrides the fraction when set
+MEMORY_SAMPLE_INTERVAL_MS = float(os.environ.get('MEMORY_SAMPLE_INTERVAL_MS', 100))
+# Parsed JSON takes several times its serialized size as Python objects
+MEMORY_EXPANSION_FACTOR = float(os.environ.get('MEMORY_EXPANSION_FACTOR', 8))
+TRACEMALLOC_SAMPLE_RATE = float(os.environ.get('TRACEMALLOC_SAMPLE_RATE', 0))  # fraction of invocations traced
+TRACEMALLOC_TOP = int(os.environ.get('TRACEMALLOC_TOP', 10))
+
+MB = 1024 * 1024
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def process_peak_rss() -> int:
+    """High-water mark of the process in bytes, including earlier invocations of a warm container"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def current_rss() -> int:
+    """Resident set size of the process in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return process_peak_rss()
+
+def estimate_bytes(records: List[Any]) -> int:
+    """Serialized size of a list of records, extrapolated from its first record"""
+    if not records:
+        return 0
+    try:
+        return len(json.dumps(records[0], default=str).encode('utf-8')) * len(records)
+    except (TypeError, ValueError):
+        return 0
+
+class MemoryGuard:
+    """Peak RSS, record buffer sizes and a memory budget for one stage invocation.
+
+    The peak is sampled by a background thread. When the process high-water mark grew
+    during the invocation it is used instead, as it also catches spikes between samples.
+    With TRACEMALLOC_SAMPLE_RATE set, a fraction of invocations also reports its top
+    allocation sites; tracing slows allocation-heavy code down noticeably.
+    """
+
+    def __init__(self, stage: str, context=None, budget_mb: Optional[float] = None,
+                 trace: Optional[bool] = None):
+        self.stage = stage
+        limit_mb = getattr(context, 'memory_limit_in_mb', None)
+        self.limit_mb = int(limit_mb) if limit_mb else None
+        if budget_mb is None:
+            budget_mb = MEMORY_BUDGET_MB or (self.limit_mb * MEMORY_BUDGET_FRACTION if self.limit_mb else None)
+        self.budget = int(budget_mb * MB) if budget_mb else None
+        self.trace = trace if trace is not None else (
+            TRACEMALLOC_SAMPLE_RATE > 0 and random.random() < TRACEMALLOC_SAMPLE_RATE)
+        self.buffers = {}
+        self.peak_buffers = {}
+        self.actions = []
+        self.top_allocators = None
+        self.traced_peak = None
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._tracing = False
+        self.start_rss = self.peak_rss = current_rss()
+        self._start_process_peak = process_peak_rss()
+
+    def start(self) -> 'MemoryGuard':
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        if MEMORY_SAMPLE_INTERVAL_MS > 0:
+            self._thread = threading.Thread(target=self._run, name='memory-sampler', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(MEMORY_SAMPLE_INTERVAL_MS / 1000):
+            self.sample()
+
+    def sample(self) -> int:
+        """Current RSS in bytes, folded into the peak"""
+        rss = current_rss()
+        with self.lock:
+            self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def set_buffer(self, name: str, size: int):
+        """Bytes currently held in a record buffer, e.g. the downloaded input or the transformed results"""
+        with self.lock:
+            self.buffers[name] = size
+            self.peak_buffers[name] = max(self.peak_buffers.get(name, 0), size)
+
+    def add_buffer(self, name: str, size: int):
+        with self.lock:
+            size += self.buffers.get(name, 0)
+        self.set_buffer(name, size)
+
+    def over_budget(self, extra_bytes: int = 0) -> bool:
+        """Whether RSS plus extra_bytes about to be allocated would pass the budget"""
+        return self.budget is not None and self.sample() + extra_bytes > self.budget
+
+    def would_exceed(self, serialized_bytes: int) -> bool:
+        """Whether parsing serialized_bytes of JSON into Python objects would pass the budget"""
+        return self.over_budget(int(serialized_bytes * MEMORY_EXPANSION_FACTOR))
+
+    def note(self, action: str, reason: str):
+        """Record that the stage switched behaviour to stay within its budget; repeats are counted"""
+        rss = self.sample()
+        for entry in self.actions:
+            if entry['action'] == action:
+                entry['count'] += 1
+                return
+        self.actions.append({'action': action, 'reason': reason, 'rssMb': round(rss / MB, 1), 'count': 1})
+        logger.warning(f"Memory budget: {self.stage} switched to {action} {reason} "
+                       f"(RSS {rss / MB:,.0f}MB, budget {self.budget / MB if self.budget else 0:,.0f}MB)")
+
+    def stop(self):
+        """Stop sampling and take the tracemalloc snapshot; safe to call more than once"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.sample()
+        process_peak = process_peak_rss()
+        if process_peak > self._start_process_peak:
+            with self.lock:
+                self.peak_rss = max(self.peak_rss, process_peak)
+        if self._tracing:
+            snapshot = tracemalloc.take_snapshot()
+            self.traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self._tracing = False
+            self.top_allocators = [
+                {
+                    'location': f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+                    'bytes': stat.size,
+                    'blocks': stat.count
+                }
+                for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]
+            ]
+
+    def get_report(self) -> Dict[str, Any]:
+        report = {
+            'peakRssMb': round(self.peak_rss / MB, 1),
+            'startRssMb': round(self.start_rss / MB, 1),
+            'limitMb': self.limit_mb,
+            'budgetMb': round(self.budget / MB) if self.budget else None,
+            'bufferBytes': dict(self.peak_buffers),
+            'budgetActions': self.actions
+        }
+        if self.top_allocators is not None:
+            report['tracedPeakMb'] = round(self.traced_peak / MB, 1)
+            report['topAllocators'] = self.top_allocators
+        return report
+
+    def record_metrics(self, metrics: stage_metrics.StageMetrics):
+        """Gauge the peak RSS, its share of the memory size and the largest record buffer"""
+        metrics.gauge('PeakMemory', round(self.peak_rss / MB, 1), stage_metrics.MEGABYTES)
+        if self.limit_mb:
+            metrics.gauge('MemoryUtilization', self.peak_rss / MB / self.limit_mb * 100, stage_metrics.PERCENT)
+        if self.peak_buffers:
+            metrics.gauge('BufferBytes', max(self.peak_buffers.values()), stage_metrics.BYTES)
+        if self.actions:
+            metrics.increment('MemoryBudgetActions', sum(entry['count'] for entry in self.actions))
@@ -0,0 +1,298 @@
+import os
+import sys
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Any, Optional, Tuple
+
+# Per-stage counters and timers emitted as CloudWatch Embedded Metric Format (EMF) log lines.
+# Lambda extracts EMF documents written to stdout into CloudWatch metrics, so every stage
+# can be charted by Stage, TenantId and BatchId without a log parsing job.
+
+logger = logging.getLogger()
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'SCMBatchProcessor')
+# The BatchId dimension set creates one metric series per batch, disable it to cut metric cost
+METRICS_BATCH_DIMENSION = os.environ.get('METRICS_BATCH_DIMENSION', 'true').lower() == 'true'
+
+# EMF limits per document
+EMF_MAX_METRICS = 100
+EMF_MAX_VALUES = 100
+
+COUNT = 'Count'
+BYTES = 'Bytes'
+MEGABYTES = 'Megabytes'
+MILLISECONDS = 'Milliseconds'
+PERCENT = 'Percent'
+COUNT_PER_SECOND = 'Count/Second'
+
+# HDR-style latency buckets: microseconds with 32 linear sub-buckets per power of two, so a
+# recorded value is reproduced within 1/32 (~3%) at any magnitude while a serialized
+# histogram stays around 1-2KB, small enough to carry in chunk results and continuations
+HISTOGRAM_SUB_BUCKET_BITS = 5
+HISTOGRAM_LINEAR_LIMIT = 2 << HISTOGRAM_SUB_BUCKET_BITS
+LATENCY_PERCENTILES = (50, 90, 99)
+
+class StageMetrics:
+    """Counters, gauges and timer samples for one stage invocation.
+
+    Counters are summed, gauges keep the last value and samples (latencies) are kept
+    as value arrays so CloudWatch computes percentiles across invocations. Nothing is
+    written until flush(), which emits the metrics and starts a new period.
+    """
+
+    def __init__(self, stage: str, batch_id: Optional[str] = None, tenant_id: Optional[str] = None,
+                 namespace: str = METRICS_NAMESPACE):
+        self.stage = stage
+        self.namespace = namespace
+        self.dimensions = {'Stage': stage, 'TenantId': tenant_id or 'unknown', 'BatchId': batch_id or 'unknown'}
+        self.properties = {}
+        self.lock = threading.Lock()
+        self._reset()
+
+    @classmethod
+    def for_event(cls, stage: str, event: Any) -> 'StageMetrics':
+        """Metrics dimensioned by the batchId and tenantId of a stage input"""
+        event = event if isinstance(event, dict) else {}
+        return cls(stage, event.get('batchId'), event.get('tenantId'))
+
+    def _reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.samples = {}
+
+    def set_dimensions(self, batch_id: Optional[str] = None, tenant_id: Optional[str] = None):
+        """Fill in dimensions that are only known after the input has been read"""
+        if batch_id:
+            self.dimensions['BatchId'] = batch_id
+        if tenant_id:
+            self.dimensions['TenantId'] = tenant_id
+
+    def set_property(self, name: str, value: Any):
+        """Searchable log field that is not a metric, e.g. chunkId"""
+        self.properties[name] = value
+
+    def increment(self, name: str, value: float = 1, unit: str = COUNT):
+        with self.lock:
+            total, _ = self.counters.get(name, (0, unit))
+            self.counters[name] = (total + value, unit)
+
+    def gauge(self, name: str, value: float, unit: str = COUNT):
+        with self.lock:
+            self.gauges[name] = (value, unit)
+
+    def record(self, name: str, value: float, unit: str = MILLISECONDS):
+        """Add one sample, e.g. the latency of a single send"""
+        with self.lock:
+            self.samples.setdefault(name, ([], unit))[0].append(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Record the wall time of the with block in milliseconds"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, (time.time() - start) * 1000)
+
+    def rate(self, name: str, count: float, seconds: float):
+        """Gauge a per-second rate, skipped when no time was measured"""
+        if seconds > 0:
+            self.gauge(name, count / seconds, COUNT_PER_SECOND)
+
+    def latency_percentiles(self, name: str, summary: Optional[Dict[str, Any]]):
+        """Gauge the p50/p90/p99/max of a summarize_latency() result"""
+        if not summary or not summary['overall']['count']:
+            return
+        overall = summary['overall']
+        for percentile in LATENCY_PERCENTILES:
+            self.gauge(f"{name}P{percentile}", overall[f"p{percentile}Ms"], MILLISECONDS)
+        self.gauge(f"{name}Max", overall['maxMs'], MILLISECONDS)
+
+    def get_dimension_sets(self) -> List[List[str]]:
+        dimension_sets = [['Stage'], ['Stage', 'TenantId']]
+        if METRICS_BATCH_DIMENSION:
+            dimension_sets.append(['Stage', 'TenantId', 'BatchId'])
+        return dimension_sets
+
+    def _take(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Swap out the current period's values and samples"""
+        with self.lock:
+            values = dict(self.counters)
+            values.update(self.gauges)
+            samples = {name: entry for name, entry in self.samples.items() if entry[0]}
+            self._reset()
+        return values, samples
+
+    def build_documents(self, values: Dict[str, Any], samples: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """EMF documents for one period, split to stay within the EMF limits"""
+        # Metrics and the first slice of each sample array, then the remaining slices
+        entries = [(name, value, unit) for name, (value, unit) in values.items()]
+        entries += [(name, items[:EMF_MAX_VALUES], unit) for name, (items, unit) in samples.items()]
+        batches = [entries[i:i + EMF_MAX_METRICS] for i in range(0, len(entries), EMF_MAX_METRICS)]
+        for name, (items, unit) in samples.items():
+            for start in range(EMF_MAX_VALUES, len(items), EMF_MAX_VALUES):
+                batches.append([(name, items[start:start + EMF_MAX_VALUES], unit)])
+
+        timestamp = int(time.time() * 1000)
+        documents = []
+        for batch in batches:
+            document = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': self.get_dimension_sets(),
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, _, unit in batch]
+                    }]
+                }
+            }
+            document.update(self.properties)
+            document.update(self.dimensions)
+            document.update({name: value for name, value, _ in batch})
+            documents.append(document)
+        return documents
+
+    def flush(self):
+        """Write the metrics to stdout as EMF and start a new period; never raises"""
+        values, samples = self._take()
+        if not METRICS_ENABLED or not (values or samples):
+            return
+        try:
+            documents = self.build_documents(values, samples)
+            for document in documents:
+                sys.stdout.write(json.dumps(document, default=str) + '\n')
+            sys.stdout.flush()
+        except Exception as e:
+            logger.warning(f"Could not emit {self.stage} metrics: {str(e)}")
+
+class LatencyHistogram:
+    """Log-linear latency histogram that merges exactly across threads, chunks and invocations"""
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @staticmethod
+    def bucket_index(value: int) -> int:
+        if value < HISTOGRAM_LINEAR_LIMIT:
+            return value
+        shift = value.bit_length() - HISTOGRAM_SUB_BUCKET_BITS - 1
+        return (shift << HISTOGRAM_SUB_BUCKET_BITS) + (value >> shift)
+
+    @staticmethod
+    def bucket_value(index: int) -> float:
+        """Midpoint of the values that share a bucket"""
+        if index < HISTOGRAM_LINEAR_LIMIT:
+            return index
+        shift = (index >> HISTOGRAM_SUB_BUCKET_BITS) - 1
+        mantissa = index - (shift << HISTOGRAM_SUB_BUCKET_BITS)
+        return ((mantissa << shift) + ((mantissa + 1) << shift) - 1) / 2
+
+    def record(self, seconds: float):
+        value = max(0, int(seconds * 1000000))
+        self.counts[self.bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: 'LatencyHistogram'):
+        for index, count in other.counts.items():
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percentile: float) -> float:
+        """Latency in milliseconds at or below which percentile% of the values fall"""
+        if not self.count:
+            return 0
+        target = max(1, -(-self.count * percentile // 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(max(self.bucket_value(index), self.min), self.max) / 1000
+        return self.max / 1000
+
+    def get_summary(self) -> Dict[str, Any]:
+        summary = {'count': self.count}
+        for percentile in LATENCY_PERCENTILES:
+            summary[f"p{percentile}Ms"] = self.percentile(percentile)
+        summary['maxMs'] = self.max / 1000
+        summary['meanMs'] = self.total / self.count / 1000 if self.count else 0
+        return summary
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Dense bucket counts from the lowest occupied bucket, compact enough for state payloads"""
+        offset = min(self.counts) if self.counts else 0
+        last = max(self.counts) if self.counts else -1
+        return {
+            'unit': 'us',
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'offset': offset,
+            'counts': [self.counts.get(index, 0) for index in range(offset, last + 1)]
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'LatencyHistogram':
+        histogram = cls()
+        for index, count in enumerate(data.get('counts', []), data.get('offset', 0)):
+            if count:
+                histogram.counts[index] = count
+        histogram.count = data.get('count', 0)
+        histogram.total = data.get('sum', 0)
+        histogram.min = data.get('min')
+        histogram.max = data.get('max', 0)
+        return histogram
+
+class LatencyHistograms:
+    """Thread-safe latency histograms keyed by partition, queue or another send target"""
+
+    def __init__(self):
+        self.histograms = defaultdict(LatencyHistogram)
+        self.lock = threading.Lock()
+
+    def record(self, key: Any, seconds: float):
+        with self.lock:
+            self.histograms[str(key)].record(seconds)
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            return {key: histogram.to_dict() for key, histogram in self.histograms.items()}
+
+def merge_latency(latency_list: List[Optional[Dict[str, Dict[str, Any]]]]) -> Optional[Dict[str, Dict[str, Any]]]:
+    """Merge serialized LatencyHistograms from several senders, chunks or invocations"""
+    latency_list = [latency for latency in latency_list if latency]
+    if not latency_list:
+        return None
+    merged = defaultdict(LatencyHistogram)
+    for latency in latency_list:
+        for key, data in latency.items():
+            merged[key].merge(LatencyHistogram.from_dict(data))
+    return {key: merged[key].to_dict() for key in sorted(merged, key=lambda key: (len(key), key))}
+
+def summarize_latency(latency: Optional[Dict[str, Dict[str, Any]]], group_by: str) -> Optional[Dict[str, Any]]:
+    """Percentiles over all sends and per partition/queue from serialized histograms"""
+    if not latency:
+        return None
+    overall = LatencyHistogram()
+    groups = {}
+    for key, data in latency.items():
+        histogram = LatencyHistogram.from_dict(data)
+        overall.merge(histogram)
+        groups[key] = histogram.get_summary()
+    return {'groupBy': group_by, 'overall': overall.get_summary(), 'groups': groups}
@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import random
+import logging
+import threading
+import functools
+from collections import Counter
+from datetime import datetime
+from typing import Any, Optional
+
+import s3_io
+
+# Opt-in sampling profiler for stage handlers. A profiled invocation samples the stacks of
+# all threads at a fixed interval and uploads them in collapsed-stack format
+# (flamegraph.pl, speedscope and most flame graph viewers read it) to
+# profiles/{batchId}/{stage}/. Invocations that are not sampled only pay for one random().
+
+logger = logging.getLogger()
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))  # fraction of invocations profiled
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 10))
+PROFILE_MAX_DEPTH = int(os.environ.get('PROFILE_MAX_DEPTH', 128))
+PROFILE_BUCKET = os.environ.get('PROFILE_BUCKET', '')  # defaults to the batch bucket
+
+class StackSampler:
+    """Background thread that counts the stacks of every other thread"""
+
+    def __init__(self, interval_ms: float = PROFILE_INTERVAL_MS, max_depth: int = PROFILE_MAX_DEPTH):
+        self.interval = interval_ms / 1000
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    @staticmethod
+    def frame_name(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self._thread.ident:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(self.frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self.started_at = time.time()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.time() - self.started_at
+
+    def collapsed(self) -> str:
+        """One 'frame;frame;frame count' line per distinct stack"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+def _event_field(event: Any, name: str) -> Optional[str]:
+    """A field of a stage input, which may be a chunk, a state with chunkConfig or a list of chunk results"""
+    if isinstance(event, list):
+        event = event[0] if event else {}
+    if not isinstance(event, dict):
+        return None
+    return event.get(name) or (event.get('chunkConfig') or {}).get(name)
+
+def should_profile(event: Any) -> bool:
+    """Profile when the input asks for it ("profile": true) or the invocation is sampled"""
+    if isinstance(event, dict) and 'profile' in event:
+        return bool(event['profile'])
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def upload_profile(sampler: StackSampler, stage: str, event: Any, context) -> Optional[str]:
+    """Upload the collapsed stacks, or log the hottest ones when there is no bucket"""
+    bucket = PROFILE_BUCKET or _event_field(event, 'bucket')
+    batch_id = _event_field(event, 'batchId') or 'unknown'
+    logger.info(f"Profiled {stage} for {sampler.duration:.1f}s: {sampler.samples} samples, "
+                f"{len(sampler.stacks)} distinct stacks")
+    if not bucket:
+        for stack, count in sampler.stacks.most_common(5):
+            logger.info(f"Profile {count} samples: {stack}")
+        return None
+
+    # Chunk invocations of one batch share the prefix, the chunk id tells their profiles apart
+    name = '-'.join(part for part in (
+        datetime.now().strftime('%Y%m%dT%H%M%S.%f'),
+        _event_field(event, 'chunkId'),
+        getattr(context, 'aws_request_id', None)
+    ) if part)
+    key = f"profiles/{batch_id}/{stage}/{name}.collapsed"
+    s3_io.upload_bytes(bucket, key, sampler.collapsed().encode('utf-8'), {'ContentType': 'text/plain'})
+    logger.info(f"Uploaded profile to s3://{bucket}/{key}")
+    return key
+
+def profiled(stage: str):
+    """Decorate a lambda_handler so a sampled fraction of its invocations is profiled"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not should_profile(event):
+                return handler(event, context)
+
+            sampler = StackSampler()
+            sampler.start()
+            try:
+                return handler(event, context)
+            finally:
+                sampler.stop()
+                try:
+                    upload_profile(sampler, stage, event, context)
+                except Exception as e:
+                    logger.warning(f"Could not upload {stage} profile: {str(e)}")
+        return wrapper
+    return decorator
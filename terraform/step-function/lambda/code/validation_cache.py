@@ -0,0 +1,82 @@
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+import s3_io
+
+# Validation verdicts cached by input object version. An entry is keyed by the bucket, key
+# and ETag of the validated object and the validation rule-set version, so a file submitted
+# again unchanged is answered from the cache instead of being scanned again, while any change
+# to the object or the rules misses. Entries live under VALIDATION_CACHE_PREFIX and expire
+# with an S3 lifecycle rule on that prefix.
+
+logger = logging.getLogger()
+
+VALIDATION_CACHE_ENABLED = os.environ.get('VALIDATION_CACHE_ENABLED', 'true').lower() == 'true'
+VALIDATION_CACHE_PREFIX = os.environ.get('VALIDATION_CACHE_PREFIX', 'validation-cache/')
+# Bump on both read-s3 and validate-data when the validation rules change
+VALIDATION_RULES_VERSION = os.environ.get('VALIDATION_RULES_VERSION', '1')
+# Options that change the verdict are part of the key; the input's checkDuplicates and earlyAbort override
+DUPLICATE_CHECK = os.environ.get('DUPLICATE_CHECK', 'false').lower() == 'true'
+EARLY_ABORT = os.environ.get('EARLY_ABORT', 'false').lower() == 'true'
+
+def validation_options(event: Dict[str, Any]) -> Dict[str, Any]:
+    """The validation options of a batch input"""
+    return {
+        'checkDuplicates': bool(event.get('checkDuplicates', DUPLICATE_CHECK)),
+        'earlyAbort': bool(event.get('earlyAbort', EARLY_ABORT))
+    }
+
+def cache_key(bucket: str, key: str, etag: str, options: Optional[Dict[str, Any]] = None) -> str:
+    """Cache entry key for one version of an object validated with one rule set and options"""
+    identity = json.dumps([bucket, key, etag, VALIDATION_RULES_VERSION, options or {}], sort_keys=True)
+    return f"{VALIDATION_CACHE_PREFIX}{hashlib.sha256(identity.encode('utf-8')).hexdigest()}.json"
+
+def head_object(bucket: str, key: str) -> Dict[str, Any]:
+    """ETag and size of the object to validate"""
+    head = s3_io.get_client('s3').head_object(Bucket=bucket, Key=key)
+    return {'etag': head['ETag'].strip('"'), 'size': head['ContentLength']}
+
+def load(bucket: str, key: str, etag: str, options: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """The cached entry for this object version, or None on a miss; lookup errors count as a miss"""
+    if not VALIDATION_CACHE_ENABLED:
+        return None
+    entry_key = cache_key(bucket, key, etag, options)
+    try:
+        entry = s3_io.get_json(bucket, entry_key)
+    except Exception as e:
+        logger.warning(f"Could not read validation cache entry {entry_key}: {str(e)}")
+        return None
+    # The entry repeats its identity, a hash collision or a hand-edited entry is a miss
+    if not entry or entry.get('identity') != [bucket, key, etag, VALIDATION_RULES_VERSION, options or {}]:
+        return None
+    entry['cacheKey'] = entry_key
+    return entry
+
+def store(bucket: str, key: str, etag: str, options: Optional[Dict[str, Any]], batch_id: str,
+          results: Dict[str, Any], line_index: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Write the verdict and line index of a validated object version; failures are only logged.
+
+    line_index is None when the verdict was reached without reading every line.
+    """
+    if not VALIDATION_CACHE_ENABLED:
+        return None
+    entry_key = cache_key(bucket, key, etag, options)
+    entry = {
+        'identity': [bucket, key, etag, VALIDATION_RULES_VERSION, options or {}],
+        'batchId': batch_id,
+        'cachedAt': datetime.now().isoformat(),
+        'lineIndex': line_index,
+        'results': results
+    }
+    try:
+        s3_io.upload_bytes(bucket, entry_key, json.dumps(entry, separators=(',', ':'), default=str).encode('utf-8'),
+                           {'ContentType': 'application/json'})
+    except Exception as e:
+        logger.warning(f"Could not write validation cache entry {entry_key}: {str(e)}")
+        return None
+    logger.info(f"Cached validation verdict for s3://{bucket}/{key} ({etag}) at {entry_key}")
+    return entry_key
@@ -41,6 +41,9 @@ resource "aws_iam_role_policy" "step_function_policy" {
           "batch:SubmitJob",
           "batch:DescribeJobs",
           "batch:ListJobs",
+          "states:StartExecution",
+          "states:DescribeExecution",
+          "states:StopExecution",
           "logs:CreateLogGroup",
           "logs:CreateLogStream",
           "logs:PutLogEvents"
@@ -54,13 +57,36 @@ resource "aws_iam_role_policy" "step_function_policy" {
           "arn:aws:s3:::${var.s3_bucket_name}/*",
           "arn:aws:batch:${var.aws_region}:*:job-queue/*",
           "arn:aws:batch:${var.aws_region}:*:job-definition/*",
-          "arn:aws:logs:${var.aws_region}:*:log-group:/aws/batch/job:*"
+          "arn:aws:logs:${var.aws_region}:*:log-group:/aws/batch/job:*",
+          # Distributed Map runs chunks as child executions of this state machine
+          "arn:aws:states:${var.aws_region}:*:stateMachine:${var.step_function_name}",
+          "arn:aws:states:${var.aws_region}:*:execution:${var.step_function_name}/*"
         ]
       }
     ]
   })
 }
 
+# The straggler monitor starts speculative attempts of the chunk function and those attempts
+# re-invoke themselves to continue, both asynchronously from the functions' own roles
+resource "aws_iam_role_policy" "speculation_invoke_policy" {
+  for_each = toset(var.speculation_role_names)
+
+  name = "${var.step_function_name}-speculation-invoke"
+  role = each.value
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect   = "Allow"
+        Action   = ["lambda:InvokeFunction"]
+        Resource = "arn:aws:lambda:${var.aws_region}:*:function:${var.lambda_functions[3]}"
+      }
+    ]
+  })
+}
+
 # AWS Batch Job Queue for heavy processing
 resource "aws_batch_job_queue" "batch_processing_queue" {
   name     = "${var.step_function_name}-batch-queue"
@@ -175,6 +201,20 @@ resource "aws_batch_job_definition" "batch_processing_job" {
     vcpus = var.batch_job_vcpus
     memory = var.batch_job_memory
     
+    # Chunk worker entry point; Ref:: values are filled from the SubmitBatchJob parameters
+    command = [
+      "python", "scm-batch-processor-batch-worker.py",
+      "--chunk-id", "Ref::chunkId",
+      "--start-index", "Ref::startIndex",
+      "--end-index", "Ref::endIndex",
+      "--bucket", "Ref::bucket",
+      "--file", "Ref::file",
+      "--customer-id", "Ref::customerId",
+      "--tenant-id", "Ref::tenantId",
+      "--batch-id", "Ref::batchId",
+      "--destination", "Ref::destination"
+    ]
+    
     environment = [
       {
         name  = "AWS_REGION"
@@ -183,6 +223,23 @@ resource "aws_batch_job_definition" "batch_processing_job" {
       {
         name  = "S3_BUCKET"
         value = var.s3_bucket_name
+      },
+      {
+        name  = "KAFKA_BROKERS"
+        value = var.kafka_brokers
+      },
+      {
+        name  = "KAFKA_TOPIC"
+        value = var.kafka_topic
+      },
+      {
+        name  = "SQS_CORE_QUEUE"
+        value = var.sqs_core_queue_url
+      },
+      {
+        # Sizes the worker's process pool; the host can have many more CPUs than the job
+        name  = "BATCH_JOB_VCPUS"
+        value = tostring(var.batch_job_vcpus)
       }
     ]
     
@@ -240,7 +297,7 @@ resource "aws_sfn_state_machine" "example" {
         Resource = "arn:aws:lambda:${var.aws_region}:*:function:${var.lambda_functions[1]}"
         InputPath = "$.batchConfig"
         ResultPath = "$.chunkConfig"
-        Next = "ProcessChunksInParallel"
+        Next = "ProcessChunks"
         Catch = [
           {
             ErrorEquals = ["States.ALL"]
@@ -250,106 +307,259 @@ resource "aws_sfn_state_machine" "example" {
         ]
       }
       
-      ProcessChunksInParallel = {
-        Type = "Map"
-        InputPath = "$.chunkConfig.chunks"
-        ItemsPath = "$.chunks"
-        MaxConcurrency = var.max_concurrent_chunks
-        Iterator = {
-          StartAt = "ProcessChunk"
-          States = {
-            ProcessChunk = {
-              Type = "Choice"
-              Choices = [
-                {
-                  Variable = "$.chunkSize"
-                  NumericGreaterThan = var.batch_processing_threshold
-                  Next = "SubmitBatchJob"
+      # The straggler monitor runs next to the chunk Map, speculatively re-running chunks that
+      # fall far behind their peers, and finishes once every chunk has committed or the Map
+      # branch has written its done marker
+      ProcessChunks = {
+        Type = "Parallel"
+        Branches = [
+          {
+            StartAt = "ProcessChunksInParallel"
+            States = {
+              ProcessChunksInParallel = {
+                Type = "Map"
+                MaxConcurrency = var.max_concurrent_chunks
+                # Chunk items are read from the JSONL plan written by CalculateChunks, so the
+                # plan size is not bound by the state payload limit
+                ItemReader = {
+                  Resource = "arn:aws:states:::s3:getObject"
+                  ReaderConfig = {
+                    InputType = "JSONL"
+                  }
+                  Parameters = {
+                    "Bucket.$" = "$.chunkConfig.chunkManifest.bucket"
+                    "Key.$" = "$.chunkConfig.chunkManifest.key"
+                  }
                 }
-              ]
-              Default = "ProcessWithLambda"
-            }
-            
-            ProcessWithLambda = {
-              Type = "Task"
-              Resource = "arn:aws:lambda:${var.aws_region}:*:function:${var.lambda_functions[2]}"
-              ResultPath = "$.chunkResult"
-              Next = "ChunkComplete"
-              Catch = [
-                {
-                  ErrorEquals = ["States.ALL"]
-                  Next = "ChunkFailed"
-                  ResultPath = "$.chunkError"
+                # Plan entries only carry the per-chunk fields; batch-wide fields are added here
+                ItemSelector = {
+                  "chunkId.$" = "$$.Map.Item.Value.chunkId"
+                  "startIndex.$" = "$$.Map.Item.Value.startIndex"
+                  "endIndex.$" = "$$.Map.Item.Value.endIndex"
+                  "chunkSize.$" = "$$.Map.Item.Value.chunkSize"
+                  "executor.$" = "$$.Map.Item.Value.executor"
+                  "predictedSeconds.$" = "$$.Map.Item.Value.predictedSeconds"
+                  "bucket.$" = "$.chunkConfig.bucket"
+                  "file.$" = "$.chunkConfig.file"
+                  "customerId.$" = "$.chunkConfig.customerId"
+                  "tenantId.$" = "$.chunkConfig.tenantId"
+                  "batchId.$" = "$.chunkConfig.batchId"
+                  "destination.$" = "$.chunkConfig.destination"
                 }
-              ]
-            }
-            
-            SubmitBatchJob = {
-              Type = "Task"
-              Resource = "arn:aws:states:::batch:submitJob"
-              Parameters = {
-                JobName = "batch-chunk-${States.UUID()}"
-                JobQueue = aws_batch_job_queue.batch_processing_queue.arn
-                JobDefinition = aws_batch_job_definition.batch_processing_job.arn
+                # Per-chunk outputs go to S3; aggregation reads chunk results from stats/
+                ResultWriter = {
+                  Resource = "arn:aws:states:::s3:putObject"
+                  Parameters = {
+                    Bucket = var.s3_bucket_name
+                    Prefix = "map-results"
+                  }
+                }
+                ItemProcessor = {
+                  ProcessorConfig = {
+                    Mode = "DISTRIBUTED"
+                    ExecutionType = "STANDARD"
+                  }
+                  StartAt = "ProcessChunk"
+                  States = {
+                    ProcessChunk = {
+                      Type = "Choice"
+                      # The planner routes each chunk; the threshold stays as a hard cap for Lambda
+                      Choices = [
+                        {
+                          Variable = "$.executor"
+                          StringEquals = "batch"
+                          Next = "SubmitBatchJob"
+                        },
+                        {
+                          Variable = "$.chunkSize"
+                          NumericGreaterThan = var.batch_processing_threshold
+                          Next = "SubmitBatchJob"
+                        }
+                      ]
+                      Default = "ProcessWithLambda"
+                    }
+                    
+                    ProcessWithLambda = {
+                      Type = "Task"
+                      Resource = "arn:aws:lambda:${var.aws_region}:*:function:${var.lambda_functions[2]}"
+                      ResultPath = "$.chunkResult"
+                      Next = "CheckChunkContinuation"
+                      Catch = [
+                        {
+                          ErrorEquals = ["States.ALL"]
+                          Next = "ChunkFailed"
+                          ResultPath = "$.chunkError"
+                        }
+                      ]
+                    }
+                    
+                    CheckChunkContinuation = {
+                      Type = "Choice"
+                      Choices = [
+                        {
+                          Variable = "$.chunkResult.status"
+                          StringEquals = "CONTINUE"
+                          Next = "ContinueChunk"
+                        }
+                      ]
+                      Default = "ChunkComplete"
+                    }
+                    
+                    ContinueChunk = {
+                      Type = "Pass"
+                      InputPath = "$.chunkResult"
+                      Next = "ProcessWithLambda"
+                    }
+                    
+                    SubmitBatchJob = {
+                      Type = "Task"
+                      Resource = "arn:aws:states:::batch:submitJob"
+                      Parameters = {
+                        JobName = "batch-chunk-${States.UUID()}"
+                        JobQueue = aws_batch_job_queue.batch_processing_queue.arn
+                        JobDefinition = aws_batch_job_definition.batch_processing_job.arn
+                        Parameters = {
+                          "chunkId.$" = "$.chunkId"
+                          "startIndex.$" = "States.Format('{}', $.startIndex)"
+                          "endIndex.$" = "States.Format('{}', $.endIndex)"
+                          "bucket.$" = "$.bucket"
+                          "file.$" = "$.file"
+                          "customerId.$" = "$.customerId"
+                          "tenantId.$" = "$.tenantId"
+                          "batchId.$" = "$.batchId"
+                          "destination.$" = "$.destination"
+                        }
+                      }
+                      ResultPath = "$.batchJob"
+                      Next = "WaitForBatchJob"
+                    }
+                    
+                    WaitForBatchJob = {
+                      Type = "Wait"
+                      Seconds = 30
+                      Next = "CheckBatchJobStatus"
+                    }
+                    
+                    CheckBatchJobStatus = {
+                      Type = "Task"
+                      Resource = "arn:aws:states:::batch:describeJobs"
+                      Parameters = {
+                        Jobs = ["${States.Format('{}', $.batchJob.JobId)}"]
+                      }
+                      ResultPath = "$.jobStatus"
+                      Next = "BatchJobComplete"
+                    }
+                    
+                    BatchJobComplete = {
+                      Type = "Choice"
+                      Choices = [
+                        {
+                          Variable = "$.jobStatus.Jobs[0].Status"
+                          StringEquals = "SUCCEEDED"
+                          Next = "ChunkComplete"
+                        },
+                        {
+                          Variable = "$.jobStatus.Jobs[0].Status"
+                          StringEquals = "FAILED"
+                          Next = "ChunkFailed"
+                        }
+                      ]
+                      Default = "WaitForBatchJob"
+                    }
+                    
+                    ChunkComplete = {
+                      Type = "Succeed"
+                    }
+                    
+                    ChunkFailed = {
+                      Type = "Fail"
+                      Cause = "Chunk processing failed"
+                      Error = "ChunkError"
+                    }
+                  }
+                }
+                # Keep the input so the done marker can be written for this batch
+                ResultPath = "$.mapResult"
+                Next = "MarkChunksDone"
+              }
+              
+              # Tells the straggler monitor that every chunk has returned, including chunks that
+              # failed without a heartbeat or ran on Batch, so it stops waiting for their commits
+              MarkChunksDone = {
+                Type = "Task"
+                Resource = "arn:aws:states:::aws-sdk:s3:putObject"
                 Parameters = {
-                  "chunkId.$" = "$.chunkId"
-                  "startIndex.$" = "$.startIndex"
-                  "endIndex.$" = "$.endIndex"
-                  "bucket.$" = "$.bucket"
-                  "file.$" = "$.file"
-                  "customerId.$" = "$.customerId"
-                  "tenantId.$" = "$.tenantId"
-                  "batchId.$" = "$.batchId"
+                  "Bucket.$" = "$.chunkConfig.bucket"
+                  "Key.$" = "States.Format('map-done/{}.json', $.chunkConfig.batchId)"
+                  "Body.$" = "States.JsonToString($.mapResult)"
+                  ContentType = "application/json"
                 }
+                ResultPath = null
+                Retry = [
+                  {
+                    ErrorEquals = ["States.ALL"]
+                    IntervalSeconds = 2
+                    MaxAttempts = 3
+                    BackoffRate = 2
+                  }
+                ]
+                # Without the marker the monitor still ends on lost heartbeats or MONITOR_MAX_SECONDS
+                Catch = [
+                  {
+                    ErrorEquals = ["States.ALL"]
+                    Next = "ChunksDone"
+                    ResultPath = "$.markerError"
+                  }
+                ]
+                Next = "ChunksDone"
               }
-              ResultPath = "$.batchJob"
-              Next = "WaitForBatchJob"
-            }
-            
-            WaitForBatchJob = {
-              Type = "Wait"
-              Seconds = 30
-              Next = "CheckBatchJobStatus"
-            }
-            
-            CheckBatchJobStatus = {
-              Type = "Task"
-              Resource = "arn:aws:states:::batch:describeJobs"
-              Parameters = {
-                Jobs = ["${States.Format('{}', $.batchJob.JobId)}"]
+              
+              ChunksDone = {
+                Type = "Succeed"
               }
-              ResultPath = "$.jobStatus"
-              Next = "BatchJobComplete"
-            }
-            
-            BatchJobComplete = {
-              Type = "Choice"
-              Choices = [
-                {
-                  Variable = "$.jobStatus.Jobs[0].Status"
-                  StringEquals = "SUCCEEDED"
-                  Next = "ChunkComplete"
-                },
-                {
-                  Variable = "$.jobStatus.Jobs[0].Status"
-                  StringEquals = "FAILED"
-                  Next = "ChunkFailed"
-                }
-              ]
-              Default = "WaitForBatchJob"
             }
-            
-            ChunkComplete = {
-              Type = "Succeed"
-            }
-            
-            ChunkFailed = {
-              Type = "Fail"
-              Cause = "Chunk processing failed"
-              Error = "ChunkError"
+          },
+          {
+            StartAt = "MonitorStragglers"
+            States = {
+              MonitorStragglers = {
+                Type = "Task"
+                Resource = "arn:aws:lambda:${var.aws_region}:*:function:${var.lambda_functions[7]}"
+                ResultPath = "$.monitor"
+                Next = "StragglersSettled"
+                Catch = [
+                  {
+                    ErrorEquals = ["States.ALL"]
+                    Next = "MonitorComplete"
+                    ResultPath = "$.monitorError"
+                  }
+                ]
+              }
+              
+              StragglersSettled = {
+                Type = "Choice"
+                Choices = [
+                  {
+                    Variable = "$.monitor.done"
+                    BooleanEquals = true
+                    Next = "MonitorComplete"
+                  }
+                ]
+                Default = "WaitForStragglers"
+              }
+              
+              WaitForStragglers = {
+                Type = "Wait"
+                Seconds = var.straggler_poll_seconds
+                Next = "MonitorStragglers"
+              }
+              
+              MonitorComplete = {
+                Type = "Succeed"
+              }
             }
           }
-        }
+        ]
         ResultPath = "$.parallelResults"
         Next = "AggregateResults"
       }
@@ -357,7 +567,14 @@ resource "aws_sfn_state_machine" "example" {
       AggregateResults = {
         Type = "Task"
         Resource = "arn:aws:lambda:${var.aws_region}:*:function:${var.lambda_functions[3]}"
-        InputPath = "$.parallelResults"
+        Parameters = {
+          "batchId.$" = "$.chunkConfig.batchId"
+          "customerId.$" = "$.chunkConfig.customerId"
+          "tenantId.$" = "$.chunkConfig.tenantId"
+          "deployment.$" = "$.chunkConfig.deployment"
+          "bucket.$" = "$.chunkConfig.bucket"
+          "chunkManifest.$" = "$.chunkConfig.chunkManifest"
+        }
         ResultPath = "$.aggregatedResults"
         Next = "DeploymentChoiceState"
         Catch = [
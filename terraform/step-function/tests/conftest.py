@@ -0,0 +1,38 @@
+import os
+import sys
+import importlib
+
+import pytest
+
+# Handlers are imported from the Lambda code directory and run against the filesystem-backed
+# S3 stand-in from the benchmark harness, so the tests need no AWS access.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CODE_DIR = os.path.join(ROOT, 'lambda', 'code')
+BENCHMARK_DIR = os.path.join(ROOT, 'benchmark')
+
+for path in (CODE_DIR, BENCHMARK_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+BUCKET = 'test-bucket'
+
+@pytest.fixture
+def local_s3(tmp_path, monkeypatch):
+    """A LocalS3 client installed as the shared S3 client"""
+    import s3_io
+    from local_aws import LocalS3
+
+    client = LocalS3(str(tmp_path / 's3'))
+    monkeypatch.setitem(s3_io._clients, 's3', client)
+    return client
+
+@pytest.fixture
+def load_handler(local_s3, monkeypatch):
+    """Import a handler module by its short name with its module-level S3 client pointed at local_s3"""
+    def load(name: str):
+        module = importlib.import_module(f"scm-batch-processor-{name}")
+        for attribute in ('s3', 's3_client'):
+            if hasattr(module, attribute):
+                monkeypatch.setattr(module, attribute, local_s3)
+        return module
+    return load
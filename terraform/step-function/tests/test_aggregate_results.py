@@ -0,0 +1,36 @@
+import json
+
+from conftest import BUCKET
+
+BATCH_ID = 'batch-1'
+
+def put_json(local_s3, key, value):
+    local_s3.put_object(Bucket=BUCKET, Key=key, Body=json.dumps(value).encode('utf-8'))
+
+def test_result_files_come_from_committed_attempts_only(load_handler, local_s3):
+    module = load_handler('aggregate-results')
+    # chunk-0 ran in two segments and won; its speculative copy left a segment behind
+    put_json(local_s3, f"results/{BATCH_ID}/chunk-0.json", [{'id': 0}])
+    put_json(local_s3, f"results/{BATCH_ID}/chunk-0.part-1.json", [{'id': 1}])
+    put_json(local_s3, f"results/{BATCH_ID}/chunk-0.speculative.json", [{'id': 0}, {'id': 1}])
+    put_json(local_s3, f"commits/{BATCH_ID}/chunk-0.json", {'attempt': 'primary', 'result': {
+        'resultKeys': [f"results/{BATCH_ID}/chunk-0.json", f"results/{BATCH_ID}/chunk-0.part-1.json"],
+        'errorKeys': [f"errors/{BATCH_ID}/chunk-0.json"]}})
+    put_json(local_s3, f"errors/{BATCH_ID}/chunk-0.json", [{'record_index': 5}])
+    put_json(local_s3, f"errors/{BATCH_ID}/chunk-0.speculative.json", [{'record_index': 5}])
+    # chunk-1 ran on Batch, which commits a single result file
+    put_json(local_s3, f"results/{BATCH_ID}/chunk-1.json", [{'id': 2}])
+    put_json(local_s3, f"commits/{BATCH_ID}/chunk-1.json", {'attempt': 'primary', 'result': {
+        'resultKey': f"results/{BATCH_ID}/chunk-1.json", 'errorKey': None}})
+    # chunk-2 failed without committing
+    put_json(local_s3, f"results/{BATCH_ID}/chunk-2.json", [{'id': 3}])
+
+    committed = module.load_committed_outputs(BUCKET, BATCH_ID)
+    result_files = module.collect_result_files(BUCKET, BATCH_ID, committed['results'])
+    records = list(module.iter_result_records(BUCKET, result_files))
+    errors = module.collect_error_reports(BUCKET, BATCH_ID, committed['errors'])
+
+    assert sorted(file_info['key'] for file_info in result_files) == [
+        f"results/{BATCH_ID}/chunk-0.json", f"results/{BATCH_ID}/chunk-0.part-1.json", f"results/{BATCH_ID}/chunk-1.json"]
+    assert sorted(record['id'] for record in records) == [0, 1, 2]
+    assert errors == [{'record_index': 5}]
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import threading
+import multiprocessing.util
+import concurrent.futures
+
+import pytest
+
+from conftest import BUCKET
+
+@pytest.fixture
+def worker(load_handler):
+    return load_handler('batch-worker')
+
+def test_pool_is_sized_from_the_job_not_the_host(worker, monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 96)
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(96)), raising=False)
+    monkeypatch.setattr(worker, 'cgroup_cpu_limit', lambda: None)
+    monkeypatch.setattr(worker, 'BATCH_JOB_VCPUS', 4)
+    assert worker.available_cpus() == 4
+
+    monkeypatch.setattr(worker, 'BATCH_JOB_VCPUS', 0)
+    monkeypatch.setattr(worker, 'cgroup_cpu_limit', lambda: 6)
+    assert worker.available_cpus() == 6
+
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: {0, 1}, raising=False)
+    assert worker.available_cpus() == 2
+
+class CountingExecutor(concurrent.futures.ThreadPoolExecutor):
+    """Thread pool that records the most slices submitted and not yet finished"""
+    def __init__(self):
+        super().__init__(max_workers=2)
+        self.outstanding = 0
+        self.most_outstanding = 0
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            self.outstanding += 1
+            self.most_outstanding = max(self.most_outstanding, self.outstanding)
+        future = super().submit(fn, *args, **kwargs)
+        future.add_done_callback(self.finished)
+        return future
+
+    def finished(self, future):
+        with self.lock:
+            self.outstanding -= 1
+
+def test_slices_are_submitted_with_bounded_in_flight(worker, monkeypatch, tmp_path):
+    def slow_slice(task):
+        time.sleep(0.005)
+        return {'offset': task['offset'], 'processed': len(task['records'])}
+
+    monkeypatch.setattr(worker, 'process_slice', slow_slice)
+    blocks = ({'baseIndex': offset, 'records': list(range(offset, offset + 10))} for offset in range(0, 400, 10))
+    with CountingExecutor() as executor:
+        slices, _ = worker.run_slices(executor, blocks, {}, str(tmp_path), max_in_flight=3)
+
+    assert executor.most_outstanding <= 3
+    assert [result['offset'] for result in slices] == list(range(0, 400, 10))
+
+def test_chunk_is_streamed_through_the_pool(worker, load_handler, local_s3, monkeypatch):
+    load_handler('update-records')  # the worker reads the chunk through the update-records reader
+    records = [{'id': i, 'name': f"record-{i}"} for i in range(1000)]
+    local_s3.put_object(Bucket=BUCKET, Key='chunks/batch-1/chunk_000000.json', Body=json.dumps(records).encode('utf-8'))
+    monkeypatch.setattr(worker, 'BATCH_WORKER_SLICE_SIZE', 150)
+    event = {'chunkId': 'chunk_000000', 'startIndex': 0, 'endIndex': 999, 'bucket': BUCKET, 'file': 'input.json',
+             'customerId': 'customer', 'tenantId': 'tenant', 'batchId': 'batch-1', 'destination': 'none',
+             'processes': 2}
+
+    result = worker.run_chunk(event)
+
+    assert result['recordsProcessed'] == 1000
+    assert result['performance']['slices'] == 7
+    assert result['performance']['inputBytes'] == len(json.dumps(records))
+    uploaded = json.loads(local_s3.get_object(Bucket=BUCKET, Key=result['resultKey'])['Body'].read())
+    assert [record['originalId'] for record in uploaded] == [record['id'] for record in records]
+
+class FakeSender:
+    """Stands in for ShardedKafkaSender and records how it is used"""
+    created = []
+
+    def __init__(self, kafka_brokers):
+        self.sent = 0
+        self.flushes = 0
+        FakeSender.created.append(self)
+
+    def send(self, topic, message, key=None, headers=None):
+        self.sent += 1
+
+    def flush(self, timeout=None):
+        self.flushes += 1
+
+    def close(self):
+        pass
+
+    def get_delivery_counts(self):
+        return {'success': self.sent - 1, 'errors': 1}
+
+    def get_partition_stats(self):
+        return None
+
+def test_slices_share_the_process_sender(worker, load_handler, monkeypatch, tmp_path):
+    update_records = load_handler('update-records')
+    FakeSender.created = []
+    monkeypatch.setattr(update_records, 'ShardedKafkaSender', FakeSender)
+    monkeypatch.setattr(multiprocessing.util, 'Finalize', lambda *args, **kwargs: None)
+    monkeypatch.setattr(worker, '_process_state', {})
+    event = {'chunkId': 'chunk_000000', 'startIndex': 0, 'endIndex': 299, 'customerId': 'customer',
+             'tenantId': 'tenant', 'batchId': 'batch-1', 'destination': 'kafka'}
+
+    worker.init_process(event, str(tmp_path))
+    for offset in range(0, 300, 100):
+        records = [{'id': i} for i in range(offset, offset + 100)]
+        result = worker.process_slice({'event': event, 'offset': offset, 'records': records,
+                                       'partPath': str(tmp_path / f"part-{offset}.json")})
+        assert result['sent'] == {'success': 100, 'errors': 0}
+    worker.close_process()
+
+    assert len(FakeSender.created) == 1
+    assert (FakeSender.created[0].sent, FakeSender.created[0].flushes) == (300, 1)
+    stats = worker.load_process_stats(str(tmp_path))
+    assert [process['kafka']['success'] for process in stats] == [299]
+
+def chunk_event(local_s3, count=100):
+    records = [{'id': i} for i in range(count)]
+    local_s3.put_object(Bucket=BUCKET, Key='chunks/batch-1/chunk_000000.json', Body=json.dumps(records).encode('utf-8'))
+    return {'chunkId': 'chunk_000000', 'startIndex': 0, 'endIndex': count - 1, 'bucket': BUCKET, 'file': 'input.json',
+            'customerId': 'customer', 'tenantId': 'tenant', 'batchId': 'batch-1', 'destination': 'none',
+            'processes': 1}
+
+def test_retried_job_returns_the_committed_result(worker, load_handler, local_s3, monkeypatch):
+    load_handler('update-records')
+    event = chunk_event(local_s3)
+    first = worker.run_chunk(event)
+    assert first['attempt'] == 'primary'
+
+    monkeypatch.setenv('AWS_BATCH_JOB_ATTEMPT', '2')
+    monkeypatch.setattr(worker, 'run_slices', lambda *args: pytest.fail('a committed chunk was processed again'))
+    retry = worker.run_chunk(event)
+    assert retry['supersededAttempt'] == 'batch-retry-2'
+    assert retry['resultKey'] == first['resultKey']
+
+def test_losing_the_commit_discards_the_attempt_output(worker, load_handler, local_s3, monkeypatch):
+    update_records = load_handler('update-records')
+    event = chunk_event(local_s3)
+    winner = {'chunkId': 'chunk_000000', 'batchId': 'batch-1', 'recordsProcessed': 100,
+              'resultKey': 'results/batch-1/chunk_000000.json', 'errorKey': None}
+    check_commit = update_records.ChunkHeartbeat.check_commit
+
+    def racing_check_commit(heartbeat):
+        # The earlier attempt commits right after this attempt has checked
+        check_commit(heartbeat)
+        local_s3.put_object(Bucket=BUCKET, Key=heartbeat.commit_key,
+                            Body=json.dumps({'attempt': 'primary', 'result': winner}).encode('utf-8'))
+
+    monkeypatch.setattr(update_records.ChunkHeartbeat, 'check_commit', racing_check_commit)
+    monkeypatch.setenv('AWS_BATCH_JOB_ATTEMPT', '2')
+    result = worker.run_chunk(event)
+
+    assert result['supersededAttempt'] == 'batch-retry-2'
+    assert result['resultKey'] == winner['resultKey']
+    assert not os.path.exists(local_s3.path(BUCKET, 'results/batch-1/chunk_000000.batch-retry-2.json'))
+    stats = json.loads(local_s3.get_object(Bucket=BUCKET, Key='stats/batch-1/chunk_000000.json')['Body'].read())
+    assert stats['resultKey'] == winner['resultKey']
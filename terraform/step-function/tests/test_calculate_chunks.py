@@ -0,0 +1,44 @@
+import pytest
+
+@pytest.fixture
+def planner(load_handler):
+    module = load_handler('calculate-chunks')
+    model = {
+        'key': 'performance-model/tenant/kafka.json',
+        'source': 'default',
+        'executors': {name: dict(executor, samples=0) for name, executor in module.DEFAULT_EXECUTOR_MODELS.items()}
+    }
+    return module, model
+
+def test_candidates_are_geometric_and_include_both_bounds(planner):
+    module, _ = planner
+    sizes = module.chunk_size_candidates(1000, 512000, steps=10)
+    assert sizes[0] == 1000 and sizes[-1] == 512000
+    assert sizes == [1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000, 256000, 512000]
+
+def test_deadline_picks_the_cheapest_plan_that_meets_it(planner):
+    module, model = planner
+    capacity = module.calculate_lambda_capacity(model)
+    total = 1000000
+    size, count = module.calculate_optimal_chunk_size(total, 50, 500000, model, deadline_seconds=600)
+    chosen = module.predict_plan(total, size, 50, model, capacity)
+    assert chosen['makespanSeconds'] <= 600
+    assert count == chosen['chunkCount']
+    for candidate in module.chunk_size_candidates(module.MIN_CHUNK_SIZE, 500000):
+        plan = module.predict_plan(total, candidate, 50, model, capacity)
+        if plan['makespanSeconds'] <= 600:
+            assert plan['costUsd'] >= chosen['costUsd']
+
+    # A looser deadline allows larger, cheaper chunks
+    loose_size, _ = module.calculate_optimal_chunk_size(total, 50, 500000, model, deadline_seconds=3600)
+    assert loose_size > size
+    assert module.predict_plan(total, loose_size, 50, model, capacity)['costUsd'] < chosen['costUsd']
+
+def test_unreachable_deadline_falls_back_to_the_fastest_plan(planner):
+    module, model = planner
+    capacity = module.calculate_lambda_capacity(model)
+    total = 20000000
+    size, _ = module.calculate_optimal_chunk_size(total, 50, 500000, model, deadline_seconds=60)
+    fastest = min(module.predict_plan(total, candidate, 50, model, capacity)['makespanSeconds']
+                  for candidate in module.chunk_size_candidates(module.MIN_CHUNK_SIZE, 500000))
+    assert module.predict_plan(total, size, 50, model, capacity)['makespanSeconds'] <= fastest
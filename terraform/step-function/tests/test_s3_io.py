@@ -0,0 +1,62 @@
+import json
+import random
+
+import s3_io
+
+from conftest import BUCKET
+
+def test_multipart_download_returns_the_part_buffer_without_copying(local_s3, monkeypatch):
+    monkeypatch.setattr(s3_io, 'S3_HEDGE_READS', False)
+    monkeypatch.setattr(s3_io, 'S3_MULTIPART_THRESHOLD', 1024)
+    monkeypatch.setattr(s3_io, 'S3_MULTIPART_CHUNK_SIZE', 1000)
+    records = [{'id': i, 'name': 'é' * (i % 7)} for i in range(500)]
+    body = json.dumps(records).encode('utf-8')
+    local_s3.put_object(Bucket=BUCKET, Key='chunk.json', Body=body)
+
+    data = s3_io.download_bytes(BUCKET, 'chunk.json')
+    assert isinstance(data, bytearray)
+    assert data == body
+    assert json.loads(data.decode('utf-8')) == records
+    assert list(s3_io.iter_json_array(data)) == records
+
+    tail = s3_io.download_bytes(BUCKET, 'chunk.json', size=len(body), offset=len(body) - 2000)
+    assert tail == body[-2000:]
+
+def put_lines(local_s3, key, lines):
+    body = ''.join(line + '\n' for line in lines).encode('utf-8')
+    local_s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+    return len(body)
+
+def test_small_objects_are_counted_exactly(local_s3, monkeypatch):
+    monkeypatch.setattr(s3_io, 'S3_HEDGE_READS', False)
+    size = put_lines(local_s3, 'small.jsonl', [json.dumps({'id': i}) for i in range(300)])
+    assert s3_io.estimate_line_count(BUCKET, 'small.jsonl', size)['records'] == 300
+    local_s3.put_object(Bucket=BUCKET, Key='unterminated.jsonl', Body=b'{"id": 1}\n{"id": 2}')
+    exact = s3_io.estimate_line_count(BUCKET, 'unterminated.jsonl', 19)
+    assert (exact['records'], exact['errorBound'], exact['method']) == (2, 0, 'exact')
+    assert s3_io.estimate_line_count(BUCKET, 'empty.jsonl', 0)['records'] == 0
+
+def test_sampled_estimate_is_within_its_error_bound(local_s3, monkeypatch):
+    monkeypatch.setattr(s3_io, 'S3_HEDGE_READS', False)
+    generator = random.Random(11)
+    # Record sizes drift through the file, so a single sample would be biased
+    lines = [json.dumps({'id': i, 'payload': 'x' * generator.randint(20, 80 + i // 200)}) for i in range(40000)]
+    size = put_lines(local_s3, 'large.jsonl', lines)
+
+    estimate = s3_io.estimate_line_count(BUCKET, 'large.jsonl', size, samples=16, sample_bytes=8 * 1024)
+    assert estimate['method'] == 'sampled'
+    assert estimate['sampledBytes'] < size
+    assert 0 < estimate['errorBound'] < len(lines) * 0.2
+    assert abs(estimate['records'] - len(lines)) <= estimate['errorBound']
+
+def test_hedge_threshold_is_kept_per_read_size_class():
+    policy = s3_io.HedgePolicy(percentile=95, window=100, min_samples=20, min_delay_ms=0)
+    for i in range(50):
+        policy.record_latency(0.020 + i / 10000, 64 * 1024)
+        policy.record_latency(2.0 + i / 100, 16 * 1024 * 1024)
+
+    # A slow 16MB part does not raise the threshold of 64KB samples, nor the reverse
+    assert policy.threshold(60 * 1024) < 0.03
+    assert policy.threshold(16 * 1024 * 1024) > 2.0
+    assert policy.threshold(1024 * 1024) is None
+    assert set(policy.get_statistics()['thresholdMs']) == {str(64 * 1024), str(16 * 1024 * 1024)}
@@ -0,0 +1,53 @@
+import math
+import random
+
+import stage_metrics
+
+def exact_percentile(values, percentile):
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(len(ordered) * percentile / 100)) - 1]
+
+def test_percentiles_stay_within_the_bucket_error():
+    generator = random.Random(42)
+    seconds = [generator.lognormvariate(math.log(0.02), 1.2) for _ in range(20000)]
+    histogram = stage_metrics.LatencyHistogram()
+    for value in seconds:
+        histogram.record(value)
+
+    for percentile in (50, 90, 99, 99.9):
+        exact_ms = exact_percentile(seconds, percentile) * 1000
+        assert math.isclose(histogram.percentile(percentile), exact_ms, rel_tol=1 / 32)
+    assert histogram.percentile(100) == max(int(value * 1000000) for value in seconds) / 1000
+    assert stage_metrics.LatencyHistogram().percentile(99) == 0
+
+def test_merged_histograms_equal_one_histogram_of_all_values():
+    generator = random.Random(7)
+    parts = [[generator.expovariate(1 / scale) for _ in range(3000)] for scale in (0.001, 0.05, 2.0)]
+    combined = stage_metrics.LatencyHistogram()
+    merged = stage_metrics.LatencyHistogram()
+    for part in parts:
+        histogram = stage_metrics.LatencyHistogram()
+        for value in part:
+            histogram.record(value)
+            combined.record(value)
+        # Round-trip through the serialized form, as chunk results do
+        merged.merge(stage_metrics.LatencyHistogram.from_dict(histogram.to_dict()))
+
+    assert merged.to_dict() == combined.to_dict()
+    assert merged.get_summary() == combined.get_summary()
+
+def test_merge_latency_combines_histograms_per_key():
+    first, second = stage_metrics.LatencyHistograms(), stage_metrics.LatencyHistograms()
+    for i in range(100):
+        first.record(0, 0.010)
+        second.record(0, 0.030)
+        second.record(1, 0.005)
+
+    merged = stage_metrics.merge_latency([first.to_dict(), None, second.to_dict()])
+    assert list(merged) == ['0', '1']
+    summary = stage_metrics.summarize_latency(merged, 'partition')
+    assert summary['overall']['count'] == 300
+    assert summary['groups']['0']['count'] == 200
+    assert math.isclose(summary['groups']['0']['p50Ms'], 10, rel_tol=1 / 32)
+    assert math.isclose(summary['groups']['0']['p99Ms'], 30, rel_tol=1 / 32)
+    assert stage_metrics.merge_latency([None, {}]) is None
@@ -0,0 +1,63 @@
+import json
+import time
+
+from conftest import BUCKET
+
+BATCH_ID = 'batch-1'
+
+def put_json(local_s3, key, value):
+    local_s3.put_object(Bucket=BUCKET, Key=key, Body=json.dumps(value).encode('utf-8'))
+
+def put_heartbeat(local_s3, chunk_id, state='running', age=0.0, attempt='primary'):
+    suffix = '' if attempt == 'primary' else f".{attempt}"
+    put_json(local_s3, f"heartbeats/{BATCH_ID}/{chunk_id}{suffix}.json", {
+        'chunkId': chunk_id, 'attempt': attempt, 'state': state, 'offset': 10, 'totalRecords': 100,
+        'forkOffset': 0, 'recordsPerSecond': 1.0, 'startedAt': time.time() - age, 'updatedAt': time.time() - age})
+
+def poll(module, total_chunks=3):
+    return module.lambda_handler({'chunkConfig': {'bucket': BUCKET, 'batchId': BATCH_ID,
+                                                  'configuration': {'totalChunks': total_chunks}}}, None)
+
+def test_monitor_waits_for_chunks_without_heartbeats_until_map_is_done(load_handler, local_s3):
+    module = load_handler('straggler-monitor')
+    put_json(local_s3, f"commits/{BATCH_ID}/chunk-0.json", {'attempt': 'primary', 'result': {}})
+    # chunk-1 ran on Batch and failed, chunk-2 crashed before its first heartbeat
+
+    assert poll(module)['done'] is False
+
+    put_json(local_s3, f"map-done/{BATCH_ID}.json", {})
+    response = poll(module)
+    assert response['done'] is True
+    assert response['mapDone'] is True
+
+def test_running_speculative_attempt_keeps_monitor_open_after_map_is_done(load_handler, local_s3):
+    module = load_handler('straggler-monitor')
+    put_heartbeat(local_s3, 'chunk-0', state='failed')
+    put_heartbeat(local_s3, 'chunk-0', attempt=module.SPECULATIVE_ATTEMPT)
+    put_json(local_s3, f"map-done/{BATCH_ID}.json", {})
+
+    response = poll(module, total_chunks=1)
+    assert response['done'] is False
+    assert response['failedChunks'] == 0
+
+def test_chunk_without_heartbeats_for_lost_seconds_is_settled(load_handler, local_s3):
+    module = load_handler('straggler-monitor')
+    put_heartbeat(local_s3, 'chunk-0', age=module.CHUNK_LOST_SECONDS + 1)
+    put_heartbeat(local_s3, 'chunk-1', state='failed')
+
+    response = poll(module, total_chunks=2)
+    assert response['lostChunks'] == 1
+    assert response['done'] is True
+
+class FailingLambda:
+    def invoke(self, **kwargs):
+        raise RuntimeError('AccessDeniedException')
+
+def test_failed_launch_leaves_no_speculation_marker(load_handler, local_s3, monkeypatch):
+    import s3_io
+    module = load_handler('straggler-monitor')
+    monkeypatch.setitem(s3_io._clients, 'lambda', FailingLambda())
+    heartbeat = {'chunkId': 'chunk-0', 'forkOffset': 10, 'event': {'chunkId': 'chunk-0'}}
+
+    assert module.launch_speculative_attempt(BUCKET, BATCH_ID, heartbeat) is False
+    assert s3_io.get_json(BUCKET, f"speculation/{BATCH_ID}/chunk-0.json") is None
@@ -0,0 +1,206 @@
+import json
+import time
+import functools
+import threading
+
+import pytest
+
+import spill_buffer
+
+from conftest import BUCKET
+
+CHUNK_KEY = 'chunks/batch-1/chunk-0.json'
+
+def test_spill_buffer_keeps_chunk_order_when_blocks_finish_out_of_order(load_handler, local_s3, monkeypatch, tmp_path):
+    module = load_handler('update-records')
+    block_size = 50
+    records = [{'id': i} for i in range(block_size * 24)]
+    local_s3.put_object(Bucket=BUCKET, Key=CHUNK_KEY, Body=json.dumps(records).encode('utf-8'))
+    monkeypatch.setattr(module, 'iter_record_blocks', functools.partial(module.iter_record_blocks, block_size=block_size))
+
+    def slow_even_blocks(record, customer_id, tenant_id):
+        # Even blocks take longer to transform, so odd blocks reach the senders first
+        if record['id'] % block_size == 0 and (record['id'] // block_size) % 2 == 0:
+            time.sleep(0.02)
+        return dict(record, customerId=customer_id)
+
+    monkeypatch.setattr(module, 'transform_record', slow_even_blocks)
+    sink = spill_buffer.SpillBuffer(directory=str(tmp_path))
+    try:
+        result = module.run_chunk_pipeline(BUCKET, CHUNK_KEY, 'chunk-0', 0, 'customer', 'tenant', 'batch-1',
+                                           'none', [], '', '', sink)
+        assert result['records'] is sink
+        assert [record['id'] for record in sink] == [record['id'] for record in records]
+    finally:
+        sink.close()
+
+def test_in_memory_sink_moved_to_spill_keeps_chunk_order(load_handler, local_s3, monkeypatch, tmp_path):
+    module = load_handler('update-records')
+    block_size = 50
+    records = [{'id': i} for i in range(block_size * 24)]
+    local_s3.put_object(Bucket=BUCKET, Key=CHUNK_KEY, Body=json.dumps(records).encode('utf-8'))
+    monkeypatch.setattr(module, 'iter_record_blocks', functools.partial(module.iter_record_blocks, block_size=block_size))
+    monkeypatch.setattr(spill_buffer.SpillBuffer.__init__, '__defaults__', (str(tmp_path), spill_buffer.SPILL_MAX_BYTES))
+
+    def slow_even_blocks(record, customer_id, tenant_id):
+        if record['id'] % block_size == 0 and (record['id'] // block_size) % 2 == 0:
+            time.sleep(0.02)
+        return record
+
+    class OverBudgetAfterFirstBlocks:
+        """A memory guard that runs out of budget once a few blocks are held"""
+        def __init__(self):
+            self.blocks = 0
+        def over_budget(self):
+            return self.blocks >= 5
+        def add_buffer(self, name, size):
+            self.blocks += 1
+        def set_buffer(self, name, size):
+            pass
+        def note(self, event, detail=''):
+            pass
+
+    monkeypatch.setattr(module, 'transform_record', slow_even_blocks)
+    result = module.run_chunk_pipeline(BUCKET, CHUNK_KEY, 'chunk-0', 0, 'customer', 'tenant', 'batch-1',
+                                       'none', [], '', '', [], memory=OverBudgetAfterFirstBlocks())
+    try:
+        assert isinstance(result['records'], spill_buffer.SpillBuffer)
+        assert [record['id'] for record in result['records']] == [record['id'] for record in records]
+    finally:
+        result['records'].close()
+
+def test_spill_buffer_switched_to_is_removed_when_the_pipeline_fails(load_handler, local_s3, monkeypatch, tmp_path):
+    module = load_handler('update-records')
+    records = [{'id': i} for i in range(50 * 24)]
+    local_s3.put_object(Bucket=BUCKET, Key=CHUNK_KEY, Body=json.dumps(records).encode('utf-8'))
+    monkeypatch.setattr(spill_buffer.SpillBuffer.__init__, '__defaults__', (str(tmp_path), spill_buffer.SPILL_MAX_BYTES))
+    iter_record_blocks = module.iter_record_blocks
+
+    def blocks_then_read_error(records, start=0):
+        for block in iter_record_blocks(records, block_size=50, start=start):
+            if block['sequence'] == 20:
+                raise ConnectionError('connection reset reading the chunk')
+            yield block
+
+    class OverBudget:
+        def over_budget(self):
+            return True
+        def set_buffer(self, name, size):
+            pass
+        def note(self, event, detail=''):
+            pass
+
+    monkeypatch.setattr(module, 'iter_record_blocks', blocks_then_read_error)
+    with pytest.raises(RuntimeError, match='connection reset'):
+        module.run_chunk_pipeline(BUCKET, CHUNK_KEY, 'chunk-0', 0, 'customer', 'tenant', 'batch-1',
+                                  'none', [], '', '', [], memory=OverBudget())
+    assert list(tmp_path.glob('spill-*')) == []
+
+class BlockBudgetContext:
+    """Lambda context whose remaining time runs out after a fixed number of blocks"""
+    invoked_function_arn = 'arn:aws:lambda:local:000000000000:function:scm-batch-processor-update-records'
+    memory_limit_in_mb = 10240
+    
+    def __init__(self, blocks: int):
+        self.checks = 0
+        self.blocks = blocks
+    
+    def get_remaining_time_in_millis(self) -> int:
+        self.checks += 1
+        return 10 ** 9 if self.checks < self.blocks else 0
+
+@pytest.mark.parametrize('mode', [{}, {'spillToDisk': True}, {'pipelined': True}])
+def test_continued_chunk_resumes_at_the_next_record_byte(load_handler, local_s3, monkeypatch, mode):
+    module = load_handler('update-records')
+    block_size = 20
+    records = [{'id': i, 'name': 'récord ✓' * (i % 4)} for i in range(block_size * 10 + 7)]
+    local_s3.put_object(Bucket=BUCKET, Key='chunks/batch-1/chunk-0.json',
+                        Body=json.dumps(records, ensure_ascii=False).encode('utf-8'))
+    monkeypatch.setattr(module, 'iter_record_blocks', functools.partial(module.iter_record_blocks, block_size=block_size))
+    monkeypatch.setattr(module, 'CONTINUATION_RESERVE_MS', 1)
+    event = dict(mode, chunkId='chunk-0', startIndex=0, endIndex=len(records) - 1, bucket=BUCKET, file='input.json',
+                 customerId='customer', tenantId='tenant', batchId='batch-1', destination='none')
+    
+    invocations = 0
+    while True:
+        response = module.lambda_handler(event, BlockBudgetContext(blocks=3))
+        invocations += 1
+        if response.get('status') != 'CONTINUE':
+            break
+        continuation = response['continuation']
+        assert 'totals' not in continuation
+        assert continuation['nextByte'] > 0
+        assert local_s3.head_object(Bucket=BUCKET, Key=continuation['totalsKey'])
+        event = response
+    
+    assert response['status'] == 'SUCCESS'
+    assert invocations > 2
+    assert response['recordsProcessed'] == len(records)
+    sent = [record for key in response['resultKeys']
+            for record in json.loads(local_s3.get_object(Bucket=BUCKET, Key=key)['Body'].read())]
+    assert [record['originalId'] for record in sent] == [record['id'] for record in records]
+
+class FlakyFuture:
+    """Delivery future that fails, succeeds or never resolves"""
+    def __init__(self, outcome, partition):
+        self.outcome = outcome
+        self.metadata = type('RecordMetadata', (), {'partition': partition})()
+
+    def add_callback(self, fn, *args):
+        if self.outcome == 'delivered':
+            fn(*args, self.metadata)
+        return self
+
+    def add_errback(self, fn, *args):
+        if self.outcome == 'failed':
+            fn(*args, RuntimeError('NotLeaderForPartition'))
+        return self
+
+class FlakyProducer:
+    """Fails every 10th delivery and leaves every 25th unacknowledged after flush"""
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def send(self, topic, value=None, key=None, headers=None):
+        with self.lock:
+            self.count += 1
+            count = self.count
+        if count % 10 == 0:
+            return FlakyFuture('failed', 0)
+        if count % 25 == 0:
+            return FlakyFuture('pending', 0)
+        return FlakyFuture('delivered', count % 3)
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self):
+        pass
+
+@pytest.mark.parametrize('shards', [1, 3])
+def test_kafka_counts_only_acknowledged_messages_as_sent(load_handler, monkeypatch, shards):
+    module = load_handler('update-records')
+    monkeypatch.setattr(module, 'create_kafka_producer', lambda brokers: FlakyProducer())
+    monkeypatch.setattr(module, 'KAFKA_PRODUCER_SHARDS', shards)
+    records = [{'id': i} for i in range(600)]
+
+    result = module.send_records_to_kafka(records, 'chunk-0', 0, 'customer', 'tenant', 'batch-1', ['broker'], 'topic')
+
+    # 60 failed and 12 unacknowledged per 600 messages, for every shard producer alike
+    assert (result['success'], result['errors']) == (528, 72)
+    assert result['partitionStats']['deliveryErrors'] == 60
+    assert sum(result['partitionStats']['partitions'].values()) == 528
+
+def test_pipelined_chunk_counts_kafka_deliveries_after_the_flush(load_handler, local_s3, monkeypatch):
+    module = load_handler('update-records')
+    monkeypatch.setattr(module, 'create_kafka_producer', lambda brokers: FlakyProducer())
+    monkeypatch.setattr(module, 'KAFKA_PRODUCER_SHARDS', 1)
+    records = [{'id': i} for i in range(600)]
+    local_s3.put_object(Bucket=BUCKET, Key=CHUNK_KEY, Body=json.dumps(records).encode('utf-8'))
+    monkeypatch.setattr(module, 'iter_record_blocks', functools.partial(module.iter_record_blocks, block_size=50))
+
+    result = module.run_chunk_pipeline(BUCKET, CHUNK_KEY, 'chunk-0', 0, 'customer', 'tenant', 'batch-1',
+                                       'kafka', ['broker'], 'topic', '', [])
+
+    assert (result['kafka']['success'], result['kafka']['errors']) == (528, 72)
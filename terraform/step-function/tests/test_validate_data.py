@@ -0,0 +1,108 @@
+import random
+
+import pytest
+
+@pytest.fixture
+def validate_data(load_handler):
+    return load_handler('validate-data')
+
+def run_test(module, ranges):
+    test = module.SequentialErrorRateTest(0.01)
+    decision = None
+    for records, errors in ranges:
+        test.add_range(records, errors)
+        decision = test.decision()
+        if decision:
+            break
+    return decision, test.estimate()['ranges']
+
+def binomial_ranges(rate, count=32, records=300, seed=7):
+    rng = random.Random(seed)
+    return [(records, sum(1 for _ in range(records) if rng.random() < rate)) for _ in range(count)]
+
+def test_spread_errors_well_above_threshold_are_rejected(validate_data):
+    decision, ranges = run_test(validate_data, binomial_ranges(0.05))
+    assert decision == 'REJECTED'
+    assert ranges <= 10
+
+def test_clean_ranges_are_accepted_after_the_minimum_ranges(validate_data):
+    decision, ranges = run_test(validate_data, [(300, 0)] * 32)
+    assert decision == 'ACCEPTED'
+    assert ranges == validate_data.EARLY_ABORT_MIN_RANGES
+
+def test_errors_clustered_in_one_range_do_not_reject(validate_data):
+    # 20% of one range fails, which a record-level test would read as a 5% file after four ranges
+    decision, _ = run_test(validate_data, [(300, 60)] + [(300, 0)] * 31)
+    assert decision != 'REJECTED'
+
+def test_uneven_errors_widen_the_standard_error(validate_data):
+    spread = validate_data.SequentialErrorRateTest(0.01)
+    clustered = validate_data.SequentialErrorRateTest(0.01)
+    for _ in range(8):
+        spread.add_range(300, 15)
+    for errors in (113, 1, 1, 1, 1, 1, 1, 1):
+        clustered.add_range(300, errors)
+    assert spread.estimate()['rate'] == clustered.estimate()['rate']
+    assert clustered.estimate()['standardError'] > spread.estimate()['standardError']
+    assert spread.decision() == 'REJECTED'
+    assert clustered.decision() is None
+
+def test_rate_near_threshold_is_never_rejected(validate_data):
+    rejected = sum(run_test(validate_data, binomial_ranges(0.01, seed=seed))[0] == 'REJECTED' for seed in range(200))
+    assert rejected <= 2
+
+def test_empty_ranges_are_ignored(validate_data):
+    test = validate_data.SequentialErrorRateTest(0.01)
+    test.add_range(0, 0)
+    assert test.estimate()['ranges'] == 0
+    assert test.decision() is None
+
+def run_duplicate_check(module, records, **options):
+    detector = module.DuplicateIdDetector(field='id', **options)
+    for record in records:
+        detector.add(record)
+    for line_number, record in enumerate(records, 1):
+        detector.count(record, line_number)
+    return detector
+
+def test_duplicate_check_counts_exactly_despite_filter_false_positives(validate_data):
+    rng = random.Random(3)
+    ids = [f"gss-{i}" for i in range(20000)]
+    repeated = rng.sample(ids, 150)
+    records = [{'id': value} for value in ids + repeated + repeated[:40]]
+    rng.shuffle(records)
+    # A 1KB filter is saturated by 20k ids, so most candidates are false positives
+    detector = run_duplicate_check(validate_data, records, filter_mb=1 / 1024)
+    summary = detector.get_summary()
+
+    assert summary['complete']
+    assert summary['candidates'] > 1000
+    assert summary['duplicateIds'] == 150
+    assert summary['duplicateRecords'] == 190
+    first_lines = {}
+    for line_number, record in enumerate(records, 1):
+        first_lines.setdefault(record['id'], line_number)
+    for sample in summary['samples']:
+        assert sample['firstLine'] == first_lines[sample['id']]
+        assert records[sample['secondLine'] - 1]['id'] == sample['id']
+        assert sample['secondLine'] > sample['firstLine']
+
+def test_duplicate_check_false_positive_rate_bounds_false_candidates(validate_data):
+    records = [{'id': i} for i in range(60000)]
+    detector = run_duplicate_check(validate_data, records, filter_mb=32 / 1024)
+    summary = detector.get_summary()
+
+    assert summary['duplicateIds'] == 0
+    observed = summary['candidates'] / summary['idsChecked']
+    assert 0 < observed <= summary['falsePositiveRate']
+
+def test_duplicate_check_skips_unusable_ids_and_reports_dropped_candidates(validate_data):
+    records = [{'id': 'a'}, {'id': 'a'}, {'id': True}, {'id': True}, {'id': ''}, {'id': ''}, {}, 'not a record',
+               {'id': 7}, {'id': '7'}, {'id': 'b'}, {'id': 'b'}]
+    detector = run_duplicate_check(validate_data, records, max_candidates=1)
+    summary = detector.get_summary()
+
+    assert summary['idsChecked'] == 6
+    assert summary['candidatesDropped'] == 2
+    assert not summary['complete']
+    assert summary['duplicateIds'] == 1
@@ -20,7 +20,8 @@ variable "lambda_functions" {
     "scm-batch-processor-update-records",    # [3] Process chunks
     "scm-batch-processor-aggregate-results", # [4] Aggregate results
     "scm-batch-processor-send-to-kafka",     # [5] Send to Kafka
-    "scm-batch-processor-send-to-sqs-core"   # [6] Send to SQS
+    "scm-batch-processor-send-to-sqs-core",  # [6] Send to SQS
+    "scm-batch-processor-straggler-monitor"  # [7] Straggler monitor
   ]
 }
 
@@ -48,6 +49,18 @@ variable "max_concurrent_chunks" {
   default     = 200  # Increased from 100 to 200 for better parallelization
 }
 
+variable "straggler_poll_seconds" {
+  description = "Seconds between straggler monitor polls of chunk heartbeats"
+  type        = number
+  default     = 30
+}
+
+variable "speculation_role_names" {
+  description = "IAM role names of the straggler-monitor and update-records functions, which invoke the chunk function for speculative attempts"
+  type        = list(string)
+  default     = []
+}
+
 variable "lambda_timeout" {
   description = "Timeout for Lambda functions in seconds"
   type        = number